@@ -0,0 +1,364 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keeps a per-subscriber index of recent ratings from connected users.
+
+Without the index, recommendations are found by scanning the most recent
+ratings of all users and joining them with the connections of the subscriber.
+The index holds the recent ratings of the user sources that the subscriber is
+connected to, so that the candidates can be read with a single memcache get.
+
+The index is rebuilt in the background when it is missing and it is updated
+incrementally as the connected users add new ratings.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from recommender import models
+from protos import cache_pb2
+
+INDEX_CACHE_PREFIX = 'ci:'
+REBUILD_LOCK_CACHE_PREFIX = 'cil:'
+UNCOVERED_REBUILD_CACHE_PREFIX = 'ciu:'
+
+# How many of the strongest user connections of a subscriber are indexed.
+MAX_INDEXED_SOURCES = 500
+# How many recent ratings of each source are read when the index is rebuilt.
+MAX_RATINGS_PER_SOURCE = 100
+MAX_INDEXED_RATINGS = 2000
+# How many subscribers of a user have their index updated when the user rates.
+# The indexes of the others are deleted.
+MAX_UPDATED_SUBSCRIBERS = 1000
+
+# Indexes do not have the sources that were connected after they were built,
+# so they are rebuilt from time to time.
+INDEX_TTL = timedelta(hours=6)
+REBUILD_LOCK_TTL = timedelta(minutes=1)
+# An index that exists but does not cover a request is rebuilt at most this
+# often. The connections of the request may not be among the indexed ones, for
+# example when only the active connections are requested, and then rebuilding
+# does not help.
+UNCOVERED_REBUILD_INTERVAL = timedelta(minutes=30)
+CAS_RETRIES = 3
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _DatetimeToMicros(d):
+  delta = d - _EPOCH
+  return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _MicrosToDatetime(micros):
+  return _EPOCH + timedelta(microseconds=micros)
+
+
+class CandidateRating(object):
+  """A rating of a user that can be recommended to the subscribers."""
+
+  def __init__(self, item_id, publisher_id, publisher_category_id, rating,
+               date):
+    self.item_id = item_id
+    self.publisher_id = publisher_id
+    self.publisher_category_id = publisher_category_id
+    self.rating = rating
+    self.date = date
+
+  def Source(self):
+    return (self.publisher_id, self.publisher_category_id)
+
+
+def CandidateRatingFromPageRating(rating):
+  return CandidateRating(rating.item_id,
+                         rating.key.parent().id(),
+                         models.GetCategoryId(rating.category), rating.rating,
+                         rating.date)
+
+
+class CandidateIndex(object):
+  """Recent ratings of the sources that a subscriber is connected to."""
+
+  def __init__(self, sources, ratings, complete_since=datetime.min):
+    # The set of (publisher_id, publisher_category_id) pairs.
+    self.sources = set(sources)
+    # Sorted from most recent to least recent.
+    self.ratings = sorted(ratings, key=lambda r: r.date, reverse=True)
+    self.complete_since = complete_since
+    self._Trim()
+
+  def Covers(self, sources, since_time):
+    """Whether the index has all the ratings of sources after since_time."""
+    if since_time < self.complete_since:
+      return False
+    for source in sources:
+      if source not in self.sources:
+        return False
+    return True
+
+  def GetRatings(self, since_time):
+    return [r for r in self.ratings if r.date > since_time]
+
+  def AddRating(self, rating):
+    """Adds or replaces the rating of a publisher for an item.
+
+    Args:
+      rating: The new CandidateRating.
+
+    Returns:
+      Whether the index has changed.
+    """
+    changed = False
+    for index, r in enumerate(self.ratings):
+      if r.item_id == rating.item_id and r.publisher_id == rating.publisher_id:
+        del self.ratings[index]
+        changed = True
+        break
+    if rating.rating == 0 or rating.Source() not in self.sources:
+      return changed
+    position = 0
+    while (position < len(self.ratings) and
+           self.ratings[position].date > rating.date):
+      position += 1
+    self.ratings.insert(position, rating)
+    self._Trim()
+    return True
+
+  def _Trim(self):
+    if len(self.ratings) > MAX_INDEXED_RATINGS:
+      self.complete_since = max(self.complete_since,
+                                self.ratings[MAX_INDEXED_RATINGS].date)
+      del self.ratings[MAX_INDEXED_RATINGS:]
+
+  def Serialize(self):
+    index_proto = cache_pb2.CandidateIndex()
+    for publisher_id, publisher_category_id in self.sources:
+      source_proto = index_proto.source.add()
+      source_proto.publisher_id = publisher_id
+      if publisher_category_id is not None:
+        source_proto.publisher_category_id = publisher_category_id
+    for r in self.ratings:
+      rating_proto = index_proto.rating.add()
+      rating_proto.item_id = r.item_id
+      rating_proto.publisher_id = r.publisher_id
+      if r.publisher_category_id is not None:
+        rating_proto.publisher_category_id = r.publisher_category_id
+      rating_proto.rating = r.rating
+      rating_proto.date_micros = _DatetimeToMicros(r.date)
+    if self.complete_since != datetime.min:
+      index_proto.complete_since_micros = _DatetimeToMicros(
+          self.complete_since)
+    return index_proto.SerializeToString()
+
+
+def DeserializeIndex(value):
+  index_proto = cache_pb2.CandidateIndex.FromString(value)
+  sources = [(s.publisher_id, s.publisher_category_id
+              if s.HasField('publisher_category_id') else None)
+             for s in index_proto.source]
+  ratings = [
+      CandidateRating(
+          r.item_id, r.publisher_id, r.publisher_category_id
+          if r.HasField('publisher_category_id') else None, r.rating,
+          _MicrosToDatetime(r.date_micros)) for r in index_proto.rating
+  ]
+  complete_since = datetime.min
+  if index_proto.HasField('complete_since_micros'):
+    complete_since = _MicrosToDatetime(index_proto.complete_since_micros)
+  return CandidateIndex(sources, ratings, complete_since)
+
+
+def _IndexCacheKey(subscriber_id):
+  return INDEX_CACHE_PREFIX + str(subscriber_id)
+
+
+@ndb.tasklet
+def GetIndexAsync(subscriber_id):
+  """Returns the CandidateIndex of a subscriber or None if it is not built."""
+  client = memcache.Client()
+  key = _IndexCacheKey(subscriber_id)
+  cached = yield client.get_multi_async([key])
+  if key not in cached:
+    raise ndb.Return(None)
+  raise ndb.Return(DeserializeIndex(cached[key]))
+
+
+def RequestRebuild(subscriber_id, index_exists=False):
+  if index_exists and not memcache.add(
+      UNCOVERED_REBUILD_CACHE_PREFIX + str(subscriber_id),
+      True,
+      time=UNCOVERED_REBUILD_INTERVAL.total_seconds()):
+    return
+  # Many requests can find the index missing at the same time but we only need
+  # to rebuild it once.
+  if memcache.add(
+      REBUILD_LOCK_CACHE_PREFIX + str(subscriber_id),
+      True,
+      time=REBUILD_LOCK_TTL.total_seconds()):
+    deferred.defer(Rebuild, subscriber_id, _queue='recommendation-updates')
+
+
+def Rebuild(subscriber_id):
+  _RebuildAsync(subscriber_id).get_result()
+
+
+@ndb.tasklet
+def _RebuildAsync(subscriber_id):
+  connections = yield models.Connection.query(
+      models.Connection.publisher_type == models.SOURCE_TYPE_USER,
+      models.Connection.subscriber_id == subscriber_id,
+      models.Connection.version == models.LOGISTIC_REGRESSION_CONNECTION).order(
+          -models.Connection.weight).fetch_async(MAX_INDEXED_SOURCES)
+  sources = []
+  seen_sources = set()
+  for connection in connections:
+    source = (connection.publisher_id, connection.PublisherCategoryId())
+    # There can be both a positive and a negative connection to a source.
+    if source not in seen_sources:
+      seen_sources.add(source)
+      sources.append(source)
+  source_ratings = yield [_GetRecentRatingsAsync(source) for source in sources]
+  ratings = []
+  complete_since = datetime.min
+  for page_ratings in source_ratings:
+    # If we could not read all ratings of the source then we do not know
+    # whether there are any ratings older than the oldest one we have read.
+    if len(page_ratings) >= MAX_RATINGS_PER_SOURCE:
+      complete_since = max(complete_since, page_ratings[-1].date)
+    ratings.extend(
+        CandidateRatingFromPageRating(r)
+        for r in page_ratings
+        if r.rating != 0 and r.item_id)
+  index = CandidateIndex(sources, ratings, complete_since)
+  memcache.set(
+      _IndexCacheKey(subscriber_id),
+      index.Serialize(),
+      time=INDEX_TTL.total_seconds())
+
+
+def _GetRecentRatingsAsync(source):
+  publisher_id, publisher_category_id = source
+  return models.PageRating.query(
+      models.PageRating.category == models.CategoryKey(publisher_category_id,
+                                                       publisher_id),
+      ancestor=models.UserKey(publisher_id)).order(
+          -models.PageRating.date).fetch_async(MAX_RATINGS_PER_SOURCE)
+
+
+def RatingAdded(page_rating):
+  """Updates the indexes of the subscribers of the user who rated a page.
+
+  A rating that was moved to another category replaces the rating in its old
+  category.
+
+  Args:
+    page_rating: The models.PageRating that was added or changed.
+
+  Returns:
+    The set of ids of the subscribers of the user.
+  """
+  if not page_rating.item_id:
+    return set()
+  return _UpdateIndexes(page_rating.key.parent().id(),
+                        [CandidateRatingFromPageRating(page_rating)])
+
+
+def RatingDeleted(page_rating):
+  """Removes a deleted rating from the indexes of the subscribers of the user.
+
+  Args:
+    page_rating: The models.PageRating that was deleted.
+
+  Returns:
+    The set of ids of the subscribers of the user.
+  """
+  return RatingsDeleted(page_rating.key.parent().id(), [page_rating])
+
+
+def RatingsDeleted(user_id, page_ratings):
+  """Removes deleted ratings of a user from the indexes of the subscribers.
+
+  Args:
+    user_id: The id of the user who rated.
+    page_ratings: The models.PageRating of the user that were deleted.
+
+  Returns:
+    The set of ids of the subscribers of the user.
+  """
+  deleted = []
+  for page_rating in page_ratings:
+    if not page_rating.item_id:
+      continue
+    rating = CandidateRatingFromPageRating(page_rating)
+    # The index removes the rating of the item and does not add a neutral one.
+    rating.rating = 0
+    deleted.append(rating)
+  if not deleted:
+    return set()
+  return _UpdateIndexes(user_id, deleted)
+
+
+def _UpdateIndexes(publisher_id, ratings):
+  # We look at the subscribers of all categories of the publisher because the
+  # rating might have been moved from another category.
+  query = models.Connection.query(
+      models.Connection.publisher_id == publisher_id,
+      models.Connection.version == models.LOGISTIC_REGRESSION_CONNECTION,
+      projection=[models.Connection.subscriber_id],
+      distinct=True)
+  connections, cursor, more = query.fetch_page(MAX_UPDATED_SUBSCRIBERS)
+  subscriber_ids = set(c.subscriber_id for c in connections)
+  if subscriber_ids:
+    _AddRatingsToIndexes(subscriber_ids, ratings)
+  if more:
+    logging.warning(
+        'User %s has more than %d subscribers, deleting the other indexes',
+        publisher_id, MAX_UPDATED_SUBSCRIBERS)
+  while more:
+    # Deleting is cheaper than updating, the indexes are rebuilt when needed.
+    connections, cursor, more = query.fetch_page(
+        MAX_UPDATED_SUBSCRIBERS, start_cursor=cursor)
+    other_ids = set(c.subscriber_id for c in connections)
+    memcache.delete_multi([_IndexCacheKey(i) for i in other_ids])
+    subscriber_ids.update(other_ids)
+  return subscriber_ids
+
+
+def _AddRatingsToIndexes(subscriber_ids, ratings):
+  client = memcache.Client()
+  keys = [_IndexCacheKey(subscriber_id) for subscriber_id in subscriber_ids]
+  for _ in range(CAS_RETRIES):
+    # We only update the indexes that exist. The missing ones will be rebuilt
+    # when they are needed.
+    cached = client.get_multi(keys, for_cas=True)
+    updated = {}
+    for key, value in cached.iteritems():
+      index = DeserializeIndex(value)
+      changed = False
+      for rating in ratings:
+        changed = index.AddRating(rating) or changed
+      if changed:
+        updated[key] = index.Serialize()
+    if not updated:
+      return
+    keys = client.cas_multi(updated, time=INDEX_TTL.total_seconds())
+    if not keys:
+      return
+  # Somebody else keeps updating these indexes. Rather than leaving them
+  # without the new rating we delete them so that they are rebuilt.
+  memcache.delete_multi(keys)
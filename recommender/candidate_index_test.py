@@ -0,0 +1,166 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import unittest
+
+from recommender import candidate_index
+from recommender import models
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class CandidateIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.now = datetime(2020, 1, 2, 3, 4, 5, 678901)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Rating(self, item_id, publisher_id, rating=1, minutes_ago=0,
+             category_id=None):
+    return candidate_index.CandidateRating(
+        item_id, publisher_id, category_id, rating,
+        self.now - timedelta(minutes=minutes_ago))
+
+  def testSerialization(self):
+    index = candidate_index.CandidateIndex(
+        [('1', None), ('2', 5)],
+        [self.Rating(10, '1'), self.Rating(11, '2', -1, 3, category_id=5)],
+        self.now - timedelta(days=1))
+    restored = candidate_index.DeserializeIndex(index.Serialize())
+    self.assertEqual(index.sources, restored.sources)
+    self.assertEqual(index.complete_since, restored.complete_since)
+    self.assertEqual(
+        [(r.item_id, r.Source(), r.rating, r.date) for r in index.ratings],
+        [(r.item_id, r.Source(), r.rating, r.date) for r in restored.ratings])
+
+  def testCovers(self):
+    index = candidate_index.CandidateIndex([('1', None)], [],
+                                           self.now - timedelta(days=1))
+    self.assertTrue(index.Covers([('1', None)], self.now))
+    self.assertFalse(index.Covers([('1', None), ('2', None)], self.now))
+    self.assertFalse(
+        index.Covers([('1', None)], self.now - timedelta(days=2)))
+
+  def testAddRating(self):
+    index = candidate_index.CandidateIndex(
+        [('1', None)], [self.Rating(10, '1', minutes_ago=5)])
+    self.assertTrue(index.AddRating(self.Rating(11, '1', minutes_ago=1)))
+    self.assertEqual([11, 10], [r.item_id for r in index.ratings])
+
+    # Ratings of the sources that are not indexed are ignored.
+    self.assertFalse(index.AddRating(self.Rating(12, '2')))
+
+    # A new rating of the same item replaces the old one.
+    self.assertTrue(index.AddRating(self.Rating(10, '1', rating=-1)))
+    self.assertEqual([(10, -1), (11, 1)],
+                     [(r.item_id, r.rating) for r in index.ratings])
+
+    # A rating that was moved to another category is removed.
+    self.assertTrue(index.AddRating(self.Rating(11, '1', category_id=7)))
+    self.assertEqual([10], [r.item_id for r in index.ratings])
+
+  def testTrimming(self):
+    ratings = [
+        self.Rating(i, '1', minutes_ago=i)
+        for i in range(candidate_index.MAX_INDEXED_RATINGS + 10)
+    ]
+    index = candidate_index.CandidateIndex([('1', None)], ratings)
+    self.assertEqual(candidate_index.MAX_INDEXED_RATINGS, len(index.ratings))
+    self.assertEqual(
+        self.now - timedelta(minutes=candidate_index.MAX_INDEXED_RATINGS),
+        index.complete_since)
+    self.assertTrue(index.Covers([('1', None)], index.complete_since))
+    self.assertFalse(
+        index.Covers([('1', None)],
+                     index.complete_since - timedelta(minutes=1)))
+
+  def testRatingDeleted(self):
+    # Two connections to the same subscriber, only one update is needed.
+    for positive in (True, False):
+      models.Connection(
+          publisher_type=models.SOURCE_TYPE_USER,
+          publisher_id='1',
+          subscriber_id='2',
+          positive=positive,
+          version=models.LOGISTIC_REGRESSION_CONNECTION).put()
+    index = candidate_index.CandidateIndex(
+        [('1', None)], [self.Rating(10, '1'), self.Rating(11, '1')])
+    memcache.set(candidate_index.INDEX_CACHE_PREFIX + '2', index.Serialize())
+    page_rating = models.PageRating(
+        key=ndb.Key(models.PageRating, 'http://a', parent=models.UserKey('1')),
+        item_id=10,
+        rating=1,
+        date=self.now)
+
+    self.assertEqual(set(['2']), candidate_index.RatingDeleted(page_rating))
+    self.assertEqual(
+        [11],
+        [r.item_id
+         for r in candidate_index.GetIndexAsync('2').get_result().ratings])
+
+  def testUncoveredRebuildIsRateLimited(self):
+    candidate_index.RequestRebuild('2', index_exists=True)
+    memcache.delete(candidate_index.REBUILD_LOCK_CACHE_PREFIX + '2')
+    candidate_index.RequestRebuild('2', index_exists=True)
+    self.assertIsNone(
+        memcache.get(candidate_index.REBUILD_LOCK_CACHE_PREFIX + '2'))
+    # A missing index is still rebuilt.
+    candidate_index.RequestRebuild('2')
+    self.assertTrue(
+        memcache.get(candidate_index.REBUILD_LOCK_CACHE_PREFIX + '2'))
+
+  def testIndexesBeyondTheLimitAreDeleted(self):
+    candidate_index.MAX_UPDATED_SUBSCRIBERS = 1
+    try:
+      for subscriber_id in ('2', '3'):
+        models.Connection(
+            publisher_type=models.SOURCE_TYPE_USER,
+            publisher_id='1',
+            subscriber_id=subscriber_id,
+            positive=True,
+            version=models.LOGISTIC_REGRESSION_CONNECTION).put()
+        index = candidate_index.CandidateIndex([('1', None)],
+                                               [self.Rating(11, '1')])
+        memcache.set(candidate_index.INDEX_CACHE_PREFIX + subscriber_id,
+                     index.Serialize())
+      page_ratings = [
+          models.PageRating(
+              key=ndb.Key(models.PageRating, url, parent=models.UserKey('1')),
+              item_id=item_id,
+              rating=1,
+              date=self.now) for url, item_id in (('http://a', 10),
+                                                  ('http://b', 11))
+      ]
+
+      self.assertEqual(
+          set(['2', '3']), candidate_index.RatingsDeleted('1', page_ratings))
+      # The first subscriber is updated and the index of the other is deleted.
+      self.assertEqual(
+          [], candidate_index.GetIndexAsync('2').get_result().ratings)
+      self.assertIsNone(memcache.get(candidate_index.INDEX_CACHE_PREFIX + '3'))
+    finally:
+      candidate_index.MAX_UPDATED_SUBSCRIBERS = 1000
@@ -15,6 +15,7 @@
 from abc import ABCMeta
 from abc import abstractmethod
 import math
+import sys
 
 from recommender import ratings
 
@@ -25,10 +26,71 @@ POSITIVE = True
 NEGATIVE = False
 
 
+# Decays of up to this many items are iterated, longer ones use the closed form.
+EXACT_DECAY_STEPS = 16
+# Decayed weights stay on the side of zero that they started on.
+MIN_DECAYED_WEIGHT = sys.float_info.min
+_LOG_2 = math.log(2)
+# Above this, sinh(z) and asinh(z) are calculated as exp(z) / 2 and log(2 * z).
+LOG_SPACE_THRESHOLD = 20
+
+
 def Sigmoid(z):
   return 1 / (1 + math.exp(-z))
 
 
+def DecayParameters(learning_rate):
+  """Returns the (log_lambda, c) constants of the closed form decay.
+
+  See DecayedWeight.
+  """
+  log_lambda = math.log(1 - learning_rate / 4.0)
+  return log_lambda, -2 * log_lambda / learning_rate
+
+
+def IteratedDecayedWeight(weight, num_items, learning_rate):
+  for _ in range(num_items):
+    weight -= learning_rate * (Sigmoid(weight) - NEUTRAL_PREDICTION)
+  return weight
+
+
+def DecayedWeight(weight, num_items, learning_rate):
+  """Returns the weight after num_items decay steps.
+
+  A step is w -= learning_rate * (Sigmoid(w) - 0.5), which is
+  w -= learning_rate / 2 * tanh(w / 2). Long decays are approximated with
+  w = asinh(sinh(c * w0) * lambda^n) / c, where lambda = 1 - learning_rate / 4
+  and c = -2 * log(lambda) / learning_rate. It is the exact result both for
+  weights close to zero, where a step multiplies the weight by lambda, and for
+  large weights, where a step subtracts learning_rate / 2. In between it is
+  within 0.04 * learning_rate of the iterated result.
+
+  Args:
+    weight: The initial weight.
+    num_items: The number of decay steps.
+    learning_rate: The learning rate of a step, less than 4.
+
+  Returns:
+    The decayed weight.
+  """
+  if weight == 0:
+    return weight
+  if num_items <= EXACT_DECAY_STEPS or learning_rate >= 4:
+    return IteratedDecayedWeight(weight, num_items, learning_rate)
+  log_lambda, c = DecayParameters(learning_rate)
+  z = c * abs(weight)
+  if z > LOG_SPACE_THRESHOLD:
+    log_sinh = z - _LOG_2
+  else:
+    log_sinh = math.log(math.sinh(z))
+  log_decayed_sinh = log_sinh + num_items * log_lambda
+  if log_decayed_sinh > LOG_SPACE_THRESHOLD:
+    decayed = (log_decayed_sinh + _LOG_2) / c
+  else:
+    decayed = math.asinh(math.exp(log_decayed_sinh)) / c
+  return math.copysign(max(decayed, MIN_DECAYED_WEIGHT), weight)
+
+
 class Rating(object):
 
   def __init__(self, rating, user, weight, num_ratings_ago):
@@ -79,6 +141,13 @@ class ConnectionStore(object):
     del user  # Unused in the default implementation.
     return True
 
+  def Flush(self):
+    """Writes changes that the store may have buffered.
+
+    The trainer calls this at the end of every update.
+    """
+    pass
+
 
 class Trainer(object):
   """Updates user-to-user connection weights.
@@ -97,11 +166,11 @@ class Trainer(object):
     self.default_contribution = default_contribution
 
   def GetDecayedWeight(self, initial_weight, num_items):
-    weight = initial_weight
-    for _ in range(num_items):
-      weight -= self.ignore_learning_rate * (
-          Sigmoid(weight) - NEUTRAL_PREDICTION)
-    return weight
+    return DecayedWeight(initial_weight, num_items, self.ignore_learning_rate)
+
+  def GetDecayedWeights(self, initial_weights, num_items):
+    """Returns a list with each of initial_weights decayed by num_items."""
+    return [self.GetDecayedWeight(w, num_items) for w in initial_weights]
 
   def DecayConnectionWeightToPublisher(self, publisher, num_items=1):
     """Decay the weight of connections to a publisher.
@@ -113,20 +182,22 @@ class Trainer(object):
       publisher: The publisher that recommended the items.
       num_items: The number of items the publisher recommended.
     """
-    for connection in self.connection_store.GetSubscribers(
-        publisher, positive=POSITIVE):
-      # We do not decay negative weights because getting out of the negative
-      # zone should be earned by posting useful content, not just a ton of
-      # content that the user ignores.
-      if connection.weight <= 0:
-        continue
-      # This could be calculated using the expected prediction.
-      # w = w - a * (hypothesis(subscriber, item) - 0.5) * rating
-      # But we simplify.
-      weight = self.GetDecayedWeight(connection.weight, num_items)
-
+    # We do not decay negative weights because getting out of the negative
+    # zone should be earned by posting useful content, not just a ton of
+    # content that the user ignores.
+    connections = [
+        c for c in self.connection_store.GetSubscribers(
+            publisher, positive=POSITIVE) if c.weight > 0
+    ]
+    # This could be calculated using the expected prediction.
+    # w = w - a * (hypothesis(subscriber, item) - 0.5) * rating
+    # But we simplify.
+    weights = self.GetDecayedWeights([c.weight for c in connections],
+                                     num_items)
+    for connection, weight in zip(connections, weights):
       self.connection_store.SetWeight(
           connection.user, publisher, POSITIVE, weight, publisher_voted=True)
+    self.connection_store.Flush()
 
   def RecommendationAdded(self, user, item, rating):
     """Updates connection weights between users.
@@ -191,3 +262,4 @@ class Trainer(object):
     # We don't penalize negative ratings.
     if rating == ratings.POSITIVE:
       self.DecayConnectionWeightToPublisher(user)
+    self.connection_store.Flush()
@@ -0,0 +1,116 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Times ConnectionStore.GetRecommendations for a url with many raters.
+
+The datastore stub answers without network latency, so this shows the CPU cost
+and the number of RPCs rather than the latency that the concurrent lookups
+save in production.
+
+Usage: python -m recommender.connection_trainer_benchmark [num_raters]
+"""
+
+from __future__ import print_function
+
+from datetime import datetime
+from datetime import timedelta
+import sys
+import timeit
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from recommender import datastore_based_connection_trainer
+from recommender import models
+
+URL = 'http://example.com/popular'
+RATINGS_PER_RATER = 5
+REPEATS = 3
+
+
+def AddRatings(num_raters):
+  start = datetime(2020, 1, 1)
+  minutes = 0
+  models.PageInfo(
+      key=ndb.Key(models.PageInfo, URL), url=URL, title=URL,
+      canonical_url=URL).put()
+  for rater in range(num_raters):
+    user_key = models.UserKey(str(rater))
+    for index in range(RATINGS_PER_RATER):
+      url = URL if index == 0 else '%s/%d/%d' % (URL, rater, index)
+      minutes += 1
+      models.SetRatingCategory(
+          models.PageRating(
+              key=ndb.Key(models.PageRating, url, parent=user_key),
+              user_id=user_key.id(),
+              url=url,
+              rating=1,
+              date=start + timedelta(minutes=minutes)),
+          None)
+
+
+def RemoveSequenceNumbers():
+  page_ratings = models.PageRating.query().fetch()
+  for page_rating in page_ratings:
+    page_rating.sequence_number = None
+  ndb.put_multi(page_ratings)
+
+
+class RpcCounter(object):
+
+  def __init__(self):
+    self.count = 0
+
+  def __call__(self, service, call, request, response):
+    del service, call, request, response  # Unused.
+    self.count += 1
+
+
+def Measure(label, num_raters, rpc_counter):
+  subscriber = models.Source(models.SOURCE_TYPE_USER, 'subscriber', None)
+
+  def Run():
+    ndb.get_context().clear_cache()
+    store = datastore_based_connection_trainer.BatchingConnectionStore()
+    return store.GetRecommendations(URL, subscriber, 1)
+
+  rpc_counter.count = 0
+  result = Run()
+  assert len(result) == num_raters, len(result)
+  rpcs = rpc_counter.count
+  seconds = min(timeit.repeat(Run, number=1, repeat=REPEATS))
+  print('raters: %d %s: %.1f ms, %d RPCs' % (num_raters, label, seconds * 1000,
+                                            rpcs))
+
+
+def main():
+  num_raters = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  rpc_counter = RpcCounter()
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'rpc_counter', rpc_counter, 'datastore_v3')
+  try:
+    AddRatings(num_raters)
+    Measure('sequence numbers', num_raters, rpc_counter)
+    RemoveSequenceNumbers()
+    Measure('count queries', num_raters, rpc_counter)
+  finally:
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+  main()
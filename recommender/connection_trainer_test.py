@@ -166,3 +166,30 @@ class ConnectionTrainerTest(AbstractConnectionTrainerTest, unittest.TestCase):
 
   def CreateTrainer(self):
     return InMemoryTrainer(0.01, 0.001)
+
+
+class DecayedWeightTest(unittest.TestCase):
+
+  def testShortDecaysAreIterated(self):
+    for num_items in range(connection_trainer.EXACT_DECAY_STEPS + 1):
+      self.assertEqual(
+          connection_trainer.IteratedDecayedWeight(1.5, num_items, 0.1),
+          connection_trainer.DecayedWeight(1.5, num_items, 0.1))
+
+  def testCloseToIteratedDecay(self):
+    for learning_rate in [0.001, 0.1, 1]:
+      for weight in [-3, 0, 0.001, 0.1, 0.5, 1, 2, 5, 10, 50]:
+        for num_items in [17, 20, 50, 100, 1000, 5000]:
+          self.assertAlmostEqual(
+              connection_trainer.IteratedDecayedWeight(weight, num_items,
+                                                       learning_rate),
+              connection_trainer.DecayedWeight(weight, num_items,
+                                               learning_rate),
+              delta=0.04 * learning_rate)
+
+  def testExtremes(self):
+    # Large weights lose learning_rate / 2 per item.
+    self.assertAlmostEqual(
+        1e6 - 500, connection_trainer.DecayedWeight(1e6, 10000, 0.1))
+    self.assertGreater(connection_trainer.DecayedWeight(1, 10**9, 0.1), 0)
+    self.assertLess(connection_trainer.DecayedWeight(-1, 10**9, 0.1), 0)
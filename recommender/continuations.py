@@ -0,0 +1,88 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keeps ranked lists of recommendations between pages.
+
+The first page of recommendations ranks all candidates but only reads the top
+of the ranking. The rest of the ranking is kept in instance memory under an
+opaque token so that the next pages are read from where the previous page
+stopped.
+
+A token only works on the instance that created it and only for a short time.
+When a token is not found the caller has to rank the recommendations again.
+"""
+
+import base64
+import collections
+from datetime import datetime
+from datetime import timedelta
+import os
+import threading
+
+# Rankings hold the scores of all candidates so we only keep a few of them.
+MAX_RANKINGS = 20
+RANKING_TTL = timedelta(minutes=10)
+
+_lock = threading.Lock()
+# Keyed by token, from the least to the most recently saved.
+_rankings = collections.OrderedDict()
+
+
+class _Ranking(object):
+
+  def __init__(self, user_id, request_key, iterator):
+    self.user_id = user_id
+    self.request_key = request_key
+    self.iterator = iterator
+    self.expires = datetime.now() + RANKING_TTL
+
+
+def Save(user_id, request_key, iterator):
+  """Keeps the rest of a ranking and returns a token to read it with.
+
+  Args:
+    user_id: The user that the ranking is for.
+    request_key: Identifies the parameters that the ranking was made with.
+    iterator: Yields the rest of the ranking.
+
+  Returns:
+    The continuation token.
+  """
+  token = base64.urlsafe_b64encode(os.urandom(12))
+  with _lock:
+    _rankings[token] = _Ranking(user_id, request_key, iterator)
+    while len(_rankings) > MAX_RANKINGS:
+      _rankings.popitem(last=False)
+  return token
+
+
+def Pop(user_id, request_key, token):
+  """Returns the rest of a saved ranking or None if it is not available.
+
+  A token can only be used once. The ranking needs to be saved again to get a
+  token for the next page.
+
+  Args:
+    user_id: The user that the ranking is for.
+    request_key: Identifies the parameters of the request.
+    token: The token returned by Save.
+
+  Returns:
+    An iterator or None.
+  """
+  with _lock:
+    ranking = _rankings.pop(token, None)
+  if (ranking is None or ranking.user_id != user_id or
+      ranking.request_key != request_key or ranking.expires < datetime.now()):
+    return None
+  return ranking.iterator
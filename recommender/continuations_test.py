@@ -0,0 +1,54 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import timedelta
+import unittest
+
+from recommender import continuations
+
+
+class ContinuationsTest(unittest.TestCase):
+
+  def testSaveAndPop(self):
+    ranking = iter([1, 2, 3])
+    token = continuations.Save('user', ('DAY',), ranking)
+    # Tokens only work for the same user and request.
+    self.assertIsNone(continuations.Pop('other', ('DAY',), token))
+    token = continuations.Save('user', ('DAY',), ranking)
+    self.assertIsNone(continuations.Pop('user', ('WEEK',), token))
+    token = continuations.Save('user', ('DAY',), ranking)
+    self.assertIs(ranking, continuations.Pop('user', ('DAY',), token))
+    # Tokens can only be used once.
+    self.assertIsNone(continuations.Pop('user', ('DAY',), token))
+
+  def testMaxRankings(self):
+    tokens = [
+        continuations.Save('user', (), iter([]))
+        for _ in range(continuations.MAX_RANKINGS + 1)
+    ]
+    self.assertIsNone(continuations.Pop('user', (), tokens[0]))
+    self.assertIsNotNone(continuations.Pop('user', (), tokens[-1]))
+
+  def testExpired(self):
+    ttl = continuations.RANKING_TTL
+    continuations.RANKING_TTL = timedelta(seconds=-1)
+    try:
+      token = continuations.Save('user', (), iter([]))
+    finally:
+      continuations.RANKING_TTL = ttl
+    self.assertIsNone(continuations.Pop('user', (), token))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,50 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Approximate named counters for monitoring.
+
+The counters live in memcache so they can be lost at any time. They are only
+meant to show trends like cache hit rates, not to be exact.
+"""
+
+from google.appengine.api import memcache
+
+COUNTER_CACHE_PREFIX = 'ctr:'
+# The names of all counters. Counters are only reported when their name is
+# registered here.
+_names = []
+
+
+def Register(*names):
+  """Registers counters so that they are returned by GetAll."""
+  for name in names:
+    if name not in _names:
+      _names.append(name)
+
+
+def Increment(name, delta=1):
+  IncrementMulti({name: delta})
+
+
+def IncrementMulti(name_to_delta):
+  """Increments several counters with a single memcache call."""
+  memcache.offset_multi(
+      {name: int(delta) for name, delta in name_to_delta.iteritems()},
+      key_prefix=COUNTER_CACHE_PREFIX,
+      initial_value=0)
+
+
+def GetAll():
+  """Returns a dict with the values of all registered counters."""
+  values = memcache.get_multi(_names, key_prefix=COUNTER_CACHE_PREFIX)
+  return {name: int(values.get(name, 0)) for name in _names}
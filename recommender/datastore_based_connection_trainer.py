@@ -15,13 +15,19 @@
 from datetime import datetime
 from datetime import timedelta
 
+from google.appengine.ext import ndb
+
 from recommender import connection_trainer
 from recommender import models
 from recommender import ratings
+from recommender import recommendation_cache
+from recommender import weight_decay
 
 LEARNING_RATE = 0.1
 IGNORE_LEARNING_RATE = 0.1
 MAX_TOP_SOURCES = 10
+# Only the most recent ratings of a url are used to train connections.
+MAX_PAST_RATINGS = 1000
 
 MINIMAL_CONNECTION_WEIGHT_TO_BE_SUBSCRIBED = 0
 
@@ -44,45 +50,74 @@ class ConnectionStore(connection_trainer.ConnectionStore):
         positive=positive)
 
   def GetRecommendations(self, url, subscriber, subscriber_rating):
-    result = []
+    return self.GetRecommendationsAsync(url, subscriber,
+                                        subscriber_rating).get_result()
+
+  @ndb.tasklet
+  def GetRecommendationsAsync(self, url, subscriber, subscriber_rating):
+    """Returns the past ratings of url with the weights of their connections.
+
+    The number of later ratings of every rater and the connections of the
+    subscriber to all raters are read concurrently.
+
+    Args:
+      url: The url that the subscriber rated.
+      subscriber: The source that rated it.
+      subscriber_rating: The rating of the subscriber.
+
+    Returns:
+      A list of connection_trainer.Rating.
+    """
     # We do not want to trust the feed specified by the url's meta tags if the
     # user downvoted the url. That's because the specified feed url may not
     # deserve to be punished (e.g., the url is malicious and tries to lower the
     # feeds reputation).
     include_source_feed = (subscriber_rating == ratings.POSITIVE)
-    for rating in models.GetUnifiedRatings(
-        url, include_source_feed=include_source_feed):
+    # Pairs of (rating, source).
+    past_ratings = []
+    # The indexes of the past ratings that the number of later ratings is
+    # needed for.
+    counted = []
+    unified_ratings = yield models.GetUnifiedRatingsAsync(
+        url, include_source_feed=include_source_feed, limit=MAX_PAST_RATINGS)
+    for rating in unified_ratings:
       source = models.Source(rating['type'], rating['publisher_id'],
                              rating['publisher_category_id'])
       if source == subscriber:
         # Any following recommendations are the ones made after the subscriber
         # recommended it and are not interesting to the subscriber.
         break
-      num_ratings_ago = 0
-      if (source.source_type == models.SOURCE_TYPE_FEED and
-          source.source_id == url):
-        # When the user recommends an RSS feed url then we do not want to
-        # penalize it for every item that feed published from the beginning of
-        # time. A freshly recommended feed should start at the same initial
-        # connection weight no matter how many items the feed has published in
-        # the past.
-        num_ratings_ago = 0
-      else:
-        num_ratings_ago = source.GetNumRatingsSinceDate(rating['date'])
-      # The number includes this rating so we decrease it by one.
-      if num_ratings_ago > 0:
-        num_ratings_ago -= 1
-      result.append(
-          connection_trainer.Rating(
-              rating=rating['rating'],
-              user=source,
-              weight=self.GetWeight(subscriber, source, rating['rating'] > 0),
-              num_ratings_ago=num_ratings_ago))
-    return result
+      # When the user recommends an RSS feed url then we do not want to
+      # penalize it for every item that feed published from the beginning of
+      # time. A freshly recommended feed should start at the same initial
+      # connection weight no matter how many items the feed has published in
+      # the past.
+      if not (source.source_type == models.SOURCE_TYPE_FEED and
+              source.source_id == url):
+        counted.append(len(past_ratings))
+      past_ratings.append((rating, source))
+    num_ratings_after, _ = yield (
+        models.GetNumRatingsAfterAsync(
+            [past_ratings[i][0] for i in counted]),
+        self._PrefetchAsync([
+            self.GetConnectionKey(subscriber, source, rating['rating'] > 0)
+            for rating, source in past_ratings
+        ]))
+    num_ratings_ago = [0] * len(past_ratings)
+    for index, num_ratings in zip(counted, num_ratings_after):
+      num_ratings_ago[index] = num_ratings
+    raise ndb.Return([
+        connection_trainer.Rating(
+            rating=rating['rating'],
+            user=source,
+            weight=self.GetWeight(subscriber, source, rating['rating'] > 0),
+            num_ratings_ago=num_ratings_ago[index])
+        for index, (rating, source) in enumerate(past_ratings)
+    ])
 
   def GetWeight(self, subscriber, publisher, positive):
-    connection = self.GetConnectionKey(
-        subscriber, publisher, positive=positive).get()
+    connection = self._Get(
+        self.GetConnectionKey(subscriber, publisher, positive=positive))
     if connection:
       return connection.weight
     return 0
@@ -99,7 +134,7 @@ class ConnectionStore(connection_trainer.ConnectionStore):
     if subscriber.source_type == models.SOURCE_TYPE_FEED:
       return
     key = self.GetConnectionKey(subscriber, publisher, positive=positive)
-    connection = key.get()
+    connection = self._Get(key)
     if connection is None:
       connection = models.Connection(
           key=key,
@@ -152,27 +187,97 @@ class ConnectionStore(connection_trainer.ConnectionStore):
           0, models.ConnectionSourcePage(url=shared_item, weight=1))
       if len(connection.top_sources) > MAX_TOP_SOURCES:
         connection.top_sources = connection.top_sources[:MAX_TOP_SOURCES]
-    connection.put()
+    self._Put(connection)
 
   def GetSubscribers(self, publisher, positive=True):
     publisher_category = models.CategoryKey(publisher.category_id,
                                             publisher.source_id)
+    connections = models.Connection.query(
+        models.Connection.publisher_id == publisher.source_id,
+        models.Connection.publisher_category == publisher_category,
+        models.Connection.version == self.connection_version,
+        models.Connection.positive == positive).fetch()
+    self._Remember(connections)
     return [
         connection_trainer.Connection(
             models.Source(models.SOURCE_TYPE_USER, c.subscriber_id,
                           c.SubscriberCategoryId()), c.weight)
-        for c in models.Connection.query(
-            models.Connection.publisher_id == publisher.source_id,
-            models.Connection.publisher_category == publisher_category,
-            models.Connection.version == self.connection_version,
-            models.Connection.positive == positive)
+        for c in connections
     ]
 
   def CanSubscribe(self, user):
     # Only users can subscribe to other user/feeds.
     return user.source_type == models.SOURCE_TYPE_USER
 
+  @ndb.tasklet
+  def _PrefetchAsync(self, keys):
+    # Fills the ndb context cache that the gets in _Get read from.
+    yield ndb.get_multi_async(keys)
+
+  def _Remember(self, connections):
+    del connections  # Unused in this implementation.
+
+  def _Get(self, key):
+    return key.get()
+
+  def _Put(self, connection):
+    connection.put()
+    recommendation_cache.BumpGeneration(connection.subscriber_id)
+
+
+class BatchingConnectionStore(ConnectionStore):
+  """A ConnectionStore that reads and writes connections in batches.
+
+  The connections needed for an update are read with a single get_multi and
+  the changed connections are kept in memory until Flush writes them with a
+  single put_multi.
+  """
+
+  def __init__(self, connection_version=models.LOGISTIC_REGRESSION_CONNECTION):
+    super(BatchingConnectionStore, self).__init__(connection_version)
+    # The connections read so far by key, None for the missing ones.
+    self._connections = {}
+    # The changed connections by key.
+    self._changed = {}
+
+  @ndb.tasklet
+  def _PrefetchAsync(self, keys):
+    missing = list(set(k for k in keys if k not in self._connections))
+    connections = yield ndb.get_multi_async(missing)
+    for key, connection in zip(missing, connections):
+      self._connections[key] = connection
+
+  def _Remember(self, connections):
+    for connection in connections:
+      self._connections.setdefault(connection.key, connection)
+
+  def _Get(self, key):
+    if key not in self._connections:
+      self._connections[key] = key.get()
+    return self._connections[key]
+
+  def _Put(self, connection):
+    self._connections[connection.key] = connection
+    self._changed[connection.key] = connection
+
+  def Flush(self):
+    if not self._changed:
+      return
+    changed = self._changed.values()
+    self._changed = {}
+    ndb.put_multi(changed)
+    recommendation_cache.BumpGenerations(
+        set(c.subscriber_id for c in changed))
+
+
+class Trainer(connection_trainer.Trainer):
+  """Decays the connections of all subscribers of a publisher with numpy."""
+
+  def GetDecayedWeights(self, initial_weights, num_items):
+    return weight_decay.DecayedWeights(initial_weights, num_items,
+                                       self.ignore_learning_rate).tolist()
+
 
 def CreateTrainer(connection_version=models.LOGISTIC_REGRESSION_CONNECTION):
-  return connection_trainer.Trainer(
-      ConnectionStore(connection_version), LEARNING_RATE, IGNORE_LEARNING_RATE)
+  return Trainer(BatchingConnectionStore(connection_version), LEARNING_RATE,
+                 IGNORE_LEARNING_RATE)
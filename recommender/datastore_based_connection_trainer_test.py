@@ -0,0 +1,121 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import unittest
+
+from recommender import connection_trainer
+from recommender import datastore_based_connection_trainer
+from recommender import items
+from recommender import models
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+POSITIVE = datastore_based_connection_trainer.POSITIVE
+URL = 'http://example.com/page'
+
+
+class BatchingConnectionStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.subscriber = models.Source(models.SOURCE_TYPE_USER, '1', None)
+    self.publisher = models.Source(models.SOURCE_TYPE_USER, '2', None)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testWritesOnFlush(self):
+    store = datastore_based_connection_trainer.BatchingConnectionStore()
+    store.SetWeight(self.subscriber, self.publisher, POSITIVE, 0.5)
+    # The buffered weight is visible to the same store but not stored yet.
+    self.assertEqual(
+        0.5, store.GetWeight(self.subscriber, self.publisher, POSITIVE))
+    self.assertEqual(
+        0,
+        datastore_based_connection_trainer.ConnectionStore().GetWeight(
+            self.subscriber, self.publisher, POSITIVE))
+
+    store.Flush()
+    self.assertEqual(
+        0.5,
+        datastore_based_connection_trainer.ConnectionStore().GetWeight(
+            self.subscriber, self.publisher, POSITIVE))
+
+  def testSameWeightsAsUnbatchedStore(self):
+    unbatched = datastore_based_connection_trainer.ConnectionStore()
+    unbatched.SetWeight(self.subscriber, self.publisher, POSITIVE, 2)
+    trainer = datastore_based_connection_trainer.CreateTrainer()
+    trainer.DecayConnectionWeightToPublisher(self.publisher, num_items=3)
+    decayed = unbatched.GetWeight(self.subscriber, self.publisher, POSITIVE)
+
+    unbatched.SetWeight(self.subscriber, self.publisher, POSITIVE, 2)
+    connection_trainer.Trainer(
+        unbatched, datastore_based_connection_trainer.LEARNING_RATE,
+        datastore_based_connection_trainer.IGNORE_LEARNING_RATE
+    ).DecayConnectionWeightToPublisher(self.publisher, num_items=3)
+    self.assertLess(decayed, 2)
+    self.assertEqual(
+        decayed,
+        unbatched.GetWeight(self.subscriber, self.publisher, POSITIVE))
+
+
+class ConnectionStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    self.testbed.init_search_stub()
+    self.testbed.init_urlfetch_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    models.PageInfo(
+        key=ndb.Key(models.PageInfo, URL), url=URL, title=URL,
+        canonical_url=URL).put()
+    self.start = datetime(2020, 1, 2)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Rate(self, url, minutes, rating=1):
+    models.AddRatingAtTime('2', url, rating, 'fake_source', None,
+                           self.start + timedelta(minutes=minutes))
+
+  def testNumRatingsAgoCountsAllLaterWrites(self):
+    self.Rate(URL, 0)
+    self.Rate('http://a', 1)
+    self.Rate('http://b', 2)
+    self.Rate('http://a', 3, rating=-1)
+    models.DeleteRating('2', 'http://b')
+    self.Rate('http://c', 4, rating=0)
+
+    recommendations = (
+        datastore_based_connection_trainer.ConnectionStore().GetRecommendations(
+            URL, models.Source(models.SOURCE_TYPE_USER, '1', None), 1))
+    # The re-rating of http://a and the deleted rating of http://b are counted
+    # as well, a count of the ratings that exist now would be 2.
+    self.assertEqual([4], [r.num_ratings_ago for r in recommendations])
+
+
+if __name__ == '__main__':
+  unittest.main()
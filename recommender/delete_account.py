@@ -18,15 +18,21 @@ Deletes all objects that are related to a user. This includes:
 NDB objects:
 - User by user_id
 - PageRating by user_id.
-- Connection by publisher_id
+- Connection by publisher_id, after the PageRatings
 - Connection by subscriber_id
 - PastRecommendation by user_id
 - RecommendationSession by user_id
 - Category by parent
+- rating_sequence.RatingSequence by parent
 - export.ExportRatingResult by key
 
 Non NDB objects:
 - Memcache: "ri:<user_id>"
+- Memcache: "ci:<user_id>"
+- The ratings are removed from the "ci:" indexes of the subscribers of the user
+- Memcache: "rg:<user_id>", which makes "rc:<user_id>:*" unreachable
+- Memcache: "ur:<url>" of every rated url
+- The user is removed from models.UrlRatingStats of every positively rated url
 - Clear text search indexes:
  - rating_history:<user_id>
  - saved_for_later:<user_id>
@@ -36,7 +42,11 @@ from google.appengine.api import memcache
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
+from recommender import candidate_index
 from recommender import models
+from recommender import rating_sequence
+from recommender import ratings
+from recommender import recommendation_cache
 
 
 def _DeleteUser(user_id):
@@ -50,9 +60,35 @@ def _DeleteAll(keys, continuation_fn, user_id):
 
 
 def _DeletePageRating(user_id):
-  _DeleteAll(
-      models.PageRating.query(ancestor=models.UserKey(user_id)).fetch(
-          keys_only=True, limit=500), _DeletePageRating, user_id)
+  keys = models.PageRating.query(ancestor=models.UserKey(user_id)).fetch(
+      keys_only=True, limit=500)
+
+  # The ratings are in the entity group of the user, so they are read, deleted
+  # and removed from the stats in one transaction.
+  def Delete():
+    page_ratings = [r for r in ndb.get_multi(keys) if r is not None]
+    positive_urls = [
+        r.url for r in page_ratings if r.rating == ratings.POSITIVE
+    ]
+    if positive_urls:
+      deferred.defer(
+          models.UpdateUrlRatingStatsMulti,
+          positive_urls,
+          -1,
+          _transactional=True)
+    ndb.delete_multi(keys)
+    return page_ratings
+
+  if keys:
+    page_ratings = ndb.transaction(Delete)
+    models.InvalidateUnifiedRatings(r.url for r in page_ratings)
+    recommendation_cache.BumpGenerations(
+        candidate_index.RatingsDeleted(user_id, page_ratings))
+    deferred.defer(_DeletePageRating, user_id)
+  else:
+    # The subscribers are found by the connections of the user, so these are
+    # deleted after the ratings were removed from the indexes.
+    deferred.defer(_DeleteConnectionPublisher, user_id)
 
 
 def _DeleteConnectionPublisher(user_id):
@@ -87,19 +123,38 @@ def _DeleteCategory(user_id):
           keys_only=True, limit=500), _DeleteCategory, user_id)
 
 
+def _DeleteRatingSequence(user_id):
+  _DeleteAll(
+      rating_sequence.RatingSequence.query(
+          ancestor=models.UserKey(user_id)).fetch(keys_only=True, limit=500),
+      _DeleteRatingSequence, user_id)
+
+
 def _DeleteCachedRatings(user_id):
   memcache.delete(models.GetUserRatedItemsCacheKey(user_id))
 
 
+def _DeleteCandidateIndex(user_id):
+  memcache.delete(candidate_index.INDEX_CACHE_PREFIX + str(user_id))
+
+
+def _DeleteCachedRecommendations(user_id):
+  # The cached recommendations are keyed by the generation so they can no
+  # longer be found once it is deleted.
+  memcache.delete(recommendation_cache.GENERATION_CACHE_PREFIX + str(user_id))
+
+
 HANDLERS = [
     _DeleteUser,
     _DeletePageRating,
-    _DeleteConnectionPublisher,
     _DeleteConnectionSubscriber,
     _DeletePastRecommendation,
     _DeleteRecommendationSession,
     _DeleteCategory,
+    _DeleteRatingSequence,
     _DeleteCachedRatings,
+    _DeleteCandidateIndex,
+    _DeleteCachedRecommendations,
 ]
 
 
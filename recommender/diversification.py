@@ -0,0 +1,99 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reorders ranked items so that items with the same key are spread out."""
+
+import collections
+import heapq
+import itertools
+
+
+def DiversifyByKey(all_items, limit, key, window=2, max_per_key=None):
+  """Returns up to limit of all_items such that nearby items have different keys.
+
+  See Diversify for the arguments.
+  """
+  return list(itertools.islice(
+      Diversify(all_items, key, window, max_per_key), limit))
+
+
+def Diversify(all_items, key, window=2, max_per_key=None):
+  """Yields all_items reordered such that nearby items have different keys.
+
+  Items are taken in their original order, skipping the items whose key is
+  among the keys of the last window - 1 yielded items. When every remaining
+  item is skipped, the first remaining item is yielded anyway.
+
+  Items are bucketed by key and the first item of each bucket is kept in a
+  heap, so this takes O(n log k) for n items with k different keys. all_items
+  is read lazily and only as far as needed.
+
+  Args:
+    all_items: An iterable of the items in ranking order.
+    key: Returns the key of an item.
+    window: Any window consecutive items have different keys when possible. The
+      default only separates neighbouring items.
+    max_per_key: If set, at most this many items with the same key are
+      yielded.
+
+  Yields:
+    The items.
+  """
+  items = enumerate(all_items)
+  # Keyed by item key, the (index, item) pairs that were read but not yielded.
+  buckets = collections.defaultdict(collections.deque)
+  # The first (index, key) of each bucket. Indexes are unique so keys are never
+  # compared.
+  heap = []
+  recent_keys = collections.deque(maxlen=max(window - 1, 0))
+  key_counts = collections.defaultdict(int)
+  exhausted = False
+  while True:
+    skipped = []
+    while True:
+      while heap and heap[0][1] in recent_keys:
+        skipped.append(heapq.heappop(heap))
+      # The items that were not read yet come after all items in the buckets so
+      # we only need to read more when all buckets are skipped.
+      if heap or exhausted:
+        break
+      index_and_item = next(items, None)
+      if index_and_item is None:
+        exhausted = True
+        break
+      item_key = key(index_and_item[1])
+      if max_per_key is not None and key_counts[item_key] >= max_per_key:
+        continue
+      bucket = buckets[item_key]
+      bucket.append(index_and_item)
+      if len(bucket) == 1:
+        heapq.heappush(heap, (index_and_item[0], item_key))
+    if heap:
+      _, item_key = heapq.heappop(heap)
+    elif skipped:
+      # The skipped entries were popped in order so the first one is the first
+      # remaining item.
+      _, item_key = skipped.pop(0)
+    else:
+      return
+    for entry in skipped:
+      heapq.heappush(heap, entry)
+    bucket = buckets[item_key]
+    _, item = bucket.popleft()
+    recent_keys.append(item_key)
+    key_counts[item_key] += 1
+    if max_per_key is not None and key_counts[item_key] >= max_per_key:
+      bucket.clear()
+    if bucket:
+      heapq.heappush(heap, (bucket[0][0], item_key))
+    yield item
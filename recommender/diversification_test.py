@@ -0,0 +1,110 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from recommender import diversification
+
+
+def QuadraticDiversifyByKey(all_items, limit, key):
+  """The scan that DiversifyByKey replaced."""
+  if len(all_items) < limit:
+    limit = len(all_items)
+  diverse_items = []
+  previous_key = None
+  added_indexes = set([])
+  for _ in range(0, limit):
+    found_diverse = False
+    first_not_added_index = -1
+    for index, item in enumerate(all_items):
+      if index in added_indexes:
+        continue
+      if first_not_added_index == -1:
+        first_not_added_index = index
+      current_key = key(item)
+      if current_key != previous_key:
+        diverse_items.append(item)
+        added_indexes.add(index)
+        previous_key = current_key
+        found_diverse = True
+        break
+    if not found_diverse:
+      diverse_items.append(all_items[first_not_added_index])
+      added_indexes.add(first_not_added_index)
+  return diverse_items
+
+
+def Key(item):
+  return item[0]
+
+
+class DiversificationTest(unittest.TestCase):
+
+  def testSeparatesNeighbours(self):
+    items = [('a', 1), ('a', 2), ('a', 3), ('b', 4), ('c', 5)]
+    self.assertEqual([('a', 1), ('b', 4), ('a', 2), ('c', 5), ('a', 3)],
+                     diversification.DiversifyByKey(items, 10, Key))
+
+  def testLimit(self):
+    items = [('a', 1), ('a', 2), ('b', 3)]
+    self.assertEqual([('a', 1), ('b', 3)],
+                     diversification.DiversifyByKey(items, 2, Key))
+    self.assertEqual([], diversification.DiversifyByKey(items, 0, Key))
+
+  def testSameAsQuadraticScan(self):
+    rng = random.Random(1)
+    for _ in range(200):
+      items = [(rng.randint(1, 4), i) for i in range(rng.randint(0, 30))]
+      limit = rng.randint(0, 35)
+      self.assertEqual(
+          QuadraticDiversifyByKey(items, limit, Key),
+          diversification.DiversifyByKey(items, limit, Key))
+
+  def testReadsLazily(self):
+    read = []
+
+    def Items():
+      for item in [('a', 1), ('a', 2), ('b', 3), ('c', 4), ('d', 5)]:
+        read.append(item)
+        yield item
+
+    self.assertEqual([('a', 1), ('b', 3)],
+                     diversification.DiversifyByKey(Items(), 2, Key))
+    self.assertEqual(3, len(read))
+
+  def testWindow(self):
+    items = [('a', 1), ('a', 2), ('b', 3), ('b', 4), ('c', 5), ('c', 6)]
+    self.assertEqual(
+        [('a', 1), ('b', 3), ('c', 5), ('a', 2), ('b', 4), ('c', 6)],
+        diversification.DiversifyByKey(items, 10, Key, window=3))
+    # Window 1 keeps the original order.
+    self.assertEqual(items,
+                     diversification.DiversifyByKey(items, 10, Key, window=1))
+
+  def testWindowFallsBackToFirstRemainingItem(self):
+    items = [('a', 1), ('b', 2), ('a', 3), ('b', 4)]
+    self.assertEqual(
+        [('a', 1), ('b', 2), ('a', 3), ('b', 4)],
+        diversification.DiversifyByKey(items, 10, Key, window=3))
+
+  def testMaxPerKey(self):
+    items = [('a', 1), ('a', 2), ('a', 3), ('b', 4)]
+    self.assertEqual([('a', 1), ('b', 4), ('a', 2)],
+                     diversification.DiversifyByKey(
+                         items, 10, Key, max_per_key=2))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Updates many feeds with a sliding window of concurrent fetches.
+
+A new fetch starts as soon as one finishes instead of when a whole batch has
+finished, so one slow feed does not hold back the others. Feeds on the same
+host are only fetched a few at a time so that no host gets many requests at
+once.
+"""
+
+import collections
+import logging
+import time
+import urlparse
+
+from google.appengine.ext import ndb
+
+# How many feeds are fetched at the same time.
+MAX_IN_FLIGHT = 30
+# How many feeds of the same host are fetched at the same time.
+MAX_IN_FLIGHT_PER_HOST = 2
+# How many feeds can wait for their host while other feeds are fetched.
+MAX_WAITING = 200
+
+
+def _Host(feed):
+  url = feed.GetUrl()
+  if url.startswith('feed:'):
+    url = url[5:]
+  return urlparse.urlparse(url).netloc.lower()
+
+
+def UpdateFeeds(feeds,
+                update,
+                on_updated,
+                on_failed=None,
+                max_in_flight=MAX_IN_FLIGHT,
+                max_in_flight_per_host=MAX_IN_FLIGHT_PER_HOST,
+                time_budget_seconds=None):
+  """Updates feeds concurrently.
+
+  Args:
+    feeds: An iterable of feeds.Feed, it is only read as fetches can start.
+    update: Starts the update of a feed and returns a future with its new
+      items.
+    on_updated: Called with a feed and its new items when an update finished.
+    on_failed: Called with a feed when its update raised an exception.
+    max_in_flight: The maximum number of concurrent updates.
+    max_in_flight_per_host: The maximum number of concurrent updates of feeds
+      on the same host.
+    time_budget_seconds: No update is started after this many seconds.
+
+  Returns:
+    True if the time budget ran out before all feeds were updated.
+  """
+  start = time.time()
+  feeds = iter(feeds)
+  no_more_feeds = False
+  # Feeds whose host had too many updates in flight, in the order they were
+  # read.
+  waiting = collections.deque()
+  in_flight = {}
+  host_counts = collections.defaultdict(int)
+
+  def Start(feed, host):
+    host_counts[host] += 1
+    in_flight[update(feed)] = (feed, host)
+
+  while True:
+    out_of_time = (time_budget_seconds is not None and
+                   time.time() - start > time_budget_seconds)
+    if not out_of_time:
+      for _ in range(len(waiting)):
+        if len(in_flight) >= max_in_flight:
+          break
+        feed, host = waiting.popleft()
+        if host_counts[host] < max_in_flight_per_host:
+          Start(feed, host)
+        else:
+          waiting.append((feed, host))
+      while (len(in_flight) < max_in_flight and len(waiting) < MAX_WAITING and
+             not no_more_feeds):
+        feed = next(feeds, None)
+        if feed is None:
+          no_more_feeds = True
+          break
+        host = _Host(feed)
+        if host_counts[host] < max_in_flight_per_host:
+          Start(feed, host)
+        else:
+          waiting.append((feed, host))
+    if not in_flight:
+      return bool(waiting) or not no_more_feeds
+    done = ndb.Future.wait_any(in_flight.keys())
+    feed, host = in_flight.pop(done)
+    host_counts[host] -= 1
+    try:
+      new_items = done.get_result()
+    except StandardError as e:
+      logging.warning('Failed to update feed %s: %s', feed.GetUrl(), e)
+      if on_failed is not None:
+        on_failed(feed)
+      continue
+    on_updated(feed, new_items)
@@ -0,0 +1,89 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares fetching feeds in batches with the sliding window of feed_fetcher.
+
+The urlfetch stub of the SDK answers one call at a time, so the fetches are
+simulated with ndb.sleep for a latency drawn per feed. Most feeds answer
+quickly and a few are slow, like in production.
+
+Usage: python -m recommender.feed_fetcher_benchmark [num_feeds]
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from google.appengine.ext import ndb
+
+from recommender import feed_fetcher
+
+BATCH_SIZE = 20
+NUM_HOSTS = 50
+# The share of feeds that take SLOW_SECONDS instead of FAST_SECONDS.
+SLOW_SHARE = 0.05
+FAST_SECONDS = 0.05
+SLOW_SECONDS = 1.0
+
+
+class SimulatedFeed(object):
+
+  def __init__(self, index, seconds):
+    self.url = 'http://host%d.com/feed%d' % (index % NUM_HOSTS, index)
+    self.seconds = seconds
+
+  def GetUrl(self):
+    return self.url
+
+
+@ndb.tasklet
+def Update(feed):
+  yield ndb.sleep(feed.seconds)
+  raise ndb.Return([])
+
+
+def UpdateInBatches(simulated_feeds):
+  for start in range(0, len(simulated_feeds), BATCH_SIZE):
+    ndb.Future.wait_all(
+        [Update(feed) for feed in simulated_feeds[start:start + BATCH_SIZE]])
+
+
+def UpdateWithSlidingWindow(simulated_feeds):
+  feed_fetcher.UpdateFeeds(simulated_feeds, Update, lambda feed, items: None)
+
+
+def Measure(label, run, simulated_feeds):
+  start = time.time()
+  run(simulated_feeds)
+  seconds = time.time() - start
+  print('%s: %.1f s, %.1f feeds/s' % (label, seconds,
+                                      len(simulated_feeds) / seconds))
+
+
+def main():
+  num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+  rand = random.Random(0)
+  simulated_feeds = [
+      SimulatedFeed(
+          i, SLOW_SECONDS if rand.random() < SLOW_SHARE else FAST_SECONDS)
+      for i in range(num_feeds)
+  ]
+  Measure('batches of %d' % BATCH_SIZE, UpdateInBatches, simulated_feeds)
+  Measure('sliding window of %d' % feed_fetcher.MAX_IN_FLIGHT,
+          UpdateWithSlidingWindow, simulated_feeds)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import unittest
+
+from recommender import feed_fetcher
+
+from google.appengine.ext import ndb
+
+
+class FakeFeed(object):
+
+  def __init__(self, url, seconds=0.01, fail=False):
+    self.url = url
+    self.seconds = seconds
+    self.fail = fail
+
+  def GetUrl(self):
+    return self.url
+
+
+class FeedFetcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.in_flight = collections.Counter()
+    self.max_in_flight = 0
+    self.max_in_flight_per_host = 0
+    self.updated = []
+    self.failed = []
+
+  @ndb.tasklet
+  def Update(self, feed):
+    host = feed_fetcher._Host(feed)
+    self.in_flight[host] += 1
+    self.max_in_flight = max(self.max_in_flight, sum(self.in_flight.values()))
+    self.max_in_flight_per_host = max(self.max_in_flight_per_host,
+                                      self.in_flight[host])
+    yield ndb.sleep(feed.seconds)
+    self.in_flight[host] -= 1
+    if feed.fail:
+      raise ValueError('failed')
+    raise ndb.Return([feed.url])
+
+  def OnUpdated(self, feed, new_items):
+    self.assertEqual([feed.url], new_items)
+    self.updated.append(feed.url)
+
+  def testLimits(self):
+    fake_feeds = [
+        FakeFeed('http://host%d.com/%d' % (i % 3, i)) for i in range(20)
+    ]
+    fake_feeds.append(FakeFeed('http://failing.com/', fail=True))
+
+    self.assertFalse(
+        feed_fetcher.UpdateFeeds(
+            fake_feeds,
+            self.Update,
+            self.OnUpdated,
+            on_failed=lambda feed: self.failed.append(feed.url),
+            max_in_flight=4,
+            max_in_flight_per_host=2))
+    self.assertEqual(sorted(f.url for f in fake_feeds[:-1]),
+                     sorted(self.updated))
+    self.assertEqual(['http://failing.com/'], self.failed)
+    self.assertEqual(4, self.max_in_flight)
+    self.assertEqual(2, self.max_in_flight_per_host)
+
+  def testSlowFeedDoesNotBlockOthers(self):
+    fake_feeds = [FakeFeed('http://slow.com/', seconds=0.5)] + [
+        FakeFeed('http://fast%d.com/' % i) for i in range(10)
+    ]
+
+    feed_fetcher.UpdateFeeds(
+        fake_feeds, self.Update, self.OnUpdated, max_in_flight=2)
+    self.assertEqual('http://slow.com/', self.updated[-1])
+
+  def testTimeBudget(self):
+    fake_feeds = [FakeFeed('http://host%d.com/' % i) for i in range(10)]
+
+    self.assertTrue(
+        feed_fetcher.UpdateFeeds(
+            fake_feeds,
+            self.Update,
+            self.OnUpdated,
+            max_in_flight=2,
+            time_budget_seconds=0.005))
+    self.assertEqual(2, len(self.updated))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -21,8 +21,12 @@ from __future__ import division
 
 from datetime import datetime
 from datetime import timedelta
+import email.utils
+import hashlib
+import httplib
 import io
 import logging
+import re
 import time
 
 import feedparser
@@ -33,11 +37,32 @@ from google.appengine.api import urlfetch_errors
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 
+from recommender import counters
 from recommender import feed_util
 from recommender import items
+from recommender import migrations
+from recommender import rating_sequence
 from recommender import url_util
 from protos import cache_pb2
 
+UPDATES_COUNTER = 'feed_updates'
+# Updates that stopped because the body of the feed did not change.
+UNCHANGED_COUNTER = 'feed_updates_unchanged'
+# Updates that parsed the feed but found no new items.
+UNCHANGED_ENTRIES_COUNTER = 'feed_updates_unchanged_entries'
+counters.Register(UPDATES_COUNTER, UNCHANGED_COUNTER,
+                  UNCHANGED_ENTRIES_COUNTER)
+
+# The bounds of the time between updates of feeds that users are connected to.
+MIN_UPDATE_INTERVAL = timedelta(minutes=30)
+MAX_UPDATE_INTERVAL = timedelta(days=1)
+# Feeds without connections are only updated so that new subscribers find
+# recent items.
+MIN_INACTIVE_UPDATE_INTERVAL = timedelta(hours=12)
+MAX_INACTIVE_UPDATE_INTERVAL = timedelta(days=3)
+DEFAULT_UPDATE_INTERVAL = timedelta(hours=2)
+MAX_FAILURE_BACKOFF = timedelta(days=3)
+
 # 0 - means we do not clean up old feed items.
 MAX_ITEMS_PER_FEED = 0
 CLEAN_UP_ITEMS_PER_UPDATE = 1000
@@ -57,10 +82,43 @@ class Feed(ndb.Model):
   modified = ndb.DateTimeProperty()
   etag = ndb.StringProperty()
   last_updated = ndb.DateTimeProperty()
+  # A digest of the entry ids that were in the feed at the last update. When
+  # the feed has the same entries it has no new items.
+  entry_ids_digest = ndb.StringProperty(indexed=False)
+  # A digest of the body of the feed at the last update. When the body is the
+  # same the feed is not parsed again.
+  content_digest = ndb.StringProperty(indexed=False)
+  # When the feed should be updated next, see ScheduleNextUpdate.
+  next_update = ndb.DateTimeProperty()
+  # The time between the last update and next_update.
+  update_interval_seconds = ndb.IntegerProperty(
+      default=int(DEFAULT_UPDATE_INTERVAL.total_seconds()), indexed=False)
+  # The number of updates in a row that could not fetch the feed.
+  consecutive_failures = ndb.IntegerProperty(default=0, indexed=False)
 
   def GetUrl(self):
     return self.key.id()
 
+  def ScheduleNextUpdate(self, now, num_new_items, cache_lifetime):
+    elapsed = None
+    if self.last_updated and self.last_updated != datetime.min:
+      elapsed = now - self.last_updated
+    interval = NextUpdateInterval(
+        timedelta(seconds=self.update_interval_seconds), elapsed,
+        num_new_items, cache_lifetime, self.has_active_connections)
+    self.update_interval_seconds = int(interval.total_seconds())
+    self.next_update = now + interval
+    self.consecutive_failures = 0
+
+  @ndb.tasklet
+  def UpdateFailedAsync(self, now):
+    """Retries a feed that could not be updated with exponential backoff."""
+    self.consecutive_failures += 1
+    self.next_update = now + min(
+        MIN_UPDATE_INTERVAL * 2**min(self.consecutive_failures, 10),
+        MAX_FAILURE_BACKOFF)
+    yield self.put_async()
+
   def Update(self, canonicalize=None):
     return self.UpdateAsync(
         canonicalize=canonicalize, enable_async=False).get_result()
@@ -72,6 +130,8 @@ class Feed(ndb.Model):
     now = datetime.now()
     if canonicalize is None:
       canonicalize = lambda url: url
+    content_digest = None
+    cache_lifetime = None
     modified_tuple = None
     etag = self.etag
     if self.modified is not None:
@@ -80,11 +140,12 @@ class Feed(ndb.Model):
       # etags when nothing actually changes and modified date stays the same.
       etag = None
     url = self.GetUrl()
+    if url.startswith('feed:http'):
+      url = url[5:]
+    elif url.startswith('feed:'):
+      url = 'http:' + url[5:]
+    not_modified = False
     if enable_async:
-      if url.startswith('feed:http'):
-        url = url[5:]
-      elif url.startswith('feed:'):
-        url = 'http:' + url[5:]
       rpc = urlfetch.create_rpc(deadline=url_util.URL_FETCH_DEADLINE_SECONDS)
       referrer = None
       auth = None
@@ -106,32 +167,45 @@ class Feed(ndb.Model):
         result = (yield urlfetch.make_fetch_call(rpc, url, headers=headers))
       except urlfetch_errors.Error as e:
         logging.warning('Error fetching feed: %s error: %s', url, e)
+        yield self.UpdateFailedAsync(now)
         raise ndb.Return([])
+      if result.status_code >= 400:
+        logging.warning('Error fetching feed: %s status: %d', url,
+                        result.status_code)
+        yield self.UpdateFailedAsync(now)
+        raise ndb.Return([])
+      cache_lifetime = _CacheLifetime(result.headers)
+      not_modified = result.status_code == httplib.NOT_MODIFIED
+      etag, modified = _Validators(result.headers)
+      if etag:
+        self.etag = etag
+      if modified:
+        self.modified = modified
       content = result.content
-      if isinstance(content, unicode):
-        stream = io.BytesIO(content.encode('utf-8'))
-      else:
-        stream = io.BytesIO(content)
-      parsed = feedparser.parse(stream)
     else:
+      # The feed is fetched once and parsed from the fetched bytes. Without
+      # the etag and modified headers the content digest tells whether the
+      # feed changed.
       try:
-        parsed = feedparser.parse(url, etag=etag, modified=modified_tuple)
-      except StandardError as e:
-        logging.warning('Failed to parse feed: %s error: %s', url, e)
-        # Try to read content ourselves and pass it to the parser:
-        try:
-          content, _, _, _ = url_util.GetPageContent(url)
-          parsed = feedparser.parse(content)
-        except url_util.Error as e:
-          logging.warning('Failed to parse feed %s with fallback error: %s',
-                          url, e)
-          raise ndb.Return([])
-    if hasattr(parsed, 'modified_parsed') and parsed.modified_parsed:
-      self.modified = datetime.fromtimestamp(
-          time.mktime(parsed.modified_parsed))
-    if hasattr(parsed, 'etag'):
-      self.etag = parsed.etag
-    new_items = []
+        content, _, _, _ = url_util.GetPageContent(url)
+      except url_util.Error as e:
+        logging.warning('Error fetching feed: %s error: %s', url, e)
+        yield self.UpdateFailedAsync(now)
+        raise ndb.Return([])
+    if isinstance(content, unicode):
+      content = content.encode('utf-8')
+    content_digest = hashlib.sha1(content).hexdigest()
+    if not_modified or content_digest == self.content_digest:
+      # Many feeds ignore the etag and modified headers, so the body is
+      # compared too. Only the schedule is written when the feed did not
+      # change.
+      self.ScheduleNextUpdate(now, 0, cache_lifetime)
+      yield self.put_async()
+      counters.IncrementMulti({UPDATES_COUNTER: 1, UNCHANGED_COUNTER: 1})
+      raise ndb.Return([])
+    parsed = feedparser.parse(io.BytesIO(content))
+    entries = []
+    entry_ids = set()
     for entry in parsed.entries:
       if not hasattr(entry, 'link') or not entry.link:
         continue
@@ -140,47 +214,76 @@ class Feed(ndb.Model):
       else:
         # Some feeds don't specify the id so we use the link as the id.
         entry_id = entry.link
-      entry_date = feed_util.GetEntryDate(
-          entry, min_date=self.last_updated, max_date=now)
-      if not entry_date:
-        entry_date = datetime.now()
-      title = None
-      if hasattr(entry, 'title'):
-        title = entry.title
-      item = FeedItem.query(FeedItem.feed_url == self.GetUrl(),
-                            FeedItem.id == entry_id).get()
-      if item is None:
+      if entry_id not in entry_ids:
+        entry_ids.add(entry_id)
+        entries.append((entry_id, entry))
+    feed_url = self.GetUrl()
+    entry_ids_digest = _EntryIdsDigest(entry_ids)
+    new_items = []
+    if entry_ids_digest != self.entry_ids_digest:
+      existing_entry_ids = yield _GetExistingEntryIdsAsync(feed_url, entry_ids)
+      for entry_id, entry in entries:
+        if entry_id in existing_entry_ids:
+          continue
+        entry_date = feed_util.GetEntryDate(
+            entry, min_date=self.last_updated, max_date=now)
+        if not entry_date:
+          entry_date = datetime.now()
+        title = None
+        if hasattr(entry, 'title'):
+          title = entry.title
         try:
-          canonical_url = canonicalize(entry.link)
           new_item = FeedItem(
+              key=FeedItemKey(feed_url, entry_id),
               id=entry_id,
-              url=canonical_url,
+              url=canonicalize(entry.link),
               title=title,
-              feed_url=self.GetUrl(),
+              feed_url=feed_url,
               retrieved_date=now,
-              published_date=entry_date,
-              item_id=items.UrlToItemId(canonical_url))
+              published_date=entry_date)
           new_items.append(new_item)
-          new_item.put()
         except db.BadValueError as e:
           logging.warning('Error creating a feed item:' + str(e))
-      # We should not be adding more new items than we are able to cleanup.
-      if len(new_items) >= CLEAN_UP_ITEMS_PER_UPDATE:
-        break
+        # We should not be adding more new items than we are able to cleanup.
+        if len(new_items) >= CLEAN_UP_ITEMS_PER_UPDATE:
+          # The rest of the entries are added by the next update.
+          entry_ids_digest = None
+          content_digest = None
+          break
+    if new_items:
+      url_to_item_id = items.UrlsToItemIdsCreatingMissing(
+          [new_item.url for new_item in new_items])
+      for new_item in new_items:
+        new_item.item_id = url_to_item_id[new_item.url]
+      # Items published earlier get lower numbers.
+      new_items.sort(key=lambda i: i.published_date)
+      first = rating_sequence.Allocate(
+          rating_sequence.FeedSequenceKey(feed_url), len(new_items))
+      for index, new_item in enumerate(new_items):
+        new_item.sequence_number = first + index
+      yield ndb.put_multi_async(new_items)
     self.item_count += len(new_items)
+    self.ScheduleNextUpdate(now, len(new_items), cache_lifetime)
     self.last_updated = now
+    self.entry_ids_digest = entry_ids_digest
+    self.content_digest = content_digest
     self.put()
-    # Remove the old items.
-    if MAX_ITEMS_PER_FEED > 0:
-      ndb.delete_multi(
-          FeedItem.query(FeedItem.feed_url == self.GetUrl()).order(
-              -FeedItem.published_date).iter(
-                  keys_only=True,
-                  limit=CLEAN_UP_ITEMS_PER_UPDATE,
-                  offset=MAX_ITEMS_PER_FEED))
-    feed_url = self.GetUrl()
-    for time_period_in_days in CACHE_TIME_PERIODS_IN_DAYS:
-      _UpdateCachedItemIds(feed_url, time_period_in_days).get_result()
+    counters.IncrementMulti({
+        UPDATES_COUNTER: 1,
+        UNCHANGED_ENTRIES_COUNTER: 0 if new_items else 1
+    })
+    if new_items:
+      # Remove the old items.
+      if MAX_ITEMS_PER_FEED > 0:
+        ndb.delete_multi(
+            FeedItem.query(FeedItem.feed_url == feed_url).order(
+                -FeedItem.published_date).iter(
+                    keys_only=True,
+                    limit=CLEAN_UP_ITEMS_PER_UPDATE,
+                    offset=MAX_ITEMS_PER_FEED))
+      # The cached items of a feed only change when items are added. Readers
+      # filter out the items that became too old.
+      yield _AddCachedItemIds(feed_url, new_items)
     raise ndb.Return(new_items)
 
 
@@ -188,6 +291,8 @@ TIME_BETWEEN_UPDATES = timedelta(minutes=30)
 
 # The time periods that we cache feed items for
 CACHE_TIME_PERIODS_IN_DAYS = [1, 3, 7, 14, 30, 60, 100000]
+# How many of the most recent items are cached for each time period.
+MAX_CACHED_ITEMS_PER_PERIOD = 100
 
 
 def _TimeToMillis(t):
@@ -237,7 +342,7 @@ def GetBulkItemIdsAsync(feed_urls, since_time):
   client = memcache.Client()
   feed_url_to_recent_items = yield client.get_multi_async(
       feed_urls,
-      key_prefix=ITEM_ID_CACHE_PREFIX + str(time_period_in_days) + ':')
+      key_prefix=_ItemIdCachePrefix(time_period_in_days))
   queries = {}
   for feed_url in feed_urls:
     if feed_url in feed_url_to_recent_items:
@@ -248,9 +353,9 @@ def GetBulkItemIdsAsync(feed_urls, since_time):
               and item.retrieved_timestamp_millis > since_time_millis)
       ]
     else:
-      queries[feed_url] = _UpdateCachedItemIds(feed_url, time_period_in_days)
+      queries[feed_url] = _UpdateCachedItemIds(feed_url)
   for feed_url, query in queries.iteritems():
-    items_proto = yield query
+    items_proto = (yield query)[time_period_in_days]
     feed_url_to_recent_items[feed_url] = [
         item for item in items_proto.feed_item
         if (item.published_timestamp_millis > minimum_published_time_millis and
@@ -265,26 +370,149 @@ def GetBulkItemIdsAsync(feed_urls, since_time):
   raise ndb.Return(feed_url_to_recent_items)
 
 
+def _ItemIdCachePrefix(time_period_in_days):
+  return ITEM_ID_CACHE_PREFIX + str(time_period_in_days) + ':'
+
+
+def _ToCachedItem(item):
+  return cache_pb2.FeedItem(
+      item_id=item.item_id,
+      published_timestamp_millis=_TimeToMillis(item.published_date),
+      retrieved_timestamp_millis=_TimeToMillis(item.retrieved_date or
+                                               item.published_date))
+
+
+@ndb.tasklet
+def _SetCachedItemIds(feed_url, cached_items, now):
+  """Caches the items of every time period with one memcache call.
+
+  The items of a time period are the most recent ones of the longest period
+  that are not older than the period, so they are all built from the items of
+  the longest period.
+
+  Args:
+    feed_url: The url of the feed.
+    cached_items: The cache_pb2.FeedItem of the longest time period, the most
+      recently published first.
+    now: The time that the periods end at.
+
+  Returns:
+    A dict with the cache_pb2.FeedItems of every time period.
+  """
+  period_to_items = {}
+  mapping = {}
+  for time_period_in_days in CACHE_TIME_PERIODS_IN_DAYS:
+    oldest_millis = _TimeToMillis(
+        _OldestCachedDate(now, time_period_in_days))
+    items_proto = cache_pb2.FeedItems()
+    items_proto.feed_item.extend([
+        item for item in cached_items
+        if item.published_timestamp_millis >= oldest_millis
+    ][:MAX_CACHED_ITEMS_PER_PERIOD])
+    period_to_items[time_period_in_days] = items_proto
+    mapping[_ItemIdCachePrefix(time_period_in_days) +
+            feed_url] = items_proto.SerializeToString()
+  yield memcache.Client().set_multi_async(mapping)
+  raise ndb.Return(period_to_items)
+
+
+def _OldestCachedDate(now, time_period_in_days):
+  return now - timedelta(days=time_period_in_days) - TIME_BETWEEN_UPDATES
+
+
 @ndb.tasklet
-def _UpdateCachedItemIds(feed_url, time_period_in_days):
-  oldest_date = (
-      datetime.now() - timedelta(days=time_period_in_days) -
-      TIME_BETWEEN_UPDATES)
+def _UpdateCachedItemIds(feed_url):
+  """Caches the items of a feed for all time periods with one query."""
+  now = datetime.now()
   feed_items = yield FeedItem.query(
       FeedItem.feed_url == feed_url, FeedItem.published_date >=
-      oldest_date).order(-FeedItem.published_date).fetch_async(
-          100, projection=['item_id', 'published_date', 'retrieved_date'])
-  items_proto = cache_pb2.FeedItems()
-  for i in feed_items:
-    item_proto = items_proto.feed_item.add()
-    item_proto.item_id = i.item_id
-    item_proto.published_timestamp_millis = _TimeToMillis(i.published_date)
-    item_proto.retrieved_timestamp_millis = _TimeToMillis(i.retrieved_date or
-                                                          i.published_date)
-  client = memcache.Client()
-  client.set(ITEM_ID_CACHE_PREFIX + str(time_period_in_days) + ':' + feed_url,
-             items_proto.SerializeToString())
-  raise ndb.Return(items_proto)
+      _OldestCachedDate(now, max(CACHE_TIME_PERIODS_IN_DAYS))).order(
+          -FeedItem.published_date).fetch_async(
+              MAX_CACHED_ITEMS_PER_PERIOD,
+              projection=['item_id', 'published_date', 'retrieved_date'])
+  period_to_items = yield _SetCachedItemIds(
+      feed_url, [_ToCachedItem(i) for i in feed_items], now)
+  raise ndb.Return(period_to_items)
+
+
+@ndb.tasklet
+def _AddCachedItemIds(feed_url, new_items):
+  """Adds new items to the cached items of a feed without a query.
+
+  The cache is built with a query when the longest period is not cached.
+  """
+  cached = yield memcache.Client().get_multi_async(
+      [feed_url],
+      key_prefix=_ItemIdCachePrefix(max(CACHE_TIME_PERIODS_IN_DAYS)))
+  if feed_url not in cached:
+    period_to_items = yield _UpdateCachedItemIds(feed_url)
+    raise ndb.Return(period_to_items)
+  cached_items = list(
+      cache_pb2.FeedItems.FromString(cached[feed_url]).feed_item)
+  seen = set((item.item_id, item.published_timestamp_millis)
+             for item in cached_items)
+  for new_item in new_items:
+    cached_item = _ToCachedItem(new_item)
+    if (cached_item.item_id,
+        cached_item.published_timestamp_millis) not in seen:
+      cached_items.append(cached_item)
+  cached_items.sort(key=lambda i: i.published_timestamp_millis, reverse=True)
+  period_to_items = yield _SetCachedItemIds(feed_url, cached_items,
+                                            datetime.now())
+  raise ndb.Return(period_to_items)
+
+
+def _CacheLifetime(headers):
+  """Returns how long the server asks to cache the feed for or None."""
+  match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+  if match:
+    return timedelta(seconds=int(match.group(1)))
+  expires = email.utils.parsedate_tz(headers.get('Expires', ''))
+  if expires:
+    return datetime.utcfromtimestamp(
+        email.utils.mktime_tz(expires)) - datetime.utcnow()
+  return None
+
+
+def _Validators(headers):
+  """Returns the ETag and the Last-Modified date of a response or None."""
+  modified = None
+  last_modified = email.utils.parsedate_tz(headers.get('Last-Modified', ''))
+  if last_modified:
+    modified = datetime.utcfromtimestamp(email.utils.mktime_tz(last_modified))
+  return headers.get('ETag'), modified
+
+
+def NextUpdateInterval(interval, elapsed, num_new_items, cache_lifetime,
+                       has_active_connections):
+  """Returns the time until the next update of a feed.
+
+  The interval moves towards the time it takes the feed to publish one item
+  and grows while the feed publishes nothing. It is never shorter than the
+  time the server asks to cache the feed for.
+
+  Args:
+    interval: The interval before the last update.
+    elapsed: The time between the previous update and the last one, None if
+      the last update was the first one.
+    num_new_items: The number of new items of the last update.
+    cache_lifetime: How long the server asks to cache the feed for or None.
+    has_active_connections: Whether any user is connected to the feed.
+
+  Returns:
+    A timedelta.
+  """
+  if num_new_items:
+    if elapsed is not None:
+      interval = (interval + elapsed // num_new_items) // 2
+  else:
+    interval = interval * 3 // 2
+  if cache_lifetime is not None:
+    interval = max(interval, cache_lifetime)
+  if has_active_connections:
+    return min(max(interval, MIN_UPDATE_INTERVAL), MAX_UPDATE_INTERVAL)
+  return min(
+      max(interval, MIN_INACTIVE_UPDATE_INTERVAL), MAX_INACTIVE_UPDATE_INTERVAL)
 
 
 def GetFeed(url):
@@ -295,7 +523,11 @@ def AddFeed(url, title):
   key = ndb.Key(Feed, url)
   feed = key.get()
   if feed is None:
-    feed = Feed(key=key, title=title, last_updated=datetime.min)
+    feed = Feed(
+        key=key,
+        title=title,
+        last_updated=datetime.min,
+        next_update=datetime.min)
     feed.put()
   return feed
 
@@ -308,3 +540,83 @@ class FeedItem(ndb.Model):
   published_date = ndb.DateTimeProperty()
   retrieved_date = ndb.DateTimeProperty()
   item_id = ndb.IntegerProperty()
+  # The position of this item in the rating_sequence of its feed.
+  sequence_number = ndb.IntegerProperty(indexed=False)
+
+
+def FeedItemKey(feed_url, entry_id):
+  """The key of the item of a feed entry."""
+  return ndb.Key(FeedItem, _Digest([feed_url, entry_id]))
+
+
+def _Digest(strings):
+  digest = hashlib.sha1()
+  for string in strings:
+    if isinstance(string, unicode):
+      string = string.encode('utf-8')
+    digest.update(string)
+    digest.update('\0')
+  return digest.hexdigest()
+
+
+def _EntryIdsDigest(entry_ids):
+  return _Digest(sorted(entry_ids))
+
+
+@ndb.tasklet
+def _GetExistingEntryIdsAsync(feed_url, entry_ids):
+  """Returns the entry ids that already have an item."""
+  entry_ids = list(entry_ids)
+  existing_items = yield ndb.get_multi_async(
+      [FeedItemKey(feed_url, entry_id) for entry_id in entry_ids])
+  existing = set(
+      entry_id for entry_id, item in zip(entry_ids, existing_items) if item)
+  missing = [entry_id for entry_id in entry_ids if entry_id not in existing]
+  # Items that were added before FeedItemKey existed have other keys. They are
+  # found with a query until the migration has run.
+  if missing and not (yield migrations.IsFinishedAsync(
+      migrations.FEED_ITEM_KEYS)):
+    queries = [
+        FeedItem.query(
+            FeedItem.feed_url == feed_url,
+            FeedItem.id.IN(
+                missing[i:i + items.MAX_IN_FILTER_VALUES])).fetch_async()
+        for i in range(0, len(missing), items.MAX_IN_FILTER_VALUES)
+    ]
+    for found in (yield queries):
+      existing.update(item.id for item in found)
+  raise ndb.Return(existing)
+
+
+def MigrateItemKeys(feed):
+  """Moves the items of a feed that have old keys to FeedItemKey keys."""
+  old_items = [
+      item for item in FeedItem.query(FeedItem.feed_url == feed.GetUrl())
+      if item.id and item.key != FeedItemKey(item.feed_url, item.id)
+  ]
+  if not old_items:
+    return
+  new_keys = [FeedItemKey(item.feed_url, item.id) for item in old_items]
+  new_items = {}
+  # Keeps the oldest item when an entry was added more than once.
+  for item, key, existing in sorted(
+      zip(old_items, new_keys, ndb.get_multi(new_keys)),
+      key=lambda t: t[0].published_date,
+      reverse=True):
+    if existing is None:
+      new_items[key] = FeedItem(key=key, **item.to_dict())
+  ndb.put_multi(new_items.values())
+  ndb.delete_multi([item.key for item in old_items])
+
+
+def BackfillSequenceNumbers(feed):
+  """Numbers the items of a feed that were added without a number.
+
+  Returns:
+    The items that were numbered.
+  """
+  numbered = rating_sequence.BackfillNumbers(
+      FeedItem.query(FeedItem.feed_url == feed.GetUrl()).fetch(),
+      lambda i: i.published_date)
+  ndb.put_multi(numbered)
+  return numbered
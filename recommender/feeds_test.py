@@ -0,0 +1,220 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime
+from datetime import timedelta
+import unittest
+
+from recommender import counters
+from recommender import feeds
+from recommender import items
+from recommender import migrations
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+FEED_URL = 'http://feed'
+
+
+class FeedItemKeyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    migrations.ClearInstanceCache()
+    self.start = datetime(2020, 1, 2)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def AddOldItem(self, entry_id, minutes):
+    return feeds.FeedItem(
+        id=entry_id,
+        url='http://' + entry_id,
+        feed_url=FEED_URL,
+        published_date=self.start + timedelta(minutes=minutes),
+        item_id=minutes).put()
+
+  def testExistingEntryIds(self):
+    feeds.FeedItem(
+        key=feeds.FeedItemKey(FEED_URL, 'a'), id='a', feed_url=FEED_URL).put()
+    self.AddOldItem('b', 1)
+
+    self.assertEqual(
+        set(['a', 'b']),
+        feeds._GetExistingEntryIdsAsync(FEED_URL,
+                                        ['a', 'b', 'c']).get_result())
+
+  def testMigrateItemKeys(self):
+    self.AddOldItem('a', 1)
+    self.AddOldItem('a', 2)
+    self.AddOldItem('b', 3)
+
+    feeds.MigrateItemKeys(feeds.AddFeed(FEED_URL, 'Feed'))
+
+    feed_items = feeds.FeedItem.query().fetch()
+    self.assertEqual(
+        sorted([feeds.FeedItemKey(FEED_URL, 'a'),
+                feeds.FeedItemKey(FEED_URL, 'b')]),
+        sorted(item.key for item in feed_items))
+    self.assertEqual(1, feeds.FeedItemKey(FEED_URL, 'a').get().item_id)
+    migrations.SetFinished(migrations.FEED_ITEM_KEYS)
+    self.assertEqual(
+        set(['a', 'b']),
+        feeds._GetExistingEntryIdsAsync(FEED_URL, ['a', 'b']).get_result())
+
+
+  def testCachedItemIds(self):
+    now = datetime.now()
+
+    def Add(item_id, days_ago):
+      return feeds.FeedItem(
+          feed_url=FEED_URL,
+          item_id=item_id,
+          published_date=now - timedelta(days=days_ago),
+          retrieved_date=now - timedelta(days=days_ago))
+
+    ndb.put_multi([Add(1, 0.5), Add(2, 5), Add(3, 100)])
+    feeds._UpdateCachedItemIds(FEED_URL).get_result()
+    new_item = Add(4, 2)
+    new_item.put()
+
+    merged = feeds._AddCachedItemIds(FEED_URL, [new_item]).get_result()
+    self.assertEqual(
+        feeds._UpdateCachedItemIds(FEED_URL).get_result(), merged)
+    self.assertEqual([1], [i.item_id for i in merged[1].feed_item])
+    self.assertEqual([1, 4], [i.item_id for i in merged[3].feed_item])
+    self.assertEqual([1, 4, 2, 3],
+                     [i.item_id for i in merged[100000].feed_item])
+
+
+
+class NextUpdateIntervalTest(unittest.TestCase):
+
+  def testInterval(self):
+    hour = timedelta(hours=1)
+    # Moves towards the time between items.
+    self.assertEqual(
+        timedelta(hours=1.5),
+        feeds.NextUpdateInterval(2 * hour, 4 * hour, 4, None, True))
+    # Backs off when there is nothing new.
+    self.assertEqual(3 * hour,
+                     feeds.NextUpdateInterval(2 * hour, 2 * hour, 0, None,
+                                              True))
+    self.assertEqual(feeds.MAX_UPDATE_INTERVAL,
+                     feeds.NextUpdateInterval(20 * hour, hour, 0, None, True))
+    self.assertEqual(feeds.MIN_UPDATE_INTERVAL,
+                     feeds.NextUpdateInterval(hour, hour, 100, None, True))
+    # The first update has no elapsed time.
+    self.assertEqual(2 * hour,
+                     feeds.NextUpdateInterval(2 * hour, None, 20, None, True))
+    # The server's cache lifetime is respected.
+    self.assertEqual(5 * hour,
+                     feeds.NextUpdateInterval(hour, hour, 1, 5 * hour, True))
+    self.assertEqual(feeds.MIN_INACTIVE_UPDATE_INTERVAL,
+                     feeds.NextUpdateInterval(hour, hour, 1, None, False))
+
+
+class ValidatorsTest(unittest.TestCase):
+
+  def testValidators(self):
+    self.assertEqual(
+        ('"abc"', datetime(2020, 1, 2, 3, 4, 5)),
+        feeds._Validators({
+            'ETag': '"abc"',
+            'Last-Modified': 'Thu, 02 Jan 2020 03:04:05 GMT'
+        }))
+    self.assertEqual((None, None), feeds._Validators({}))
+
+
+RSS = ('<?xml version="1.0"?><rss version="2.0"><channel><title>%s</title>'
+       '%s</channel></rss>')
+RSS_ITEM = '<item><link>http://%s</link><guid>%s</guid></item>'
+
+
+class _Response(object):
+
+  def __init__(self, status_code, content):
+    self.status_code = status_code
+    self.content = content
+    self.headers = {}
+
+
+class UpdateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_urlfetch_stub()
+    migrations.ClearInstanceCache()
+    items.ClearInstanceCaches()
+    self.make_fetch_call = urlfetch.make_fetch_call
+    urlfetch.make_fetch_call = self.MakeFetchCall
+    self.responses = []
+    self.feed = feeds.AddFeed(FEED_URL, 'Feed')
+
+  def tearDown(self):
+    urlfetch.make_fetch_call = self.make_fetch_call
+    self.testbed.deactivate()
+
+  def MakeFetchCall(self, rpc, url, headers=None):
+    future = ndb.Future()
+    future.set_result(self.responses.pop(0))
+    return future
+
+  def Update(self, status_code, entry_ids, title='Feed'):
+    self.responses.append(
+        _Response(status_code,
+                  RSS % (title, ''.join(RSS_ITEM % (i, i) for i in entry_ids))))
+    return [item.id for item in self.feed.UpdateAsync().get_result()]
+
+  def Counters(self):
+    values = counters.GetAll()
+    return [
+        values[feeds.UPDATES_COUNTER], values[feeds.UNCHANGED_COUNTER],
+        values[feeds.UNCHANGED_ENTRIES_COUNTER]
+    ]
+
+  def testUnchangedBody(self):
+    self.assertEqual(['a'], self.Update(200, ['a']))
+    last_updated = self.feed.last_updated
+
+    self.assertEqual([], self.Update(200, ['a']))
+    # Only the schedule of the feed is written.
+    feed = ndb.Key(feeds.Feed, FEED_URL).get()
+    self.assertEqual(last_updated, feed.last_updated)
+    self.assertGreater(feed.next_update, last_updated)
+    self.assertEqual([2, 1, 0], self.Counters())
+
+  def testNotModified(self):
+    self.assertEqual(['a'], self.Update(200, ['a']))
+    # The body of a 304 response is not parsed.
+    self.assertEqual([], self.Update(304, ['b']))
+    self.assertEqual([2, 1, 0], self.Counters())
+    self.assertEqual(1, feeds.FeedItem.query().count())
+
+  def testChangedBody(self):
+    self.assertEqual(['a'], self.Update(200, ['a']))
+    # The body changed but the entries did not.
+    self.assertEqual([], self.Update(200, ['a'], title='New title'))
+    self.assertEqual(['b'], self.Update(200, ['a', 'b']))
+    self.assertEqual([3, 0, 1], self.Counters())
+
+
+if __name__ == '__main__':
+  unittest.main()
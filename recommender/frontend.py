@@ -26,9 +26,11 @@ from google.appengine.api import users
 from google.appengine.ext import ndb
 
 from recommender import config
+from recommender import counters
 from recommender import delete_account
 from recommender import export
 from recommender import item_recommendation
+from recommender import items
 from recommender import json_encoder
 from recommender import models
 from recommender import pipelines
@@ -144,7 +146,7 @@ class RateHandler(RestHandler):
 class DeleteRatingHandler(RestHandler):
 
   def Handle(self, data):
-    models.DeleteRating(users.get_current_user(), data['url'])
+    recommendations.DeleteRating(users.get_current_user(), data['url'])
     self.response.headers['Content-Type'] = 'text/plain'
     self.response.out.write('Success')
 
@@ -243,24 +245,30 @@ class RecommendationsHandler(RestHandler):
     decay_rate = data.get('decay_rate', 1)
     source_type = data.get('source_type', item_recommendation.SOURCE_TYPE_ANY)
     exclude_urls = set(data.get('exclude_urls', []))
+    continuation_token = data.get('continuation_token')
     user = users.get_current_user()
 
-    result = item_recommendation.RecommendationsOnDemand(
-        user,
-        time_period,
-        category_id,
-        any_category,
-        include_popular,
-        limit,
-        models.LOGISTIC_REGRESSION_CONNECTION,
-        decay_rate=decay_rate,
-        source_type=source_type,
-        exclude_urls=exclude_urls,
-        save_past_recommendations=True,
-        exclude_past_recommendations=True,
-        exclude_past_recommendations_from_all_time_periods=True,
-        diversify=True)
-    self.SendJson(result)
+    result, continuation_token = (
+        item_recommendation.RecommendationsPageOnDemand(
+            user,
+            time_period,
+            category_id,
+            any_category,
+            include_popular,
+            limit,
+            models.LOGISTIC_REGRESSION_CONNECTION,
+            continuation_token=continuation_token,
+            decay_rate=decay_rate,
+            source_type=source_type,
+            exclude_urls=exclude_urls,
+            save_past_recommendations=True,
+            exclude_past_recommendations=True,
+            exclude_past_recommendations_from_all_time_periods=True,
+            diversify=True))
+    self.SendJson({
+        'recommendations': result,
+        'continuation_token': continuation_token
+    })
 
 
 class PastRecommendationsHandler(RestHandler):
@@ -355,6 +363,16 @@ class AdminExecuteActionHandler(RestHandler):
     handler(None)
 
 
+class AdminCountersHandler(RestHandler):
+
+  def Handle(self, data):
+    # The instance cache counters are only those of the instance that serves
+    # this request.
+    values = counters.GetAll()
+    values.update(items.InstanceCacheStats())
+    self.SendJson(values)
+
+
 class DeleteAccountHandler(RestHandler):
 
   def Handle(self, data):
@@ -415,6 +433,7 @@ application = ndb.toplevel(
             # Admin actions.
             ('/rest/admin/actions', AdminActionsHandler),
             ('/rest/admin/executeAction', AdminExecuteActionHandler),
+            ('/rest/admin/counters', AdminCountersHandler),
             ('/download_history', DownloadHistoryHandler),
             ('/', MainPageHandler)
         ],
@@ -0,0 +1,149 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Extracts the metadata in the <head> of an html page.
+
+The page is fed to an incremental parser in chunks and the parsing stops when
+the head ends, so the body is never parsed or kept in memory.
+"""
+
+import lxml.etree
+
+# The page is fed to the parser in chunks of this many bytes.
+CHUNK_SIZE = 16 * 1024
+# The parsing stops after this many bytes even if the head did not end.
+MAX_HEAD_BYTES = 512 * 1024
+
+# The children of <head> that hold each field, in order of preference. Each is
+# a tuple of the tag, the attribute and value that select the element and the
+# attribute that holds the field, None for the text of the element.
+_TITLE_ELEMENTS = [
+    ('meta', 'property', 'og:title', 'content'),
+    ('meta', 'name', 'twitter:title', 'content'),
+    ('title', None, None, None),
+]
+_CANONICAL_URL_ELEMENTS = [
+    ('link', 'rel', 'canonical', 'href'),
+    ('meta', 'property', 'og:url', 'content'),
+]
+_DESCRIPTION_ELEMENTS = [
+    ('meta', 'property', 'og:description', 'content'),
+    ('meta', 'name', 'description', 'content'),
+    ('meta', 'name', 'twitter:description', 'content'),
+]
+_FEED_ELEMENTS = [
+    ('link', 'type', 'application/rss+xml', 'href'),
+    ('link', 'type', 'application/atom+xml', 'href'),
+]
+_ALL_ELEMENTS = (
+    _TITLE_ELEMENTS + _CANONICAL_URL_ELEMENTS + _DESCRIPTION_ELEMENTS +
+    _FEED_ELEMENTS)
+
+
+class HeadMetadata(object):
+  """The fields of a page head, None when the page does not have them.
+
+  The urls are not resolved against the url of the page.
+  """
+
+  def __init__(self):
+    self.title = None
+    self.canonical_url = None
+    self.description = None
+    self.feed_url = None
+    self.feed_title = None
+
+
+def Parse(content, encoding=None):
+  """Returns the HeadMetadata of an html page.
+
+  Args:
+    content: The bytes of the page.
+    encoding: The charset of the page or None to detect it.
+
+  Raises:
+    lxml.etree.LxmlError: When the page cannot be parsed.
+  """
+  parser = lxml.etree.HTMLPullParser(events=('start', 'end'), encoding=encoding)
+  # The first element of each of _ALL_ELEMENTS.
+  found = {}
+  head_ended = False
+  for chunk in Chunks(content[:MAX_HEAD_BYTES], CHUNK_SIZE):
+    parser.feed(chunk)
+    if _FindElements(parser.read_events(), found):
+      head_ended = True
+      break
+  if not head_ended:
+    parser.close()
+    _FindElements(parser.read_events(), found)
+
+  result = HeadMetadata()
+  result.title = _FirstValue(found, _TITLE_ELEMENTS)
+  result.canonical_url = _FirstValue(found, _CANONICAL_URL_ELEMENTS)
+  result.description = _FirstValue(found, _DESCRIPTION_ELEMENTS)
+  for selector in _FEED_ELEMENTS:
+    element = found.get(selector)
+    if element is not None and element.get('href') is not None:
+      result.feed_url = element.get('href')
+      result.feed_title = element.get('title')
+      break
+  return result
+
+
+def Chunks(content, chunk_size):
+  """Splits a page into chunks of at most chunk_size bytes for a pull parser.
+
+  A chunk ends before a '<' when it has one, because libxml2 ends a script at
+  the wrong place when the end tag of the script is split between two chunks.
+  """
+  offset = 0
+  while offset < len(content):
+    end = offset + chunk_size
+    if end < len(content):
+      tag_start = content.rfind('<', offset + 1, end)
+      if tag_start != -1:
+        end = tag_start
+    yield content[offset:end]
+    offset = end
+
+
+def _FindElements(events, found):
+  """Adds the elements of events to found, returns True when the head ended."""
+  for action, element in events:
+    if action == 'end':
+      if element.tag == 'head':
+        return True
+      continue
+    if element.tag == 'body':
+      return True
+    parent = element.getparent()
+    if parent is None or parent.tag != 'head':
+      continue
+    for selector in _ALL_ELEMENTS:
+      tag, attribute, value, _ = selector
+      if (selector not in found and element.tag == tag and
+          (attribute is None or element.get(attribute) == value)):
+        found[selector] = element
+  return False
+
+
+def _FirstValue(found, selectors):
+  for selector in selectors:
+    element = found.get(selector)
+    if element is None:
+      continue
+    attribute = selector[3]
+    value = element.get(attribute) if attribute else element.text
+    if value:
+      return value
+  return None
@@ -0,0 +1,70 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from recommender import html_head
+
+
+class HtmlHeadTest(unittest.TestCase):
+
+  def testFields(self):
+    head = html_head.Parse(
+        '<html><head><title>Title</title>'
+        '<meta property="og:title" content="">'
+        '<meta name="twitter:description" content="Twitter">'
+        '<meta name="description" content="Description">'
+        '<meta property="og:url" content="/og">'
+        '<link rel="canonical" href="/canonical">'
+        '<link type="application/rss+xml">'
+        '<link type="application/atom+xml" href="/atom" title="Atom">'
+        '</head><body><p>Text</p></body></html>')
+
+    # The empty og:title is skipped.
+    self.assertEqual('Title', head.title)
+    self.assertEqual('/canonical', head.canonical_url)
+    self.assertEqual('Description', head.description)
+    # The rss link without href is skipped.
+    self.assertEqual('/atom', head.feed_url)
+    self.assertEqual('Atom', head.feed_title)
+
+  def testOnlyChildrenOfHead(self):
+    head = html_head.Parse('<html><head></head><body><title>Body</title>'
+                           '<link rel="canonical" href="/c"></body></html>')
+
+    self.assertIsNone(head.title)
+    self.assertIsNone(head.canonical_url)
+
+  def testStopsAfterHead(self):
+    body = '<p>' + 'text ' * 100000 + '</p>'
+    content = ('<html><head><title>Title</title></head><body>' + body +
+               '<meta name="description" content="late"></body></html>')
+
+    head = html_head.Parse(content)
+    self.assertEqual('Title', head.title)
+    self.assertIsNone(head.description)
+
+  def testWithoutHeadEnd(self):
+    self.assertEqual('Title', html_head.Parse('<title>Title</title>').title)
+
+  def testChunks(self):
+    content = '<p>text</p><script>x</script>tail'
+    chunks = list(html_head.Chunks(content, 9))
+    self.assertEqual(content, ''.join(chunks))
+    self.assertEqual(['<p>text', '</p>', '<script>x', '</script>', 'tail'],
+                     chunks)
+    self.assertEqual(['0123', '4'], list(html_head.Chunks('01234', 4)))
+
+
+if __name__ == '__main__':
+  unittest.main()
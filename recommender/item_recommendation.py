@@ -17,11 +17,19 @@ from __future__ import division
 
 from datetime import datetime
 from datetime import timedelta
+import heapq
+import itertools
+import time
 
+from recommender import candidate_index
+from recommender import continuations
+from recommender import diversification
 from recommender import feeds
+from recommender import item_scoring
 from recommender import items
 from recommender import models
 from recommender import past_recommendations
+from recommender import recommendation_cache
 from recommender import time_periods
 from recommender import url_util
 
@@ -90,6 +98,106 @@ def RecommendationsOnDemand(
   Returns:
     A list of recommendations.
   """
+  ranked = _RankRecommendations(
+      user, time_period, category_id, any_category, include_popular,
+      connection_version, decay_rate, source_type, exclude_urls,
+      exclude_past_recommendations,
+      exclude_past_recommendations_from_all_time_periods, external_connections,
+      exclude_rated_items, diversify)
+  return _FinishPage(user, time_period, list(itertools.islice(ranked, limit)),
+                     save_past_recommendations)
+
+
+def RecommendationsPageOnDemand(
+    user,
+    time_period,
+    category_id,
+    any_category,
+    include_popular,
+    limit,
+    connection_version,
+    continuation_token=None,
+    decay_rate=1,
+    source_type=SOURCE_TYPE_ANY,
+    exclude_urls=frozenset(),
+    save_past_recommendations=False,
+    exclude_past_recommendations=False,
+    exclude_past_recommendations_from_all_time_periods=False,
+    diversify=False):
+  """Returns a page of recommendations and a token for the next page.
+
+  The first page is calculated like in RecommendationsOnDemand and the rest of
+  the ranking is kept in the continuations module, so the next pages only read
+  limit more recommendations from it. When the token has expired the ranking is
+  calculated again, without the recommendations in exclude_urls.
+
+  Args:
+    continuation_token: The token returned with the previous page or None for
+      the first page.
+    See RecommendationsOnDemand for the other arguments.
+
+  Returns:
+    A (recommendations, continuation_token) pair. The token is None when there
+    are no more recommendations.
+  """
+  subscriber_id = models.UserKey(user).id()
+  request_key = (time_period, category_id, any_category, include_popular,
+                 connection_version, decay_rate, source_type,
+                 save_past_recommendations, exclude_past_recommendations,
+                 exclude_past_recommendations_from_all_time_periods, diversify)
+
+  def Rank(exclude_urls):
+    return _RankRecommendations(
+        user, time_period, category_id, any_category, include_popular,
+        connection_version, decay_rate, source_type, exclude_urls,
+        exclude_past_recommendations,
+        exclude_past_recommendations_from_all_time_periods, None, True,
+        diversify)
+
+  ranked = None
+  if continuation_token:
+    ranked = continuations.Pop(subscriber_id, request_key, continuation_token)
+  if ranked is not None:
+    page = list(itertools.islice(ranked, limit))
+    has_more = len(page) == limit
+  else:
+    # Popular recommendations depend on the ratings of all users, not only on
+    # the state of this user, so they are not cached.
+    use_cache = not include_popular and not exclude_urls
+    cached = None
+    if use_cache:
+      generation = recommendation_cache.GetGeneration(subscriber_id)
+      cached = recommendation_cache.Get(subscriber_id, request_key, generation,
+                                        limit)
+    if cached is not None:
+      page, has_more = cached
+      ranked = _RankAfter(page, Rank)
+    else:
+      start = time.time()
+      ranked = Rank(exclude_urls)
+      page = list(itertools.islice(ranked, limit))
+      has_more = len(page) == limit
+      if use_cache:
+        _AddDestinationUrls(page)
+        recommendation_cache.Set(subscriber_id, request_key, generation, page,
+                                 not has_more, (time.time() - start) * 1000)
+  next_continuation_token = None
+  if has_more:
+    next_continuation_token = continuations.Save(subscriber_id, request_key,
+                                                 ranked)
+  return (_FinishPage(user, time_period, page, save_past_recommendations),
+          next_continuation_token)
+
+
+def _RankRecommendations(user, time_period, category_id, any_category,
+                         include_popular, connection_version, decay_rate,
+                         source_type, exclude_urls, exclude_past_recommendations,
+                         exclude_past_recommendations_from_all_time_periods,
+                         external_connections, exclude_rated_items, diversify):
+  """Scores the candidates and returns an iterator over the ranking.
+
+  The recommendations are yielded with all fields but destination_url.
+  """
   exclude_item_ids = set(items.UrlsToItemIds(exclude_urls).values())
   subscriber_id = models.UserKey(user).id()
   now = datetime.now()
@@ -144,11 +252,33 @@ def RecommendationsOnDemand(
 
   connections_future = GetConnections()
 
-  query = models.PageRating.query(
-      projection=['item_id', 'user_id', 'rating', 'category', 'date'])
-  if since_time != datetime.min:
-    query = query.filter(models.PageRating.date > since_time)
-  user_ratings = query.order(-models.PageRating.date).fetch(1000)
+  # The candidate index has only the ratings of the connected users so we
+  # cannot use it for the popular items.
+  use_candidate_index = (
+      not include_popular and not external_connections and
+      connection_version == models.LOGISTIC_REGRESSION_CONNECTION)
+  if use_candidate_index:
+    candidate_index_future = candidate_index.GetIndexAsync(subscriber_id)
+
+  connections = connections_future.get_result()
+  if external_connections:
+    connections = [
+        c for c in external_connections
+        if c.publisher_type == models.SOURCE_TYPE_USER
+    ]
+
+  user_ratings = None
+  if use_candidate_index:
+    index = candidate_index_future.get_result()
+    connected_sources = set(
+        (c.publisher_id, c.PublisherCategoryId()) for c in connections)
+    if index is not None and index.Covers(connected_sources, since_time):
+      user_ratings = index.GetRatings(since_time)
+    else:
+      candidate_index.RequestRebuild(
+          subscriber_id, index_exists=index is not None)
+  if user_ratings is None:
+    user_ratings = _GetRecentRatings(since_time)
 
   if past_recommendation_item_ids_future:
     past_recommendation_item_ids = (
@@ -162,26 +292,15 @@ def RecommendationsOnDemand(
       continue
     if r.item_id in exclude_item_ids:
       continue
-    if r.key.parent().id() == subscriber_id:
+    if r.publisher_id == subscriber_id:
       continue
-    publisher_id = r.key.parent().id()
-    publisher_category_id = models.GetCategoryId(r.category)
-    source = (publisher_id, publisher_category_id)
     if r.rating < 0:
-      negative_sources.add(source)
+      negative_sources.add(r.Source())
     else:
-      positive_sources.add(source)
-    r.rating_source = source
+      positive_sources.add(r.Source())
 
   positive_source_to_connection = {}
   negative_source_to_connection = {}
-  connections = connections_future.get_result()
-  if external_connections:
-    connections = [
-        c for c in external_connections
-        if c.publisher_type == models.SOURCE_TYPE_USER
-    ]
-
   for connection in connections:
     source = (connection.publisher_id, connection.PublisherCategoryId())
     # The user may be subscribed to the same source from multiple collections.
@@ -193,174 +312,145 @@ def RecommendationsOnDemand(
         source not in negative_source_to_connection):
       negative_source_to_connection[source] = connection
 
-  item_id_to_recommendation = {}
   recent_rated_item_ids = set(recent_rated_item_ids_future.get_result())
   nominal_weight = NOMINAL_USER_VOTE_WEIGHT if include_popular else 0
-  num_matched_past_recommendations = 0
-  # Keyed by (user_id, category_id).
-  seen_items_from_user = {}
+  (feed_items, feed_url_to_connection) = feed_info_future.get_result()
+  (scores, table, table_connections,
+   category_id_to_category) = _ScoreCandidates(
+       subscriber_id, user_ratings, positive_source_to_connection,
+       negative_source_to_connection, feed_items, feed_url_to_connection,
+       past_recommendation_item_ids, exclude_item_ids, recent_rated_item_ids,
+       nominal_weight, decay_rate)
+  # Only the candidates that are read from the ranking are turned into
+  # recommendations, so the work from here on is proportional to the number of
+  # recommendations read rather than to the number of candidates.
+  ranked = _RankedRecommendations(scores, table, table_connections,
+                                  category_id_to_category)
+  if diversify:
+    ranked = diversification.Diversify(
+        ranked, lambda pair: pair[1].ConnectionsHash())
+  return _WithSources(ranked, scores, table, table_connections)
+
+
+def _ScoreCandidates(subscriber_id, user_ratings, positive_source_to_connection,
+                     negative_source_to_connection, feed_items,
+                     feed_url_to_connection, past_recommendation_item_ids,
+                     exclude_item_ids, recent_rated_item_ids, nominal_weight,
+                     decay_rate):
+  """Adds the candidate ratings and feed items to a table and scores them.
+
+  Returns:
+    A (scores, table, table_connections, category_id_to_category) tuple, where
+    table_connections are the connection objects by their index in the table.
+  """
+  # The candidates are scored with item_scoring. Every connection that can
+  # contribute is added to the scoring table once.
+  table = item_scoring.ScoringTable()
+  # The connection objects by their index in the table.
+  table_connections = []
+  category_id_to_category = {None: None}
+
+  def AddConnection(connection, weight, category, decay_group,
+                    needs_shared_items=False):
+    category_id = models.GetCategoryId(category)
+    category_id_to_category.setdefault(category_id, category)
+    table_connections.append(connection)
+    return table.AddConnection(weight, category_id, decay_group,
+                               needs_shared_items)
+
+  # The positive and the negative connection to the same source share the
+  # decay.
+  positive_source_to_index = {}
+  for source, connection in positive_source_to_connection.iteritems():
+    positive_source_to_index[source] = AddConnection(
+        connection, connection.weight, connection.subscriber_category,
+        (SOURCE_TYPE_USER,) + source, connection.num_shared_items == 0)
+  negative_source_to_index = {}
+  for source, connection in negative_source_to_connection.iteritems():
+    negative_source_to_index[source] = AddConnection(
+        connection, connection.weight, connection.subscriber_category,
+        (SOURCE_TYPE_USER,) + source, connection.num_shared_items == 0)
+
   for r in user_ratings:
     item_id = r.item_id
     assert item_id
     if r.rating == 0:
       continue
     if r.item_id in past_recommendation_item_ids:
-      num_matched_past_recommendations += 1
       continue
     if r.item_id in exclude_item_ids:
       continue
     if r.item_id in recent_rated_item_ids:
       continue
-    if r.key.parent().id() == subscriber_id:
+    if r.publisher_id == subscriber_id:
       continue
     if r.rating > 0:
-      connection = positive_source_to_connection.get(r.rating_source, None)
-    else:
-      connection = negative_source_to_connection.get(r.rating_source, None)
-    if connection:
-      category_id = connection.SubscriberCategoryId()
-      category = connection.subscriber_category
+      connection_index = positive_source_to_index.get(
+          r.Source(), item_scoring.NO_CONNECTION)
     else:
-      category = None
-      category_id = None
-    key = (r.item_id, category_id)
-    if key in item_id_to_recommendation:
-      (recommendation, top_sources, source_users,
-       feed_connections) = item_id_to_recommendation[key]
-    else:
-      recommendation = models.Recommendation(
-          item_id=r.item_id,
-          source_category=category,
-          first_seen_datetime=r.date)
-      top_sources = {}
-      source_users = {}
-      feed_connections = []
-      item_id_to_recommendation[key] = (recommendation, top_sources,
-                                        source_users, feed_connections)
-    recommendation.first_seen_datetime = min(recommendation.first_seen_datetime,
-                                             r.date)
-    weight = nominal_weight
-    if connection:
-      connection_weight = connection.weight
-      connection_top_sources = connection.top_sources
-      publisher_id = connection.publisher_id
-      if r.rating > 0 and connection_weight > 0:
-        for source in connection_top_sources:
-          if source.url not in top_sources:
-            top_sources[source.url] = models.RecommendationSourcePage(
-                source.url)
-          top_sources[source.url].weight += connection_weight
-          top_sources[source.url].user_count += 1
-        source_users[publisher_id] = connection_weight
-        recommendation.connection_key_components.append(
-            connection.KeyComponents())
-      # Skip positive recommendations if the publisher has no positive
-      # recommendations in common with the subscriber
-      # (ie, num_shared_items == 0).
-      if r.rating > 0 and connection.num_shared_items == 0:
-        pass
-      else:
-        if decay_rate < 1:
-          key = (publisher_id, connection.PublisherCategoryId())
-          seen_items = seen_items_from_user.get(key, 0)
-          seen_items_from_user[key] = seen_items + 1
-          # We are processing user ratings in most-recent first order. The most
-          # recent rated item gets the full weight of the connection, the older
-          # ones get progressively smaller weight.
-          # We apply the decay rate only to the earned connection weight and
-          # leave the nominal weight alone. That way a new user will see purely
-          # popularity based ranking where each rating has the same weight, no
-          # matter who those ratings came from.
-          connection_weight *= decay_rate ** seen_items
-        weight += connection_weight
-    if weight > 0:
-      recommendation.weight += r.rating * weight
-      if r.rating > 0:
-        recommendation.user_count += 1
+      connection_index = negative_source_to_index.get(
+          r.Source(), item_scoring.NO_CONNECTION)
+    table.AddRating(item_id, r.rating, item_scoring.DatetimeToMicros(r.date),
+                    connection_index)
 
-  (feed_items, feed_url_to_connection) = feed_info_future.get_result()
-  seen_items_from_feed = {}
   if decay_rate < 1:
     # We need to sort so that the decay rate is applied from most recent items
     # to less recent items.
     feed_items.sort(key=lambda item: item.published_date, reverse=True)
 
-  num_feed_items_matched_past_recommendations = 0
+  feed_url_to_index = {}
   for item in feed_items:
     item_id = item.item_id
     if item_id in recent_rated_item_ids:
       continue
     if item_id in past_recommendation_item_ids:
-      num_feed_items_matched_past_recommendations += 1
       continue
     connection = feed_url_to_connection.get(item.feed_url, None)
     if not connection:
       continue
-    seen_items = 0
+    if item.feed_url not in feed_url_to_index:
+      feed_url_to_index[item.feed_url] = AddConnection(
+          connection, connection['weight'], connection['category'],
+          (SOURCE_TYPE_FEED, item.feed_url))
     # We need to count urls in the exclude list before we ignore them.
-    if decay_rate < 1:
-      seen_items = seen_items_from_feed.get(item.feed_url, 0)
-      seen_items_from_feed[item.feed_url] = seen_items + 1
-    if item_id in exclude_item_ids:
-      continue
-    category = connection['category']
-    key = (item_id, models.GetCategoryId(category))
-    if key in item_id_to_recommendation:
-      (recommendation, top_sources, source_users,
-       feed_connections) = item_id_to_recommendation[key]
-    else:
-      recommendation = models.Recommendation(
-          item_id=item_id,
-          source_category=category,
-          first_seen_datetime=item.published_date)
-      top_sources = {}
-      source_users = {}
-      feed_connections = []
-      item_id_to_recommendation[key] = (recommendation, top_sources,
-                                        source_users, feed_connections)
-    recommendation.first_seen_datetime = min(recommendation.first_seen_datetime,
-                                             item.published_date)
-    weight = connection['weight']
-    if decay_rate < 1:
-      weight = connection['weight'] * (decay_rate ** seen_items)
-    feed_connections.append(connection)
-    recommendation.weight += weight
-    recommendation.connection_key_components.append(
-        connection['key_components'])
-
-  for _, (recommendation, top_sources, source_users,
-          feed_connections) in item_id_to_recommendation.iteritems():
-    recommendation.source_count = len(top_sources)
-    recommendation.top_sources = sorted(
-        top_sources.values(), key=lambda v: v.weight,
-        reverse=True)[:MAX_TOP_SOURCES]
-    feed_connections = sorted(
-        feed_connections, key=lambda c: c['weight'], reverse=True)
-    unique_feed_urls = set(
-        url_util.DeduplicateUrls([c['publisher_id'] for c in feed_connections]))
-    recommendation.top_feed_urls = _GetTopFeedUrls(feed_connections,
-                                                   unique_feed_urls)
-    recommendation.feed_count = len(unique_feed_urls)
-
-  result = [
-      r for (r, _, _, _) in item_id_to_recommendation.values() if r.weight > 0
-  ]
-  result.sort(key=lambda v: (v.weight, v.first_seen_datetime), reverse=True)
-  seen = set()
-  seen_add = seen.add
-  # Remove duplicate items that may have been recommended under different
-  # categories.
-  result = [r for r in result if not (r.item_id in seen or seen_add(r.item_id))]
-  if diversify:
-    result = _DiversifyByKey(result, limit, lambda r: r.ConnectionsHash())
-  result = result[:limit]
+    table.AddFeedItem(
+        item_id,
+        item_scoring.DatetimeToMicros(item.published_date),
+        feed_url_to_index[item.feed_url],
+        excluded=item_id in exclude_item_ids)
+
+  scores = item_scoring.Score(table, nominal_weight, decay_rate)
+  return scores, table, table_connections, category_id_to_category
+
+
+def _RankAfter(recommendations, rank):
+  """Lazily ranks the recommendations that come after the given ones.
 
+  Args:
+    recommendations: The recommendations that were already returned.
+    rank: Returns the ranking without a set of urls.
+
+  Yields:
+    The recommendations.
+  """
+  for r in rank(set(r.destination_url for r in recommendations)):
+    yield r
+
+
+def _AddDestinationUrls(result):
   # The recommendations only have item_id populated. We need to add
   # destination_url.
-  item_id_to_url = items.ItemIdsToUrls([r.item_id for r in result])
-  for r in result:
+  missing = [r for r in result if r.destination_url is None]
+  item_id_to_url = items.ItemIdsToUrls([r.item_id for r in missing])
+  for r in missing:
     r.destination_url = item_id_to_url.get(r.item_id, '#invalid_item')
 
+
+def _FinishPage(user, time_period, result, save_past_recommendations):
+  """Adds destination urls to a page of recommendations and decorates it."""
+  subscriber_id = models.UserKey(user).id()
+  _AddDestinationUrls(result)
+
   if save_past_recommendations:
     past_recommendations.SavePastRecommendations(subscriber_id, time_period,
                                                  result)
@@ -368,6 +458,82 @@ def RecommendationsOnDemand(
   return models.DecorateRecommendations(subscriber_id, result)
 
 
+def _WithSources(ranked, scores, table, table_connections):
+  for candidate, recommendation in ranked:
+    _AddSources(recommendation, scores.Rows(candidate), table,
+                table_connections)
+    yield recommendation
+
+
+def _RankedRecommendations(scores, table, table_connections,
+                           category_id_to_category):
+  """Yields (candidate, recommendation) pairs from the best to the worst.
+
+  The recommendations only have the fields that are needed for ranking and
+  diversification. _AddSources adds the rest.
+  """
+  seen_item_ids = set()
+  for candidate in scores.Ranked():
+    item_id = int(scores.item_ids[candidate])
+    # Remove duplicate items that may have been recommended under different
+    # categories.
+    if item_id in seen_item_ids:
+      continue
+    seen_item_ids.add(item_id)
+    recommendation = models.Recommendation(
+        item_id=item_id,
+        source_category=category_id_to_category[scores.categories[candidate]],
+        first_seen_datetime=item_scoring.MicrosToDatetime(
+            scores.first_seen[candidate]),
+        weight=float(scores.weights[candidate]),
+        user_count=int(scores.user_counts[candidate]))
+    for row in scores.Rows(candidate):
+      connection_index = table.row_connections[row]
+      if connection_index == item_scoring.NO_CONNECTION:
+        continue
+      connection = table_connections[connection_index]
+      if table.is_feed[row]:
+        recommendation.connection_key_components.append(
+            connection['key_components'])
+      elif table.ratings[row] > 0 and connection.weight > 0:
+        recommendation.connection_key_components.append(
+            connection.KeyComponents())
+    yield candidate, recommendation
+
+
+def _AddSources(recommendation, rows, table, table_connections):
+  """Sets the sources of a recommendation from its rows in the scoring table."""
+  top_sources = {}
+  feed_connections = []
+  for row in rows:
+    connection_index = table.row_connections[row]
+    if connection_index == item_scoring.NO_CONNECTION:
+      continue
+    connection = table_connections[connection_index]
+    if table.is_feed[row]:
+      feed_connections.append(connection)
+      continue
+    connection_weight = connection.weight
+    if table.ratings[row] > 0 and connection_weight > 0:
+      for source in connection.top_sources:
+        if source.url not in top_sources:
+          top_sources[source.url] = models.RecommendationSourcePage(source.url)
+        top_sources[source.url].weight += connection_weight
+        top_sources[source.url].user_count += 1
+
+  recommendation.source_count = len(top_sources)
+  # nlargest returns the same as sorted(..., reverse=True)[:n].
+  recommendation.top_sources = heapq.nlargest(
+      MAX_TOP_SOURCES, top_sources.values(), key=lambda v: v.weight)
+  feed_connections = sorted(
+      feed_connections, key=lambda c: c['weight'], reverse=True)
+  unique_feed_urls = set(
+      url_util.DeduplicateUrls([c['publisher_id'] for c in feed_connections]))
+  recommendation.top_feed_urls = _GetTopFeedUrls(feed_connections,
+                                                 unique_feed_urls)
+  recommendation.feed_count = len(unique_feed_urls)
+
+
 MAX_TOP_FEEDS = 10
 
 
@@ -385,38 +551,6 @@ def _GetTopFeedUrls(feed_connections, unique_feed_urls):
   return urls
 
 
-def _DiversifyByKey(all_items, limit, key):
-  """Returns a subset of all_items such that no two items next to each other have the same key."""
-  if len(all_items) < 2:
-    return all_items
-  if len(all_items) < limit:
-    limit = len(all_items)
-  diverse_items = []
-  previous_key = None
-  added_indexes = set([])
-  for _ in range(0, limit):
-    found_diverse = False
-    first_not_added_index = -1
-    for index, item in enumerate(all_items):
-      if index in added_indexes:
-        continue
-      if first_not_added_index == -1:
-        first_not_added_index = index
-      current_key = key(item)
-      if current_key != previous_key:
-        diverse_items.append(item)
-        added_indexes.add(index)
-        previous_key = current_key
-        found_diverse = True
-        break
-    # If we didn't find a new item, then we add the next not added item with
-    # the same hash.
-    if not found_diverse:
-      diverse_items.append(all_items[first_not_added_index])
-      added_indexes.add(first_not_added_index)
-  return diverse_items
-
-
 @ndb.tasklet
 def _GetRecommendedFeedItems(user, since_time, category_id, any_category,
     connection_version, connection_active_days,
@@ -516,6 +650,18 @@ def _GetRecommendedFeedItems(user, since_time, category_id, any_category,
   raise ndb.Return((feed_items, feed_url_to_connection))
 
 
+def _GetRecentRatings(since_time):
+  """Returns the most recent ratings of all users."""
+  query = models.PageRating.query(
+      projection=['item_id', 'user_id', 'rating', 'category', 'date'])
+  if since_time != datetime.min:
+    query = query.filter(models.PageRating.date > since_time)
+  return [
+      candidate_index.CandidateRatingFromPageRating(r)
+      for r in query.order(-models.PageRating.date).fetch(1000)
+  ]
+
+
 def _GetSinceTime(time_period, now):
   if time_period == time_periods.ALL:
     return datetime.min
@@ -15,16 +15,20 @@
 
 from datetime import datetime
 import os
+import random
 
 from google.appengine.ext import deferred
 from google.appengine.ext import testbed
 
 import unittest
+from recommender import counters
 from recommender import feeds
 from recommender import item_recommendation
+from recommender import item_scoring_benchmark
 from recommender import items
 from recommender import models
 from recommender import ratings
+from recommender import recommendation_cache
 from recommender import recommendations
 from recommender import time_periods
 
@@ -36,6 +40,7 @@ class AbstractRecommendationsTest(object):
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
     self.testbed.init_search_stub()
     self.testbed.init_taskqueue_stub()
     self.testbed.init_urlfetch_stub()
@@ -153,6 +158,68 @@ class AbstractRecommendationsTest(object):
     self.assertEqual('http://b.test', popular[1].url)
     self.assertEqual(1, popular[1].positive_ratings)
 
+  def testRecommendationsPages(self):
+    user1 = FakeUser('1')
+    user2 = FakeUser('2')
+    self._AddRating(user1, 'http://a.test', ratings.POSITIVE)
+    self._AddRating(user2, 'http://a.test', ratings.POSITIVE)
+    self._AddRating(user1, 'http://b.test', ratings.POSITIVE)
+    self._AddRating(user1, 'http://c.test', ratings.POSITIVE)
+    self._AddRating(user1, 'http://d.test', ratings.POSITIVE)
+    expected = [
+        r.destination_url
+        for r in self._GetRecommendations(user2, any_category=True)
+    ]
+    self.assertLen(expected, 3)
+
+    def GetPage(continuation_token, exclude_urls=frozenset()):
+      return item_recommendation.RecommendationsPageOnDemand(
+          user2,
+          time_periods.DAY,
+          None,
+          True,
+          False,
+          2,
+          self.GetConnectionVersion(),
+          continuation_token=continuation_token,
+          exclude_urls=exclude_urls)
+
+    first_page, token = GetPage(None)
+    self.assertEqual(expected[:2], [r.destination_url for r in first_page])
+    self.assertIsNotNone(token)
+    second_page, next_token = GetPage(token)
+    self.assertEqual(expected[2:], [r.destination_url for r in second_page])
+    self.assertIsNone(next_token)
+
+    # A token can only be used once, after that the recommendations are
+    # calculated again without the excluded urls.
+    second_page, _ = GetPage(token, exclude_urls=set(expected[:2]))
+    self.assertEqual(expected[2:], [r.destination_url for r in second_page])
+
+  def testRecommendationsAreCachedUntilRatingsChange(self):
+    user1 = FakeUser('1')
+    user2 = FakeUser('2')
+    self._AddRating(user1, 'http://a.test', ratings.POSITIVE)
+    self._AddRating(user2, 'http://a.test', ratings.POSITIVE)
+    self._AddRating(user1, 'http://b.test', ratings.POSITIVE)
+
+    def GetUrls():
+      result, _ = item_recommendation.RecommendationsPageOnDemand(
+          user2, time_periods.DAY, None, True, False, 20,
+          self.GetConnectionVersion())
+      return [r.destination_url for r in result]
+
+    self.assertEqual(['http://b.test'], GetUrls())
+    self.assertEqual(['http://b.test'], GetUrls())
+    self.assertEqual(1,
+                     counters.GetAll()[recommendation_cache.HITS_COUNTER])
+
+    self._AddRating(user1, 'http://c.test', ratings.POSITIVE)
+    self.assertEqual(['http://c.test', 'http://b.test'], GetUrls())
+
+    self._AddRating(user2, 'http://c.test', ratings.POSITIVE)
+    self.assertEqual(['http://b.test'], GetUrls())
+
   def testPastRecommendations(self):
     user1 = FakeUser('1')
     user2 = FakeUser('2')
@@ -503,3 +570,22 @@ class RecommendationsTest(AbstractRecommendationsTest, unittest.TestCase):
     # uses logistic regression to update connections.
     return models.LOGISTIC_REGRESSION_CONNECTION
 
+
+
+class ScoringTest(unittest.TestCase):
+
+  def testSameScoresAsBaselineLoops(self):
+    rng = random.Random(1)
+    for num_ratings in [1, 10, 1000]:
+      for decay_rate in [1, 0.9]:
+        for nominal_weight in [0, item_recommendation.NOMINAL_USER_VOTE_WEIGHT]:
+          candidates = item_scoring_benchmark.RandomCandidates(
+              rng, num_ratings, num_ratings // 3 + 1, 20)
+          # The weights must be exactly the same, not just close.
+          self.assertEqual(
+              item_scoring_benchmark.BaselineScores(
+                  item_scoring_benchmark.BaselineRecommendations(
+                      candidates, nominal_weight, decay_rate)),
+              item_scoring_benchmark.NewScores(
+                  *item_scoring_benchmark.ScoredRecommendations(
+                      candidates, nominal_weight, decay_rate)))
@@ -0,0 +1,358 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the scoring of item_recommendation with the loops it replaced.
+
+BaselineRecommendations has the two loops of RecommendationsOnDemand before
+item_scoring, copied verbatim from item_recommendation.py. The new path is
+timed from the same inputs and includes adding every rating and feed item to
+the ScoringTable as well as item_scoring.Score and the ranking. The weights,
+user counts and first seen dates of all candidates must be the same, bit for
+bit, and the candidates must come in the same order of weight and first seen
+date.
+
+It needs the App Engine SDK on the path for the model classes.
+
+Usage: python -m recommender.item_scoring_benchmark
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+from datetime import datetime
+from datetime import timedelta
+import random
+import timeit
+
+from recommender import candidate_index
+from recommender import feeds
+from recommender import item_recommendation
+from recommender import item_scoring
+from recommender import models
+
+NUM_RATINGS = [10000, 100000]
+NUM_CONNECTIONS = 100
+REPEATS = 3
+
+SUBSCRIBER_ID = 'subscriber'
+
+
+class Candidates(object):
+  """The inputs of the scoring in RecommendationsOnDemand."""
+
+  def __init__(self):
+    self.user_ratings = []
+    self.positive_source_to_connection = {}
+    self.negative_source_to_connection = {}
+    self.feed_items = []
+    self.feed_url_to_connection = {}
+    self.past_recommendation_item_ids = set()
+    self.exclude_item_ids = set()
+    self.recent_rated_item_ids = set()
+
+
+def RandomCandidates(rng, num_ratings, num_items, num_connections):
+  """Returns random Candidates, the most recent ratings and items first."""
+  candidates = Candidates()
+  categories = [None] + [
+      models.CategoryKey(category_id, SUBSCRIBER_ID) for category_id in (2, 3)
+  ]
+  sources = []
+  for index in range(num_connections // 2):
+    source = ('publisher%d' % index, rng.choice([None, 4]))
+    sources.append(source)
+    for positive, source_to_connection in (
+        (True, candidates.positive_source_to_connection),
+        (False, candidates.negative_source_to_connection)):
+      if rng.random() < 0.2:
+        continue
+      source_to_connection[source] = models.Connection(
+          publisher_type=models.SOURCE_TYPE_USER,
+          publisher_id=source[0],
+          publisher_category=models.CategoryKey(source[1], source[0]),
+          subscriber_id=SUBSCRIBER_ID,
+          subscriber_category=rng.choice(categories),
+          weight=rng.uniform(-1, 1),
+          positive=positive,
+          num_shared_items=rng.choice([0, 1, 2, 3, 4]),
+          version=models.LOGISTIC_REGRESSION_CONNECTION,
+          top_sources=[
+              models.ConnectionSourcePage(url='http://source/%d' % i)
+              for i in range(rng.randint(0, 3))
+          ])
+  feed_urls = ['http://feed/%d' % i for i in range(num_connections // 2)]
+  for feed_url in feed_urls:
+    candidates.feed_url_to_connection[feed_url] = {
+        'weight': rng.uniform(0, 1),
+        'category': rng.choice(categories),
+        'publisher_id': feed_url,
+        'key_components': (feed_url, SUBSCRIBER_ID),
+    }
+  date = datetime(2020, 1, 2)
+  for _ in range(num_ratings):
+    date -= timedelta(microseconds=rng.randint(0, 1000))
+    item_id = rng.randint(1, num_items)
+    if rng.random() < 0.3:
+      candidates.feed_items.append(
+          feeds.FeedItemId(rng.choice(feed_urls), item_id, date))
+    else:
+      publisher_id, publisher_category_id = rng.choice(sources)
+      if rng.random() < 0.2:
+        publisher_id = 'unconnected%d' % rng.randint(1, 10)
+      candidates.user_ratings.append(
+          candidate_index.CandidateRating(item_id, publisher_id,
+                                          publisher_category_id,
+                                          rng.choice([-1, 1]), date))
+  for item_ids in (candidates.past_recommendation_item_ids,
+                   candidates.exclude_item_ids,
+                   candidates.recent_rated_item_ids):
+    item_ids.update(rng.randint(1, num_items) for _ in range(num_items // 50))
+  return candidates
+
+
+def BaselineRecommendations(candidates, nominal_weight, decay_rate):
+  """Scores the candidates with the loops of RecommendationsOnDemand.
+
+  The loops are the ones of item_recommendation.py before item_scoring, with
+  the inputs read from candidates.
+
+  Args:
+    candidates: The Candidates.
+    nominal_weight: The weight of every user rating on top of the weight of its
+      connection.
+    decay_rate: How much to penalize older items from the same source.
+
+  Returns:
+    The models.Recommendation with a positive weight, sorted the same way.
+  """
+  subscriber_id = SUBSCRIBER_ID
+  user_ratings = candidates.user_ratings
+  positive_source_to_connection = candidates.positive_source_to_connection
+  negative_source_to_connection = candidates.negative_source_to_connection
+  past_recommendation_item_ids = candidates.past_recommendation_item_ids
+  exclude_item_ids = candidates.exclude_item_ids
+  recent_rated_item_ids = candidates.recent_rated_item_ids
+  feed_items = list(candidates.feed_items)
+  feed_url_to_connection = candidates.feed_url_to_connection
+
+  # Verbatim from here on.
+  item_id_to_recommendation = {}
+  num_matched_past_recommendations = 0
+  # Keyed by (user_id, category_id).
+  seen_items_from_user = {}
+  for r in user_ratings:
+    item_id = r.item_id
+    assert item_id
+    if r.rating == 0:
+      continue
+    if r.item_id in past_recommendation_item_ids:
+      num_matched_past_recommendations += 1
+      continue
+    if r.item_id in exclude_item_ids:
+      continue
+    if r.item_id in recent_rated_item_ids:
+      continue
+    if r.publisher_id == subscriber_id:
+      continue
+    if r.rating > 0:
+      connection = positive_source_to_connection.get(r.Source(), None)
+    else:
+      connection = negative_source_to_connection.get(r.Source(), None)
+    if connection:
+      category_id = connection.SubscriberCategoryId()
+      category = connection.subscriber_category
+    else:
+      category = None
+      category_id = None
+    key = (r.item_id, category_id)
+    if key in item_id_to_recommendation:
+      (recommendation, top_sources, source_users,
+       feed_connections) = item_id_to_recommendation[key]
+    else:
+      recommendation = models.Recommendation(
+          item_id=r.item_id,
+          source_category=category,
+          first_seen_datetime=r.date)
+      top_sources = {}
+      source_users = {}
+      feed_connections = []
+      item_id_to_recommendation[key] = (recommendation, top_sources,
+                                        source_users, feed_connections)
+    recommendation.first_seen_datetime = min(recommendation.first_seen_datetime,
+                                             r.date)
+    weight = nominal_weight
+    if connection:
+      connection_weight = connection.weight
+      connection_top_sources = connection.top_sources
+      publisher_id = connection.publisher_id
+      if r.rating > 0 and connection_weight > 0:
+        for source in connection_top_sources:
+          if source.url not in top_sources:
+            top_sources[source.url] = models.RecommendationSourcePage(
+                source.url)
+          top_sources[source.url].weight += connection_weight
+          top_sources[source.url].user_count += 1
+        source_users[publisher_id] = connection_weight
+        recommendation.connection_key_components.append(
+            connection.KeyComponents())
+      # Skip positive recommendations if the publisher has no positive
+      # recommendations in common with the subscriber
+      # (ie, num_shared_items == 0).
+      if r.rating > 0 and connection.num_shared_items == 0:
+        pass
+      else:
+        if decay_rate < 1:
+          key = (publisher_id, connection.PublisherCategoryId())
+          seen_items = seen_items_from_user.get(key, 0)
+          seen_items_from_user[key] = seen_items + 1
+          # We are processing user ratings in most-recent first order. The most
+          # recent rated item gets the full weight of the connection, the older
+          # ones get progressively smaller weight.
+          # We apply the decay rate only to the earned connection weight and
+          # leave the nominal weight alone. That way a new user will see purely
+          # popularity based ranking where each rating has the same weight, no
+          # matter who those ratings came from.
+          connection_weight *= decay_rate ** seen_items
+        weight += connection_weight
+    if weight > 0:
+      recommendation.weight += r.rating * weight
+      if r.rating > 0:
+        recommendation.user_count += 1
+
+  seen_items_from_feed = {}
+  if decay_rate < 1:
+    # We need to sort so that the decay rate is applied from most recent items
+    # to less recent items.
+    feed_items.sort(key=lambda item: item.published_date, reverse=True)
+
+  num_feed_items_matched_past_recommendations = 0
+  for item in feed_items:
+    item_id = item.item_id
+    if item_id in recent_rated_item_ids:
+      continue
+    if item_id in past_recommendation_item_ids:
+      num_feed_items_matched_past_recommendations += 1
+      continue
+    connection = feed_url_to_connection.get(item.feed_url, None)
+    if not connection:
+      continue
+    seen_items = 0
+    # We need to count urls in the exclude list before we ignore them.
+    if decay_rate < 1:
+      seen_items = seen_items_from_feed.get(item.feed_url, 0)
+      seen_items_from_feed[item.feed_url] = seen_items + 1
+    if item_id in exclude_item_ids:
+      continue
+    category = connection['category']
+    key = (item_id, models.GetCategoryId(category))
+    if key in item_id_to_recommendation:
+      (recommendation, top_sources, source_users,
+       feed_connections) = item_id_to_recommendation[key]
+    else:
+      recommendation = models.Recommendation(
+          item_id=item_id,
+          source_category=category,
+          first_seen_datetime=item.published_date)
+      top_sources = {}
+      source_users = {}
+      feed_connections = []
+      item_id_to_recommendation[key] = (recommendation, top_sources,
+                                        source_users, feed_connections)
+    recommendation.first_seen_datetime = min(recommendation.first_seen_datetime,
+                                             item.published_date)
+    weight = connection['weight']
+    if decay_rate < 1:
+      weight = connection['weight'] * (decay_rate ** seen_items)
+    feed_connections.append(connection)
+    recommendation.weight += weight
+    recommendation.connection_key_components.append(
+        connection['key_components'])
+
+  result = [
+      r for (r, _, _, _) in item_id_to_recommendation.values() if r.weight > 0
+  ]
+  result.sort(key=lambda v: (v.weight, v.first_seen_datetime), reverse=True)
+  return result
+
+
+def ScoredRecommendations(candidates, nominal_weight, decay_rate):
+  """Scores the candidates the way RecommendationsOnDemand does now.
+
+  Returns:
+    The item_scoring.Scores and the ranked candidates.
+  """
+  scores, _, _, _ = item_recommendation._ScoreCandidates(
+      SUBSCRIBER_ID, candidates.user_ratings,
+      candidates.positive_source_to_connection,
+      candidates.negative_source_to_connection, list(candidates.feed_items),
+      candidates.feed_url_to_connection,
+      candidates.past_recommendation_item_ids, candidates.exclude_item_ids,
+      candidates.recent_rated_item_ids, nominal_weight, decay_rate)
+  return scores, list(scores.Ranked())
+
+
+def BaselineScores(recommendations):
+  """Returns the ranking and the scores of candidates by (item id, category)."""
+  ranking = [(r.weight, r.first_seen_datetime) for r in recommendations]
+  scores = {(r.item_id, models.GetCategoryId(r.source_category)):
+            (r.weight, r.user_count, r.first_seen_datetime)
+            for r in recommendations}
+  return ranking, scores
+
+
+def NewScores(scores, ranked):
+  """Returns the same as BaselineScores for item_scoring.Scores."""
+  ranking = []
+  by_candidate = {}
+  for candidate in ranked:
+    weight = float(scores.weights[candidate])
+    first_seen = item_scoring.MicrosToDatetime(scores.first_seen[candidate])
+    ranking.append((weight, first_seen))
+    by_candidate[(int(scores.item_ids[candidate]),
+                  scores.categories[candidate])] = (
+                      weight, int(scores.user_counts[candidate]), first_seen)
+  return ranking, by_candidate
+
+
+def main():
+  rng = random.Random(1)
+  for num_ratings in NUM_RATINGS:
+    candidates = RandomCandidates(rng, num_ratings, num_ratings // 5,
+                                  NUM_CONNECTIONS)
+    for decay_rate in [1, 0.95]:
+      nominal_weight = item_recommendation.NOMINAL_USER_VOTE_WEIGHT
+      expected = BaselineScores(
+          BaselineRecommendations(candidates, nominal_weight, decay_rate))
+      actual = NewScores(
+          *ScoredRecommendations(candidates, nominal_weight, decay_rate))
+      assert expected == actual, (num_ratings, decay_rate)
+      baseline = min(
+          timeit.repeat(
+              lambda: BaselineRecommendations(candidates, nominal_weight,
+                                              decay_rate),
+              number=1,
+              repeat=REPEATS))
+      vectorized = min(
+          timeit.repeat(
+              lambda: ScoredRecommendations(candidates, nominal_weight,
+                                            decay_rate),
+              number=1,
+              repeat=REPEATS))
+      print('ratings and feed items: %d decay_rate: %s loop: %.1f ms '
+            'table and numpy: %.1f ms speedup: %.1fx' %
+            (num_ratings, decay_rate, baseline * 1000, vectorized * 1000,
+             baseline / vectorized))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+import unittest
+
+from recommender import item_scoring
+
+
+class ItemScoringTest(unittest.TestCase):
+
+  def testEmpty(self):
+    table = item_scoring.ScoringTable()
+    self.assertEqual(0, len(item_scoring.Score(table, 0, 1)))
+
+  def testAllExcluded(self):
+    table = item_scoring.ScoringTable()
+    connection = table.AddConnection(1.0, None, 'feed')
+    table.AddFeedItem(1, 1, connection, excluded=True)
+    self.assertEqual(0, len(item_scoring.Score(table, 0, 0.5)))
+
+  def testScore(self):
+    table = item_scoring.ScoringTable()
+    positive = table.AddConnection(0.5, None, 'a')
+    negative = table.AddConnection(0.25, 3, 'a')
+    feed = table.AddConnection(2.0, None, 'feed')
+    table.AddRating(1, 1, 300, positive)
+    table.AddRating(2, -1, 200, negative)
+    table.AddFeedItem(1, 100, feed, excluded=True)
+    table.AddFeedItem(1, 50, feed)
+    table.AddRating(1, 1, 10)
+
+    scores = item_scoring.Score(table, 0.0001, 0.5)
+
+    self.assertEqual([1, 2], scores.item_ids.tolist())
+    self.assertEqual([None, 3], scores.categories)
+    self.assertEqual(
+        [(0.0001 + 0.5) + 2.0 * 0.5 + 0.0001, -(0.0001 + 0.25 * 0.5)],
+        scores.weights.tolist())
+    self.assertEqual([2, 0], scores.user_counts.tolist())
+    self.assertEqual([10, 200], scores.first_seen.tolist())
+    self.assertEqual([0, 3, 4], scores.Rows(0))
+
+  def testRanked(self):
+    table = item_scoring.ScoringTable()
+    for item_id, rating, date in [(1, 1, 10), (2, -1, 20), (3, 1, 30),
+                                  (4, 1, 10), (3, 1, 30), (5, 1, 30)]:
+      table.AddRating(item_id, rating, date)
+    scores = item_scoring.Score(table, 0.5, 1)
+    self.assertEqual([3, 5, 1, 4],
+                     [scores.item_ids[c] for c in scores.Ranked()])
+
+  def testMicros(self):
+    d = datetime(2020, 5, 6, 7, 8, 9, 123456)
+    self.assertEqual(
+        d, item_scoring.MicrosToDatetime(item_scoring.DatetimeToMicros(d)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -11,12 +11,31 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Maps urls to a numeric identifier."""
+"""Maps urls to a numeric identifier.
+
+Every url has an Item keyed by its id and a UrlToItem keyed by a hash of the
+url, so both directions are resolved with gets.
+"""
+
+import hashlib
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from protos import cache_pb2
+from recommender import lru_cache
+from recommender import migrations
+
+URL_TO_ITEM_ID_CACHE_PREFIX = 'u2i:'
+ITEM_ID_TO_URL_CACHE_PREFIX = 'i2u:'
+# How many urls and item ids each instance keeps in memory in front of
+# memcache. The mapping never changes once an item is created.
+INSTANCE_CACHE_SIZE = 50000
+# The maximum number of values of an IN filter.
+MAX_IN_FILTER_VALUES = 30
+
+_url_to_item_id_cache = lru_cache.LruCache(INSTANCE_CACHE_SIZE)
+_item_id_to_url_cache = lru_cache.LruCache(INSTANCE_CACHE_SIZE)
 
 
 class Item(ndb.Model):
@@ -26,59 +45,184 @@ class Item(ndb.Model):
     return self.key.integer_id()
 
 
+class UrlToItem(ndb.Model):
+  """The item id of a url. Keyed by UrlToItemKeyName(url)."""
+  url = ndb.StringProperty(indexed=False)
+  item_id = ndb.IntegerProperty(indexed=False)
+
+
+def UrlToItemKeyName(url):
+  if isinstance(url, unicode):
+    url = url.encode('utf-8')
+  return hashlib.sha1(url).hexdigest()
+
+
+def _UrlToItemKey(url):
+  return ndb.Key(UrlToItem, UrlToItemKeyName(url))
+
+
+def _RememberInInstance(url_to_item_id):
+  _url_to_item_id_cache.SetMulti(url_to_item_id)
+  _item_id_to_url_cache.SetMulti(
+      {item_id: url for url, item_id in url_to_item_id.iteritems()})
+
+
+def ClearInstanceCaches():
+  _url_to_item_id_cache.Clear()
+  _item_id_to_url_cache.Clear()
+
+
+def InstanceCacheStats():
+  """Returns the hits and misses of the instance caches."""
+  return {
+      'url_to_item_id_hits': _url_to_item_id_cache.hits,
+      'url_to_item_id_misses': _url_to_item_id_cache.misses,
+      'item_id_to_url_hits': _item_id_to_url_cache.hits,
+      'item_id_to_url_misses': _item_id_to_url_cache.misses,
+  }
+
+
 def UrlToItemId(url):
-  item = Item.query(Item.url == url).get()
-  if not item:
-    item = Item(url=url)
-    item.put()
-  return item.key.integer_id()
+  return UrlsToItemIdsCreatingMissing([url])[url]
+
+
+def _GetItemIds(urls):
+  """Returns a map from url to item id for the urls that have one."""
+  url_to_item_id = _url_to_item_id_cache.GetMulti(urls)
+  urls_not_in_instance = [url for url in urls if url not in url_to_item_id]
+  if not urls_not_in_instance:
+    return url_to_item_id
+  in_memcache = memcache.get_multi(
+      urls_not_in_instance, key_prefix=URL_TO_ITEM_ID_CACHE_PREFIX)
+  _RememberInInstance(in_memcache)
+  url_to_item_id.update(in_memcache)
+  urls_not_in_cache = list(set(url for url in urls_not_in_instance
+                               if url not in url_to_item_id))
+  if not urls_not_in_cache:
+    return url_to_item_id
+  new_items = {}
+  for url, url_to_item in zip(
+      urls_not_in_cache,
+      ndb.get_multi([_UrlToItemKey(url) for url in urls_not_in_cache])):
+    if url_to_item:
+      new_items[url] = url_to_item.item_id
+  urls_not_found = [url for url in urls_not_in_cache if url not in new_items]
+  # Items that were created before UrlToItem existed are found with a query
+  # until the migration has run.
+  if urls_not_found and not migrations.IsFinished(migrations.URL_TO_ITEM):
+    # An IN filter is split into a query per value, so the urls are queried
+    # in chunks that run concurrently.
+    queries = [
+        Item.query(Item.url.IN(
+            urls_not_found[i:i + MAX_IN_FILTER_VALUES])).fetch_async()
+        for i in range(0, len(urls_not_found), MAX_IN_FILTER_VALUES)
+    ]
+    for query in queries:
+      for item in query.get_result():
+        new_items[item.url] = item.ItemId()
+  memcache.set_multi(new_items, key_prefix=URL_TO_ITEM_ID_CACHE_PREFIX)
+  _RememberInInstance(new_items)
+  url_to_item_id.update(new_items)
+  return url_to_item_id
+
+
+def UrlsToItemIdsCreatingMissing(urls):
+  """Returns a map from url to item id, creating items for new urls.
+
+  The ids of new urls are allocated in one batch. A url only gets an id when
+  its UrlToItem is inserted, so concurrent calls agree on the id of a url.
+
+  Args:
+    urls: The urls.
+
+  Returns:
+    A dict with an item id for every url.
+  """
+  if not urls:
+    return {}
+  url_to_item_id = _GetItemIds(urls)
+  new_urls = list(set(url for url in urls if url not in url_to_item_id))
+  if not new_urls:
+    return url_to_item_id
+  first_id, _ = Item.allocate_ids(size=len(new_urls))
+  new_items = [
+      Item(key=ndb.Key(Item, first_id + i), url=url)
+      for i, url in enumerate(new_urls)
+  ]
+  # The items are written first so that every id in a UrlToItem has an item.
+  ndb.put_multi(new_items)
+  futures = [
+      UrlToItem.get_or_insert_async(
+          UrlToItemKeyName(item.url), url=item.url, item_id=item.ItemId())
+      for item in new_items
+  ]
+  unused_items = []
+  for item, future in zip(new_items, futures):
+    item_id = future.get_result().item_id
+    if item_id != item.ItemId():
+      # Another request created the url at the same time.
+      unused_items.append(item.key)
+    url_to_item_id[item.url] = item_id
+  if unused_items:
+    ndb.delete_multi(unused_items)
+  created = {url: url_to_item_id[url] for url in new_urls}
+  memcache.set_multi(created, key_prefix=URL_TO_ITEM_ID_CACHE_PREFIX)
+  _RememberInInstance(created)
+  return url_to_item_id
 
 
 def UrlsToItemIds(urls):
   """Returns a map from url to item id."""
   if not urls:
     return {}
-  url_to_item_id = memcache.get_multi(urls, key_prefix='u2i:')
-  urls_not_in_cache = [url for url in urls if url not in url_to_item_id]
-  if urls_not_in_cache:
-    new_items = {}
-    for item in Item.query(Item.url.IN(urls_not_in_cache)).fetch():
-      url_to_item_id[item.url] = item.ItemId()
-      new_items[item.url] = item.ItemId()
-    memcache.set_multi(new_items, key_prefix='u2i:')
-  return url_to_item_id
+  return _GetItemIds(urls)
+
+
+def AddUrlToItem(item):
+  """Creates the UrlToItem of an item that was created before it existed.
+
+  When a url has several items the first one that is migrated wins.
+  """
+  UrlToItem.get_or_insert(
+      UrlToItemKeyName(item.url), url=item.url, item_id=item.ItemId())
 
 
 def ItemIdsToUrls(item_ids):
   """Returns a map from item id to url."""
   if not item_ids:
     return {}
+  item_id_to_url = _item_id_to_url_cache.GetMulti(item_ids)
+  item_ids_not_in_instance = [
+      item_id for item_id in item_ids if item_id not in item_id_to_url
+  ]
+  if not item_ids_not_in_instance:
+    return item_id_to_url
   item_id_string_to_url = memcache.get_multi(
-      [str(item_id) for item_id in item_ids], key_prefix='i2u:')
-  item_id_to_url = {
+      [str(item_id) for item_id in item_ids_not_in_instance],
+      key_prefix=ITEM_ID_TO_URL_CACHE_PREFIX)
+  found = {
       int(item_id_string): url
       for (item_id_string, url) in item_id_string_to_url.iteritems()
   }
   item_ids_not_in_cache = [
-      item_id for item_id in item_ids if item_id not in item_id_to_url
+      item_id for item_id in item_ids_not_in_instance if item_id not in found
   ]
   if item_ids_not_in_cache:
     new_items = {}
     for item in ndb.get_multi(
         [ndb.Key(Item, item_id) for item_id in item_ids_not_in_cache]):
       if item:
-        item_id_to_url[item.ItemId()] = item.url
+        found[item.ItemId()] = item.url
         new_items[str(item.ItemId())] = item.url
-    memcache.set_multi(new_items, key_prefix='i2u:')
+    memcache.set_multi(new_items, key_prefix=ITEM_ID_TO_URL_CACHE_PREFIX)
+  _item_id_to_url_cache.SetMulti(found)
+  item_id_to_url.update(found)
   return item_id_to_url
 
 
 def ItemIdToUrl(item_id):
   assert item_id
-  item = ndb.Key(Item, item_id).get()
-  if item:
-    return item.url
-  return None
+  return ItemIdsToUrls([item_id]).get(item_id)
 
 
 def ItemIdsToBytes(item_ids):
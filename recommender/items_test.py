@@ -15,7 +15,9 @@
 import unittest
 
 from recommender import items
+from recommender import migrations
 
+from google.appengine.api import memcache
 from google.appengine.ext import testbed
 
 
@@ -26,6 +28,8 @@ class ItemsTest(unittest.TestCase):
     self.testbed.activate()
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    migrations.ClearInstanceCache()
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -53,3 +57,55 @@ class ItemsTest(unittest.TestCase):
     self.assertEqual({'a': id_a}, items.UrlsToItemIds(['a']))
     self.assertEqual({}, items.UrlsToItemIds(['z']))
     self.assertEqual({}, items.UrlsToItemIds([]))
+
+  def testCreatingMissing(self):
+    id_a = items.UrlToItemId('a')
+
+    url_to_item_id = items.UrlsToItemIdsCreatingMissing(['a', 'b', 'c', 'b'])
+    self.assertEqual(['a', 'b', 'c'], sorted(url_to_item_id))
+    self.assertEqual(id_a, url_to_item_id['a'])
+    self.assertEqual(3, len(set(url_to_item_id.values())))
+    self.assertEqual(url_to_item_id,
+                     items.UrlsToItemIdsCreatingMissing(['a', 'b', 'c']))
+    self.assertEqual({v: k for k, v in url_to_item_id.items()},
+                     items.ItemIdsToUrls(url_to_item_id.values()))
+    self.assertEqual({}, items.UrlsToItemIdsCreatingMissing([]))
+
+  def testItemWithoutUrlToItem(self):
+    item_id = items.Item(url='a').put().integer_id()
+
+    self.assertEqual({'a': item_id}, items.UrlsToItemIds(['a']))
+    self.assertEqual(item_id, items.UrlToItemId('a'))
+
+    items.AddUrlToItem(items.Item.get_by_id(item_id))
+    self.assertEqual(item_id,
+                     items.UrlToItem.get_by_id(
+                         items.UrlToItemKeyName('a')).item_id)
+
+  def testNoQueryAfterMigration(self):
+    items.Item(url='a').put()
+    migrations.SetFinished(migrations.URL_TO_ITEM)
+
+    self.assertEqual({}, items.UrlsToItemIds(['a']))
+
+  def testQueriesManyItemsWithoutUrlToItem(self):
+    urls = ['http://%d' % i for i in range(items.MAX_IN_FILTER_VALUES * 2 + 1)]
+    url_to_item_id = {
+        url: items.Item(url=url).put().integer_id() for url in urls
+    }
+
+    self.assertEqual(url_to_item_id, items.UrlsToItemIds(urls))
+
+  def testInstanceCache(self):
+    id_a = items.UrlToItemId('a')
+    items.ClearInstanceCaches()
+    self.assertEqual({'a': id_a}, items.UrlsToItemIds(['a']))
+
+    # Both directions are now served from instance memory.
+    memcache.flush_all()
+    items.Item.get_by_id(id_a).key.delete()
+    self.assertEqual({'a': id_a}, items.UrlsToItemIds(['a']))
+    self.assertEqual({id_a: 'a'}, items.ItemIdsToUrls([id_a]))
+    stats = items.InstanceCacheStats()
+    self.assertEqual(1, stats['url_to_item_id_hits'])
+    self.assertEqual(1, stats['item_id_to_url_hits'])
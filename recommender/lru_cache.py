@@ -0,0 +1,67 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A bounded least recently used cache shared by the requests of an instance.
+
+It is meant for values that never change once they are created, so entries
+are never invalidated, only evicted.
+"""
+
+import collections
+import threading
+
+
+class LruCache(object):
+  """A thread-safe map that keeps at most max_size entries."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # From the least to the most recently used.
+    self._entries = collections.OrderedDict()
+
+  def GetMulti(self, keys):
+    """Returns a dict with the keys that are in the cache."""
+    result = {}
+    with self._lock:
+      for key in keys:
+        value = self._entries.pop(key, None)
+        if value is None:
+          self.misses += 1
+          continue
+        self.hits += 1
+        self._entries[key] = value
+        result[key] = value
+    return result
+
+  def SetMulti(self, mapping):
+    """Adds the entries of mapping. None values are not cached."""
+    with self._lock:
+      for key, value in mapping.iteritems():
+        if value is None:
+          continue
+        self._entries.pop(key, None)
+        self._entries[key] = value
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
@@ -0,0 +1,70 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from recommender import lru_cache
+
+
+class LruCacheTest(unittest.TestCase):
+
+  def testGetMulti(self):
+    cache = lru_cache.LruCache(10)
+    cache.SetMulti({'a': 1, 'b': 2})
+
+    self.assertEqual({'a': 1, 'b': 2}, cache.GetMulti(['a', 'b', 'c']))
+    self.assertEqual(2, cache.hits)
+    self.assertEqual(1, cache.misses)
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = lru_cache.LruCache(2)
+    cache.SetMulti({'a': 1})
+    cache.SetMulti({'b': 2})
+    cache.GetMulti(['a'])
+    cache.SetMulti({'c': 3})
+
+    self.assertEqual({'a': 1, 'c': 3}, cache.GetMulti(['a', 'b', 'c']))
+    self.assertEqual(2, len(cache))
+
+  def testClear(self):
+    cache = lru_cache.LruCache(2)
+    cache.SetMulti({'a': 1})
+    cache.GetMulti(['a', 'b'])
+    cache.Clear()
+
+    self.assertEqual({}, cache.GetMulti(['a']))
+    self.assertEqual(0, cache.hits)
+    self.assertEqual(1, cache.misses)
+
+  def testConcurrentUse(self):
+    cache = lru_cache.LruCache(50)
+
+    def Work(offset):
+      for i in range(1000):
+        key = (offset + i) % 100
+        cache.SetMulti({key: key})
+        cache.GetMulti([key, key + 1])
+
+    threads = [threading.Thread(target=Work, args=(i,)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(50, len(cache))
+    self.assertEqual(8 * 1000 * 2, cache.hits + cache.misses)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records which data migrations have finished.
+
+Code that reads data written before a migration checks IsFinished, which is
+true once the pipeline of the migration has run over all entities.
+"""
+
+from google.appengine.ext import ndb
+
+URL_TO_ITEM = 'migrate_url_to_item'
+FEED_ITEM_KEYS = 'migrate_feed_item_keys'
+SCHEDULE_FEEDS = 'schedule_feeds'
+
+# A migration stays finished, so each instance remembers the finished ones.
+_finished = set()
+
+
+class Migration(ndb.Model):
+  """Keyed by the name of a migration, exists once it has finished."""
+  finished_datetime = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+def IsFinished(name):
+  return IsFinishedAsync(name).get_result()
+
+
+@ndb.tasklet
+def IsFinishedAsync(name):
+  if name not in _finished:
+    migration = yield ndb.Key(Migration, name).get_async()
+    if migration is None:
+      raise ndb.Return(False)
+    _finished.add(name)
+  raise ndb.Return(True)
+
+
+def SetFinished(name):
+  Migration(id=name).put()
+  _finished.add(name)
+
+
+def ClearInstanceCache():
+  _finished.clear()
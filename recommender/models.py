@@ -17,6 +17,7 @@ from __future__ import division
 
 from datetime import datetime
 from datetime import timedelta
+import collections
 import functools
 import logging
 import math
@@ -30,7 +31,9 @@ from google.appengine.ext import ndb
 from recommender import feeds
 from recommender import items
 from recommender import json_encoder
+from recommender import rating_sequence
 from recommender import ratings
+from recommender import recommendation_cache
 from recommender import time_periods
 from recommender import url_util
 
@@ -94,6 +97,8 @@ class PageRating(ndb.Model):
   source = ndb.StringProperty(indexed=True)
   category = ndb.KeyProperty(kind=Category)
   item_id = ndb.IntegerProperty()
+  # The position of this rating in the rating_sequence of its category.
+  sequence_number = ndb.IntegerProperty(indexed=False)
 
   def to_dict(self):
     result = _FilterFields(ndb.Model.to_dict(self), PageRating._EXPORTED_FIELDS)
@@ -133,6 +138,38 @@ class PageInfo(ndb.Model):
     return result
 
 
+PAGE_FETCH_FAILURE_MEMCACHE_PREFIX = 'pff:'
+# The kinds of PageFetchFailure.
+FAILURE_INVALID_URL = 'invalid_url'
+FAILURE_FETCH_ERROR = 'fetch_error'
+FAILURE_VALUE_ERROR = 'value_error'
+# The delay before the first retry, it doubles with every failed attempt.
+FIRST_PAGE_FETCH_RETRY_DELAY = timedelta(hours=1)
+MAX_PAGE_FETCH_RETRY_DELAY = timedelta(days=30)
+# A url is not retried anymore after this many failed attempts.
+MAX_PAGE_FETCH_ATTEMPTS = 10
+PAGE_FETCH_RETRIES_PER_RUN = 100
+# How many pages a request fetches at the same time.
+MAX_CONCURRENT_PAGE_FETCHES = 20
+
+
+class PageFetchFailure(ndb.Model):
+  """A url whose metadata could not be fetched. Keyed by url.
+
+  Requests never fetch a url that has a failure, they get a placeholder
+  PageInfo instead. RetryFailedPageFetches fetches it again once next_retry
+  has passed.
+  """
+  kind = ndb.StringProperty(indexed=False)
+  message = ndb.StringProperty(indexed=False)
+  attempts = ndb.IntegerProperty(default=0, indexed=False)
+  # None when the url is not retried anymore.
+  next_retry = ndb.DateTimeProperty()
+
+  def RetryIsDue(self, now):
+    return self.next_retry is not None and self.next_retry <= now
+
+
 class ConnectionSourcePage(ndb.Model):
   url = ndb.StringProperty()
   weight = ndb.FloatProperty()
@@ -284,6 +321,7 @@ def UserRatingToUnified(rating):
       'date': rating.date,
       'rating': rating.rating,
       'url': rating.url,
+      'sequence_number': rating.sequence_number,
   }
 
 
@@ -295,24 +333,50 @@ def FeedRatingToUnified(item):
       'date': item.published_date,
       'rating': ratings.POSITIVE,
       'url': item.url,
+      'sequence_number': item.sequence_number,
   }
 
 
-def GetUnifiedRatings(url, include_source_feed=True, do_not_fetch=False):
-  page_info_future = GetPageInfoAsync(url, do_not_fetch=do_not_fetch)
-  # Find user ratings for this url.
-  user_ratings = [
-      UserRatingToUnified(rating)
-      for rating in PageRating.query(
-          PageRating.url == url).order(-PageRating.date)
-      if rating.rating != ratings.NEUTRAL
-  ]
+UNIFIED_RATINGS_CACHE_PREFIX = 'ur:'
+# How many of the most recent ratings of a url are cached.
+MAX_CACHED_UNIFIED_RATINGS = 1000
+# The ratings are read with an eventually consistent query, so a read that
+# raced with an invalidation can cache stale ratings until they expire.
+UNIFIED_RATINGS_CACHE_TTL = timedelta(minutes=10)
 
-  # Find feed items for this url.
-  feed_ratings = [
-      FeedRatingToUnified(item) for item in feeds.FeedItem.query(
-          feeds.FeedItem.url == url).order(-feeds.FeedItem.published_date)
-  ]
+
+def GetUnifiedRatings(url,
+                      include_source_feed=True,
+                      do_not_fetch=False,
+                      limit=None):
+  return GetUnifiedRatingsAsync(url, include_source_feed, do_not_fetch,
+                                limit).get_result()
+
+
+@ndb.tasklet
+def GetUnifiedRatingsAsync(url,
+                           include_source_feed=True,
+                           do_not_fetch=False,
+                           limit=None):
+  """Returns the user ratings and feed items of a url sorted by date.
+
+  The ratings, the feed of the url and the page info are read concurrently.
+
+  Args:
+    url: The url.
+    include_source_feed: Whether to include the feed that the page info of the
+      url names.
+    do_not_fetch: Whether to skip fetching the page info when it is not known.
+    limit: If set, only this many of the most recent ratings are returned.
+
+  Returns:
+    A list of dicts.
+  """
+  if include_source_feed:
+    page_info_future = GetPageInfoAsync(url, do_not_fetch=do_not_fetch)
+  ratings_future = _GetCachedRatingsOfUrlAsync(url, limit)
+  feed_future = ndb.Key(feeds.Feed, url).get_async()
+  merged = yield ratings_future
 
   # We do not include the source feed if this url was downvoted because we
   # do not trust that the feed url in the page info has posted this url.
@@ -320,15 +384,16 @@ def GetUnifiedRatings(url, include_source_feed=True, do_not_fetch=False):
   # of a "good" feed and the "bad" page puts a link to the "good" feed in the
   # <head> <meta> tag.
   if include_source_feed:
-    page_info = page_info_future.get_result()
-    if page_info.feed_url:
+    page_info = yield page_info_future
+    if page_info and page_info.feed_url:
       feed_already_included = False
-      for feed_rating in feed_ratings:
-        if feed_rating['publisher_id'] == page_info.feed_url:
+      for rating in merged:
+        if (rating['type'] == SOURCE_TYPE_FEED and
+            rating['publisher_id'] == page_info.feed_url):
           feed_already_included = True
           break
       if not feed_already_included:
-        feed_ratings.append({
+        merged.append({
             'type': SOURCE_TYPE_FEED,
             'publisher_id': page_info.feed_url,
             'publisher_category_id': None,
@@ -338,10 +403,9 @@ def GetUnifiedRatings(url, include_source_feed=True, do_not_fetch=False):
             'date': datetime.now() - timedelta(days=1),
             'rating': ratings.POSITIVE,
         })
-
-  merged = user_ratings + feed_ratings
-  merged.sort(key=lambda r: r['date'])
-  if feeds.GetFeed(url):
+        merged.sort(key=lambda r: r['date'])
+  feed = yield feed_future
+  if feed:
     # Every feed url is recommended by itself.
     merged.insert(
         0, {
@@ -351,7 +415,78 @@ def GetUnifiedRatings(url, include_source_feed=True, do_not_fetch=False):
             'date': datetime.min,
             'rating': ratings.POSITIVE,
         })
-  return merged
+  raise ndb.Return(merged)
+
+
+def _MostRecent(unified_ratings, limit):
+  if limit is None:
+    return unified_ratings
+  return unified_ratings[max(len(unified_ratings) - limit, 0):]
+
+
+@ndb.tasklet
+def _GetRatingsOfUrlAsync(url, limit):
+  """Reads the user ratings and feed items of a url.
+
+  Args:
+    url: The url.
+    limit: If set, only this many of the most recent ratings are returned.
+
+  Returns:
+    A (ratings, is_complete) pair, where ratings are sorted by date and
+    is_complete tells whether no ratings were left out.
+  """
+  fetch_limit = limit + 1 if limit is not None else None
+  page_ratings, feed_items = yield (
+      PageRating.query(PageRating.url == url).order(
+          -PageRating.date).fetch_async(fetch_limit),
+      feeds.FeedItem.query(feeds.FeedItem.url == url).order(
+          -feeds.FeedItem.published_date).fetch_async(fetch_limit))
+  is_complete = limit is None or (len(page_ratings) <= limit and
+                                  len(feed_items) <= limit)
+  merged = [
+      UserRatingToUnified(rating)
+      for rating in page_ratings
+      if rating.rating != ratings.NEUTRAL
+  ] + [FeedRatingToUnified(item) for item in feed_items]
+  merged.sort(key=lambda r: r['date'])
+  raise ndb.Return((_MostRecent(merged, limit), is_complete))
+
+
+@ndb.tasklet
+def _GetCachedRatingsOfUrlAsync(url, limit):
+  if limit is not None and limit > MAX_CACHED_UNIFIED_RATINGS:
+    result, _ = yield _GetRatingsOfUrlAsync(url, limit)
+    raise ndb.Return(result)
+  client = memcache.Client()
+  cached = yield client.get_async(UNIFIED_RATINGS_CACHE_PREFIX + url)
+  if cached is not None:
+    result, is_complete = pickle.loads(cached)
+    for r in result:
+      r['url'] = url
+  else:
+    result, is_complete = yield _GetRatingsOfUrlAsync(
+        url, MAX_CACHED_UNIFIED_RATINGS)
+    # Every rating has the same url, so it is not stored for each of them.
+    value = pickle.dumps(
+        ([{k: v for k, v in r.iteritems() if k != 'url'} for r in result],
+         is_complete), pickle.HIGHEST_PROTOCOL)
+    if len(value) <= memcache.MAX_VALUE_SIZE:
+      yield client.set_async(
+          UNIFIED_RATINGS_CACHE_PREFIX + url,
+          value,
+          time=UNIFIED_RATINGS_CACHE_TTL.total_seconds())
+    else:
+      logging.warning('Ratings of %s are too large to cache: %d bytes', url,
+                      len(value))
+  if limit is None and not is_complete:
+    result, _ = yield _GetRatingsOfUrlAsync(url, None)
+  raise ndb.Return(_MostRecent(result, limit))
+
+
+def InvalidateUnifiedRatings(urls):
+  """Drops the cached ratings of urls after their ratings changed."""
+  memcache.delete_multi(list(urls), key_prefix=UNIFIED_RATINGS_CACHE_PREFIX)
 
 
 def GetCategoryId(category_key):
@@ -794,6 +929,9 @@ class Source(object):
 
   # How many ratings did this source submit after a given date.
   def GetNumRatingsSinceDate(self, date):
+    return self.GetNumRatingsSinceDateAsync(date).get_result()
+
+  def GetNumRatingsSinceDateAsync(self, date):
     if self.source_type == SOURCE_TYPE_USER:
       q = PageRating.query(
           PageRating.category == self.CategoryKey(),
@@ -802,7 +940,13 @@ class Source(object):
     else:
       q = feeds.FeedItem.query(feeds.FeedItem.feed_url == self.source_id,
                                feeds.FeedItem.published_date >= date)
-    return q.count()
+    return q.count_async()
+
+  def RatingSequenceKey(self):
+    if self.source_type == SOURCE_TYPE_USER:
+      return rating_sequence.UserSequenceKey(
+          UserKey(self.source_id), self.CategoryKey())
+    return rating_sequence.FeedSequenceKey(self.source_id)
 
   def GetLastRatingDatetime(self):
     if self.source_type == SOURCE_TYPE_USER:
@@ -850,22 +994,22 @@ def GetBulkPageInfo(urls, log_not_found=False, do_not_fetch=False):
     page_info_models_list = ndb.get_multi(
         [ndb.Key(PageInfo, url) for url in urls_not_in_cache])
     page_info_models = {}
-    pending = {}
     # Third, fetch in parallel what was not found in the cache and the
     # datastore.
+    pending = []
     for url, page_info_model in zip(urls_not_in_cache, page_info_models_list):
       if page_info_model:
         page_info_models[url] = page_info_model
       else:
-        pending[url] = GetPageInfoAsync(
-            url,
-            log_not_found=log_not_found,
-            do_not_fetch=do_not_fetch,
-            get_from_datastore=False)
-    for url, page_info_model_future in pending.iteritems():
+        pending.append(url)
+    fetched = _GetPageInfos(
+        pending,
+        log_not_found=log_not_found,
+        do_not_fetch=do_not_fetch,
+        get_from_datastore=False)
+    for url in pending:
       # GetPageInfoAsync returns None when do_not_fetch is True.
-      page_info_models[url] = page_info_model_future.get_result() or PageInfo(
-          url=url, title=url)
+      page_info_models[url] = fetched[url] or PageInfo(url=url, title=url)
     new_entries = {}
     for url, page_info_model in page_info_models.iteritems():
       page_info = page_info_model.to_dict()
@@ -888,17 +1032,39 @@ def GetBulkPageInfo(urls, log_not_found=False, do_not_fetch=False):
 
 
 def PrefetchPageInfos(urls):
-  tasks = [GetPageInfoAsync(url) for url in urls]
-  # All tasks kicked off.
-  page_infos = [task.get_result() for task in tasks]
+  page_infos = _GetPageInfos(list(urls)).values()
   # Prefetch canonical urls as well.
-  canonical_url_tasks = [
-      GetPageInfoAsync(page_info.canonical_url)
+  _GetPageInfos([
+      page_info.canonical_url
       for page_info in page_infos
-      if page_info.url != page_info.canonical_url
-  ]
-  for task in canonical_url_tasks:
-    task.get_result()
+      if page_info and page_info.url != page_info.canonical_url
+  ])
+
+
+def _GetPageInfos(urls, **kwargs):
+  """Calls GetPageInfoAsync for urls with a bounded number of fetches.
+
+  A new page is started as soon as one finishes, so the latency is close to
+  that of the slowest page when there are fewer than
+  MAX_CONCURRENT_PAGE_FETCHES urls.
+
+  Args:
+    urls: The urls.
+    **kwargs: The arguments of GetPageInfoAsync.
+
+  Returns:
+    A dict with the result of GetPageInfoAsync for every url.
+  """
+  result = {}
+  pending = collections.deque(urls)
+  in_flight = {}
+  while pending or in_flight:
+    while pending and len(in_flight) < MAX_CONCURRENT_PAGE_FETCHES:
+      url = pending.popleft()
+      in_flight[GetPageInfoAsync(url, **kwargs)] = url
+    done = ndb.Future.wait_any(in_flight.keys())
+    result[in_flight.pop(done)] = done.get_result()
+  return result
 
 
 def _MetadataToPageInfo(m, key, url):
@@ -914,6 +1080,48 @@ def _MetadataToPageInfo(m, key, url):
       estimated_reading_time=m.estimated_reading_time)
 
 
+def _PlaceholderPageInfo(key, url):
+  return PageInfo(key=key, url=url, title=url, canonical_url=url)
+
+
+@ndb.tasklet
+def _GetPageFetchFailureAsync(url):
+  client = memcache.Client()
+  failure = yield client.get_async(PAGE_FETCH_FAILURE_MEMCACHE_PREFIX + url)
+  if failure is None:
+    failure = yield ndb.Key(PageFetchFailure, url).get_async()
+    if failure:
+      yield client.set_async(PAGE_FETCH_FAILURE_MEMCACHE_PREFIX + url, failure)
+  raise ndb.Return(failure)
+
+
+@ndb.tasklet
+def _RecordPageFetchFailureAsync(url, failure, kind, error):
+  """Saves a failed attempt and when to try the url again."""
+  failure = failure or PageFetchFailure(key=ndb.Key(PageFetchFailure, url))
+  failure.kind = kind
+  try:
+    failure.message = unicode(error)[:500]
+  except UnicodeError:
+    failure.message = repr(error)[:500]
+  failure.attempts += 1
+  if kind == FAILURE_INVALID_URL or failure.attempts >= MAX_PAGE_FETCH_ATTEMPTS:
+    failure.next_retry = None
+  else:
+    failure.next_retry = datetime.now() + min(
+        FIRST_PAGE_FETCH_RETRY_DELAY * 2**(failure.attempts - 1),
+        MAX_PAGE_FETCH_RETRY_DELAY)
+  yield (failure.put_async(), memcache.Client().set_async(
+      PAGE_FETCH_FAILURE_MEMCACHE_PREFIX + url, failure))
+
+
+@ndb.tasklet
+def _DeletePageFetchFailureAsync(url):
+  yield (ndb.Key(PageFetchFailure, url).delete_async(),
+         memcache.Client().delete_async(PAGE_FETCH_FAILURE_MEMCACHE_PREFIX +
+                                        url))
+
+
 @ndb.tasklet
 def GetPageInfoAsync(
     url,
@@ -921,7 +1129,8 @@ def GetPageInfoAsync(
     do_not_fetch=False,
     raise_invalid_url=False,
     raise_error=False,
-    get_from_datastore=True):
+    get_from_datastore=True,
+    retry_failed=False):
   url = url_util.Normalize(url)
   # This is the central place where we fetch url information. We remove useless
   # parameters here.
@@ -934,13 +1143,24 @@ def GetPageInfoAsync(
   if get_from_datastore:
     page_info = yield key.get_async()
   if page_info is None:
+    if log_not_found:
+      logging.warning('url not found in cache and datastore: %s', url)
+    if do_not_fetch:
+      logging.warning('returning empty details: %s', url)
+      raise ndb.Return(None)
+    failure = yield _GetPageFetchFailureAsync(url)
+    # Requests that report errors try again once the retry is due, all others
+    # wait for RetryFailedPageFetches.
+    if failure and not retry_failed and not (
+        raise_error and failure.RetryIsDue(datetime.now())):
+      if failure.kind == FAILURE_INVALID_URL:
+        if raise_invalid_url or raise_error:
+          raise url_util.InvalidURLError(failure.message)
+      elif raise_error:
+        raise url_util.Error(failure.message)
+      raise ndb.Return(_PlaceholderPageInfo(key, url))
     try:
-      if log_not_found:
-        logging.warning('url not found in cache and datastore: %s', url)
-      if do_not_fetch:
-        logging.warning('returning empty details: %s', url)
-        raise ndb.Return(None)
-      metadata = url_util.GetPageMetadata(url)
+      metadata = yield url_util.GetPageMetadataAsync(url)
       page_info = _MetadataToPageInfo(metadata, key, url)
       yield page_info.put_async()
       # If the original link is a redirect
@@ -953,27 +1173,52 @@ def GetPageInfoAsync(
         yield _MetadataToPageInfo(metadata, ndb.Key(PageInfo,
                                                     metadata.final_url),
                                   metadata.final_url).put_async()
+      if failure:
+        yield _DeletePageFetchFailureAsync(url)
     except url_util.InvalidURLError as e:
+      yield _RecordPageFetchFailureAsync(url, failure, FAILURE_INVALID_URL, e)
       if raise_invalid_url or raise_error:
         raise e
-      raise ndb.Return(PageInfo(key=key, url=url, title=url, canonical_url=url))
+      raise ndb.Return(_PlaceholderPageInfo(key, url))
     except url_util.Error as e:
+      yield _RecordPageFetchFailureAsync(url, failure, FAILURE_FETCH_ERROR, e)
       if raise_error:
         raise e
       logging.warning('Failed to get page details: %s error: %s', url, e)
       # Store the empty PageInfo so that next time we don't try to urlfetch it
       # again.
-      page_info = PageInfo(key=key, url=url, title=url, canonical_url=url)
+      page_info = _PlaceholderPageInfo(key, url)
       yield page_info.put_async()
     except ValueError as e:
       logging.warning('Got ValueError for page: %s error: %s', url, e)
-      page_info = PageInfo(key=key, url=url, title=url, canonical_url=url)
+      yield _RecordPageFetchFailureAsync(url, failure, FAILURE_VALUE_ERROR, e)
+      page_info = _PlaceholderPageInfo(key, url)
   # Support existing objects that didn't have the canonical url property.
   elif page_info.canonical_url is None:
     page_info.canonical_url = url
   raise ndb.Return(page_info)
 
 
+def RetryFailedPageFetches():
+  """Fetches again the urls whose retry is due.
+
+  This heals the placeholders of urls that failed for a transient reason
+  without making user requests wait for the fetch.
+  """
+  # The urls that are not retried anymore have a next_retry of None, which an
+  # inequality filter matches before any date unless it is excluded.
+  urls = [
+      key.id() for key in PageFetchFailure.query(
+          PageFetchFailure.next_retry > datetime.min,
+          PageFetchFailure.next_retry <= datetime.now()).fetch(
+              PAGE_FETCH_RETRIES_PER_RUN, keys_only=True)
+  ]
+  _GetPageInfos(urls, get_from_datastore=False, retry_failed=True)
+  # The cached placeholders of the urls that were fetched now are replaced.
+  memcache.delete_multi(urls, key_prefix=PAGE_INFO_DICT_MEMCACHE_PREFIX)
+  memcache.delete_multi(urls, key_prefix=PAGE_INFO_MEMCACHE_PREFIX)
+
+
 def GetPageInfoOrRaise(url):
   page_info = memcache.get(PAGE_INFO_MEMCACHE_PREFIX + url)
   if page_info:
@@ -1017,8 +1262,9 @@ def AddRatingAtTime(user,
     category_id,
     time):
   # Get existing ratings before we the new rating is added so we can tell who
-  # this user will be connecting to.
-  stats = GetRatingStats(url)
+  # this user will be connecting to. The page is not fetched while the user
+  # waits.
+  stats = GetRatingStats(url, do_not_fetch=True)
   # Make sure there is a User placeholder for each user with rating so
   # we can run analysis by user.
   MaybeAddUser(user)
@@ -1030,7 +1276,7 @@ def AddRatingAtTime(user,
   if category_id is not None:
     category = CategoryKey(category_id, user)
   user_id = user_key.id()
-  PageRating(
+  page_rating = PageRating(
       key=ndb.Key(PageRating, url, parent=user_key),
       user_id=user_id,
       url=url,
@@ -1038,7 +1284,18 @@ def AddRatingAtTime(user,
       category=category,
       source=source,
       date=time,
-      item_id=items.UrlToItemId(url)).put()
+      item_id=items.UrlToItemId(url))
+
+  def Put():
+    previous = page_rating.key.get()
+    _PutWithSequenceNumber(page_rating)
+    user_count_delta = _PositiveCount(page_rating) - _PositiveCount(previous)
+    if user_count_delta:
+      deferred.defer(
+          UpdateUrlRatingStats, url, user_count_delta, _transactional=True)
+
+  ndb.transaction(Put)
+  InvalidateUnifiedRatings([url])
   # We do not want to show as a past recommendation anything that the user
   # downvoted.
   if rating < 0:
@@ -1048,28 +1305,217 @@ def AddRatingAtTime(user,
 
 
 MAX_STATS_TOP_FEEDS = 10
+# Only the most recent ratings are counted in the stats of popular urls.
+MAX_STATS_RATINGS = 1000
 
 
-def GetRatingStats(url, do_not_fetch=False):
-  """Returns summary of sources of a url."""
+def _PutWithSequenceNumber(page_rating):
+  """Numbers a PageRating in its category and puts it, in a transaction."""
+  page_rating.sequence_number = rating_sequence.AllocateInTransaction(
+      rating_sequence.UserSequenceKey(page_rating.key.parent(),
+                                      page_rating.category))
+  page_rating.put()
+
+
+def SetRatingCategory(page_rating, category):
+  """Moves a PageRating to the end of the sequence of another category."""
+  page_rating.category = category
+  ndb.transaction(lambda: _PutWithSequenceNumber(page_rating))
+  InvalidateUnifiedRatings([page_rating.url])
+
+
+# How many count queries GetNumRatingsAfterAsync runs at the same time.
+MAX_CONCURRENT_COUNT_QUERIES = 20
+
+
+def GetNumRatingsAfter(unified_ratings):
+  return GetNumRatingsAfterAsync(unified_ratings).get_result()
+
+
+@ndb.tasklet
+def GetNumRatingsAfterAsync(unified_ratings):
+  """Returns how many ratings the publisher of each rating made after it.
+
+  Ratings with a sequence number are counted with one batched get of the
+  sequences of their publishers, the others with count queries that run
+  concurrently with the get, at most MAX_CONCURRENT_COUNT_QUERIES at a time.
+  The sequence counts every later write of the publisher, including changed
+  and deleted ratings, so it can be higher than the count query, see
+  rating_sequence.
+
+  Args:
+    unified_ratings: Ratings as returned by GetUnifiedRatings.
+
+  Returns:
+    A list with a number for each rating.
+  """
+  sources = [
+      Source(r['type'], r['publisher_id'], r['publisher_category_id'])
+      for r in unified_ratings
+  ]
+  numbered = [
+      r.get('sequence_number') is not None for r in unified_ratings
+  ]
+  last_numbers_future = rating_sequence.GetLastAsync(
+      source.RatingSequenceKey()
+      for source, is_numbered in zip(sources, numbered)
+      if is_numbered)
+  counted = [i for i, is_numbered in enumerate(numbered) if not is_numbered]
+  counts = {}
+  for start in range(0, len(counted), MAX_CONCURRENT_COUNT_QUERIES):
+    indexes = counted[start:start + MAX_CONCURRENT_COUNT_QUERIES]
+    batch = yield [
+        sources[i].GetNumRatingsSinceDateAsync(unified_ratings[i]['date'])
+        for i in indexes
+    ]
+    counts.update(zip(indexes, batch))
+  last_numbers = yield last_numbers_future
+  result = []
+  for i, (source, r) in enumerate(zip(sources, unified_ratings)):
+    if numbered[i]:
+      num_ratings = (
+          last_numbers[source.RatingSequenceKey()] - r['sequence_number'])
+    else:
+      # The count includes this rating.
+      num_ratings = counts[i] - 1
+    result.append(max(num_ratings, 0))
+  raise ndb.Return(result)
+
+
+def BackfillRatingSequenceNumbers(user_key):
+  """Numbers the PageRatings of a user that were added without a number."""
+  by_category = {}
+  for page_rating in PageRating.query(ancestor=user_key):
+    by_category.setdefault(page_rating.category, []).append(page_rating)
+  for page_ratings in by_category.itervalues():
+    numbered = rating_sequence.BackfillNumbers(page_ratings, lambda r: r.date)
+    ndb.put_multi(numbered)
+    InvalidateUnifiedRatings(r.url for r in numbered)
+
+
+class UrlRatingStats(ndb.Model):
+  """The summary of the sources of a url. Keyed by url.
+
+  It is calculated from the ratings the first time it is needed and then
+  updated by tasks as ratings and feed items of the url are added. Updates
+  that ran before the first calculation are lost, and the ratings query may
+  not have seen the latest ratings yet, so it is calculated once more by the
+  first read after recount_after.
+  """
+  # The number of users who rated the url positively.
+  user_count = ndb.IntegerProperty(default=0, indexed=False)
+  # The deduplicated feeds that published the url.
+  feed_urls = ndb.StringProperty(repeated=True, indexed=False)
+  # None once the stats were calculated for the second time.
+  recount_after = ndb.DateTimeProperty(indexed=False)
+
+  def ToDict(self):
+    return {
+        'user_count': self.user_count,
+        'feed_count': len(self.feed_urls),
+        'top_feeds': self.feed_urls[:MAX_STATS_TOP_FEEDS],
+    }
+
+
+# The number of feeds is not counted beyond this.
+MAX_STATS_FEEDS = 1000
+# How long after the first calculation of UrlRatingStats they are calculated
+# again, by then the ratings query sees the ratings that were added before.
+RATING_STATS_RECOUNT_DELAY = timedelta(minutes=1)
+
+
+def _PositiveCount(page_rating):
+  if page_rating is not None and page_rating.rating == ratings.POSITIVE:
+    return 1
+  return 0
+
+
+def _CalculateRatingStats(url, do_not_fetch):
   feeds_urls = []
-  stats = {'user_count': 0}
-  # Get existing ratings before we the new rating is added so we can tell who
-  # this user will be connecting to.
-  for r in GetUnifiedRatings(url, do_not_fetch=do_not_fetch):
+  user_count = 0
+  for r in GetUnifiedRatings(
+      url, do_not_fetch=do_not_fetch, limit=MAX_STATS_RATINGS):
     if r['type'] == SOURCE_TYPE_FEED:
       feeds_urls.append(r['publisher_id'])
     # We only want to tell about the number of users who rated positively.
     if r['type'] == SOURCE_TYPE_USER and r['rating'] == ratings.POSITIVE:
-      stats['user_count'] += 1
-  feeds_urls = url_util.DeduplicateUrls(feeds_urls)
-  stats['feed_count'] = len(feeds_urls)
-  stats['top_feeds'] = feeds_urls[:MAX_STATS_TOP_FEEDS]
-  return stats
+      user_count += 1
+  return UrlRatingStats(
+      user_count=user_count,
+      feed_urls=url_util.DeduplicateUrls(feeds_urls)[:MAX_STATS_FEEDS])
+
+
+def GetRatingStats(url, do_not_fetch=False):
+  """Returns summary of sources of a url."""
+  key = ndb.Key(UrlRatingStats, url)
+  stats = key.get()
+  now = datetime.now()
+  if stats is None or (stats.recount_after is not None and
+                       stats.recount_after <= now):
+    # The cached ratings may be older than the stats.
+    InvalidateUnifiedRatings([url])
+    calculated = _CalculateRatingStats(url, do_not_fetch)
+
+    def Store():
+      current = key.get()
+      if current is None:
+        calculated.recount_after = now + RATING_STATS_RECOUNT_DELAY
+      elif current.recount_after is not None and current.recount_after <= now:
+        calculated.feed_urls = url_util.DeduplicateUrls(
+            calculated.feed_urls + current.feed_urls)[:MAX_STATS_FEEDS]
+      else:
+        # Another request stored the stats first.
+        return current
+      calculated.key = key
+      calculated.put()
+      return calculated
+
+    stats = ndb.transaction(Store)
+  return stats.ToDict()
+
+
+def UpdateUrlRatingStats(url, user_count_delta=0, feed_url=None):
+  UpdateUrlRatingStatsMulti([url], user_count_delta, feed_url)
+
+
+def UpdateUrlRatingStatsMulti(urls, user_count_delta=0, feed_url=None):
+  """Updates the stats of urls after a rating or feed item was added.
+
+  Stats that were not calculated yet are left alone, they will include the
+  change when they are calculated.
+
+  Args:
+    urls: The urls whose stats changed.
+    user_count_delta: The change of the number of positive user ratings.
+    feed_url: The feed that published the urls, if any.
+  """
+
+  @ndb.tasklet
+  def UpdateAsync(url):
+    stats = yield ndb.Key(UrlRatingStats, url).get_async()
+    if stats is None:
+      return
+    stats.user_count = max(stats.user_count + user_count_delta, 0)
+    if (feed_url is not None and len(stats.feed_urls) < MAX_STATS_FEEDS and
+        len(url_util.DeduplicateUrls(stats.feed_urls + [feed_url])) > len(
+            stats.feed_urls)):
+      stats.feed_urls.append(feed_url)
+    yield stats.put_async()
+
+  futures = [
+      ndb.transaction_async(functools.partial(UpdateAsync, url))
+      for url in set(urls)
+  ]
+  for future in futures:
+    future.get_result()
 
 
 def UpdateRatedItemIdsCache(user_id):
   UpdateRatedItemIdsAsync(user_id).get_result()
+  # Rated items are excluded from recommendations. We invalidate them only
+  # after the rated items are updated, otherwise they could be recalculated
+  # and cached with the old rated items.
+  recommendation_cache.BumpGeneration(user_id)
 
 
 def GetUserRatedItemsCacheKey(user_id):
@@ -1158,9 +1604,21 @@ def GetConnectionInfo(user_id):
 
 
 def DeleteRating(user, url):
+  """Deletes the rating of a user and returns it, None if there was none."""
   user_key = UserKey(user)
-  ndb.Key(PageRating, url, parent=user_key).delete()
+  key = ndb.Key(PageRating, url, parent=user_key)
+
+  def Delete():
+    page_rating = key.get()
+    if _PositiveCount(page_rating):
+      deferred.defer(UpdateUrlRatingStats, url, -1, _transactional=True)
+    key.delete()
+    return page_rating
+
+  page_rating = ndb.transaction(Delete)
+  InvalidateUnifiedRatings([url])
   deferred.defer(UpdateRatedItemIdsCache, user_key.id())
+  return page_rating
 
 
 def AddCategory(user, name):
@@ -1190,8 +1648,7 @@ def RemoveCategory(user, category_id):
   category_key.delete()
   for p in PageRating.query(
       PageRating.category == category_key, ancestor=UserKey(user)).fetch():
-    p.category = None
-    p.put()
+    SetRatingCategory(p, None)
 
 
 def SetPageCategory(user, url, category_id, retries_left=10):
@@ -1208,8 +1665,7 @@ def SetPageCategory(user, url, category_id, retries_left=10):
   if category_id is not None:
     category = CategoryKey(category_id, user)
 
-  page_rating.category = category
-  page_rating.put()
+  SetRatingCategory(page_rating, category)
 
 
 DEFAULT_CATEGORY_ID = 1
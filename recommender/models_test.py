@@ -0,0 +1,281 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from recommender import items
+from recommender import models
+from recommender import url_util
+
+URL = 'http://example.com/page'
+
+
+class UnifiedRatingsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    self.testbed.init_search_stub()
+    self.testbed.init_urlfetch_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    models.PageInfo(
+        key=ndb.Key(models.PageInfo, URL), url=URL, title=URL,
+        canonical_url=URL).put()
+    self.start = datetime(2020, 1, 2)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Rate(self, user_id, minutes, rating=1):
+    models.AddRatingAtTime(user_id, URL, rating, 'fake_source', None,
+                           self.start + timedelta(minutes=minutes))
+
+  def Publishers(self, **kwargs):
+    return [r['publisher_id'] for r in models.GetUnifiedRatings(URL, **kwargs)]
+
+  def testSortedByDate(self):
+    self.Rate('2', 2)
+    self.Rate('1', 1)
+    self.Rate('3', 3, rating=0)
+    self.assertEqual(['1', '2'], self.Publishers())
+
+  def testLimit(self):
+    for minutes in range(5):
+      self.Rate(str(minutes), minutes)
+    self.assertEqual(['3', '4'], self.Publishers(limit=2))
+    self.assertEqual(['0', '1', '2', '3', '4'], self.Publishers())
+
+  def testCacheIsInvalidated(self):
+    self.Rate('1', 1)
+    self.assertEqual(['1'], self.Publishers())
+    self.Rate('2', 2)
+    self.assertEqual(['1', '2'], self.Publishers())
+    models.DeleteRating('1', URL)
+    self.assertEqual(['2'], self.Publishers())
+
+  def testCachedRatingsHaveTheUrl(self):
+    self.Rate('1', 1)
+    self.Publishers()
+    self.assertEqual([URL],
+                     [r['url'] for r in models.GetUnifiedRatings(URL)[:1]])
+
+  def testTooManyRatingsAreNotCached(self):
+    self.Rate('1', 1)
+    max_value_size = memcache.MAX_VALUE_SIZE
+    memcache.MAX_VALUE_SIZE = 10
+    try:
+      self.assertEqual(['1'], self.Publishers())
+    finally:
+      memcache.MAX_VALUE_SIZE = max_value_size
+    self.assertIsNone(memcache.get(models.UNIFIED_RATINGS_CACHE_PREFIX + URL))
+
+
+class RatingStatsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    self.testbed.init_search_stub()
+    self.testbed.init_urlfetch_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    models.PageInfo(
+        key=ndb.Key(models.PageInfo, URL), url=URL, title=URL,
+        canonical_url=URL).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def RunAllTasks(self):
+    while True:
+      tasks = self.taskqueue.get_filtered_tasks()
+      if not tasks:
+        break
+      for task in tasks:
+        deferred.run(task.payload)
+        self.taskqueue.DeleteTask(task.headers['X-AppEngine-QueueName'],
+                                  task.headers['X-AppEngine-TaskName'])
+
+  def Rate(self, user_id, rating):
+    stats = models.AddRating(user_id, URL, rating, 'fake_source', None)
+    self.RunAllTasks()
+    return stats
+
+  def testReturnsStatsFromBeforeTheRating(self):
+    self.assertEqual(0, self.Rate('1', 1)['user_count'])
+    self.assertEqual(1, self.Rate('2', 1)['user_count'])
+    self.assertEqual(2, self.Rate('3', -1)['user_count'])
+    # Changing a rating updates the count.
+    self.assertEqual(2, self.Rate('1', -1)['user_count'])
+    self.assertEqual(1, models.GetRatingStats(URL)['user_count'])
+
+  def testDeleteRating(self):
+    self.Rate('1', 1)
+    self.Rate('2', 1)
+    models.DeleteRating('1', URL)
+    self.RunAllTasks()
+    self.assertEqual(1, models.GetRatingStats(URL)['user_count'])
+
+  def testRecountsTheFirstStats(self):
+    self.Rate('1', 1)
+    # The stats were calculated before the update of a rating was seen.
+    models.UrlRatingStats(
+        id=URL,
+        user_count=0,
+        feed_urls=['http://feed'],
+        recount_after=datetime.now() - timedelta(seconds=1)).put()
+    stats = models.GetRatingStats(URL)
+    self.assertEqual(1, stats['user_count'])
+    self.assertEqual(1, stats['feed_count'])
+    self.assertIsNone(ndb.Key(models.UrlRatingStats, URL).get().recount_after)
+    # Recounted stats are only updated by the tasks.
+    models.UrlRatingStats(id=URL, user_count=5).put()
+    self.assertEqual(5, models.GetRatingStats(URL)['user_count'])
+
+  def testFeeds(self):
+    self.Rate('1', 1)
+    models.UpdateUrlRatingStatsMulti([URL], feed_url='http://feed')
+    models.UpdateUrlRatingStatsMulti([URL], feed_url='https://www.feed/')
+    stats = models.GetRatingStats(URL)
+    self.assertEqual(1, stats['feed_count'])
+    self.assertEqual(['http://feed'], stats['top_feeds'])
+
+
+
+class PageFetchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.get_page_metadata = url_util.GetPageMetadataAsync
+    url_util.GetPageMetadataAsync = self.GetPageMetadataAsync
+    self.fetched_urls = []
+    self.error = ValueError('bad page')
+    self.in_flight = 0
+    self.max_in_flight = 0
+
+  def tearDown(self):
+    url_util.GetPageMetadataAsync = self.get_page_metadata
+    self.testbed.deactivate()
+
+  @ndb.tasklet
+  def GetPageMetadataAsync(self, url):
+    self.fetched_urls.append(url)
+    self.in_flight += 1
+    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    yield ndb.sleep(0.01)
+    self.in_flight -= 1
+    if self.error:
+      raise self.error
+    metadata = url_util.PageMetadata()
+    metadata.title = 'Title'
+    metadata.canonical_url = url
+    metadata.final_url = url
+    metadata.description = None
+    metadata.feed_url = None
+    metadata.feed_title = None
+    metadata.is_feed = False
+    metadata.estimated_reading_time = 1
+    raise ndb.Return(metadata)
+
+  def testFailedUrlIsNotFetchedAgain(self):
+    self.assertEqual(URL, models.GetPageInfo(URL).title)
+    self.assertEqual(URL, models.GetPageInfo(URL).title)
+    self.assertEqual([URL], self.fetched_urls)
+
+    failure = ndb.Key(models.PageFetchFailure, URL).get()
+    self.assertEqual(models.FAILURE_VALUE_ERROR, failure.kind)
+    self.assertEqual(1, failure.attempts)
+
+  def testInvalidUrlIsNotRetried(self):
+    self.error = url_util.InvalidURLError('invalid')
+    with self.assertRaises(url_util.InvalidURLError):
+      models.GetCanonicalUrl(URL)
+    with self.assertRaises(url_util.InvalidURLError):
+      models.GetCanonicalUrl(URL)
+    self.assertEqual([URL], self.fetched_urls)
+    self.assertIsNone(ndb.Key(models.PageFetchFailure, URL).get().next_retry)
+
+  def testRetryHealsPlaceholder(self):
+    self.error = url_util.Error('timeout')
+    models.GetPageInfo(URL)
+    models.RetryFailedPageFetches()
+    self.assertEqual([URL], self.fetched_urls)
+
+    failure = ndb.Key(models.PageFetchFailure, URL).get()
+    failure.next_retry = datetime.now() - timedelta(minutes=1)
+    failure.put()
+    models.RetryFailedPageFetches()
+    self.assertEqual(2, ndb.Key(models.PageFetchFailure, URL).get().attempts)
+
+    failure = ndb.Key(models.PageFetchFailure, URL).get()
+    failure.next_retry = datetime.now() - timedelta(minutes=1)
+    failure.put()
+    self.error = None
+    models.RetryFailedPageFetches()
+    self.assertEqual([URL] * 3, self.fetched_urls)
+    self.assertEqual('Title', models.GetPageInfo(URL).title)
+    self.assertIsNone(ndb.Key(models.PageFetchFailure, URL).get())
+
+  def testRetrySkipsUrlsThatAreNotRetried(self):
+    self.addCleanup(setattr, models, 'PAGE_FETCH_RETRIES_PER_RUN',
+                    models.PAGE_FETCH_RETRIES_PER_RUN)
+    models.PAGE_FETCH_RETRIES_PER_RUN = 1
+    invalid_url = URL + '/invalid'
+    models.PageFetchFailure(
+        key=ndb.Key(models.PageFetchFailure, invalid_url),
+        kind=models.FAILURE_INVALID_URL,
+        attempts=1,
+        next_retry=None).put()
+    models.PageFetchFailure(
+        key=ndb.Key(models.PageFetchFailure, URL),
+        kind=models.FAILURE_FETCH_ERROR,
+        attempts=1,
+        next_retry=datetime.now() - timedelta(minutes=1)).put()
+    self.error = None
+
+    models.RetryFailedPageFetches()
+    self.assertEqual([URL], self.fetched_urls)
+    self.assertIsNone(ndb.Key(models.PageFetchFailure, URL).get())
+
+  def testPagesAreFetchedConcurrently(self):
+    self.error = None
+    urls = ['%s/%d' % (URL, i) for i in range(30)]
+    page_infos = models.GetBulkPageInfo(urls)
+
+    self.assertEqual(set(urls), set(page_infos))
+    self.assertEqual('Title', page_infos[urls[0]]['title'])
+    self.assertEqual(models.MAX_CONCURRENT_PAGE_FETCHES, self.max_in_flight)
+
+
+if __name__ == '__main__':
+  unittest.main()
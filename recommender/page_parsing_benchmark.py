@@ -0,0 +1,96 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares parsing pages into a tree with the incremental head and text parsers.
+
+For every page it reports the time to get the head metadata and the reading
+time, and the peak memory of a process that does only that. Without
+arguments it uses a generated page with a large body.
+
+Usage: python -m recommender.page_parsing_benchmark [page.html ...]
+"""
+
+from __future__ import print_function
+
+import os
+import resource
+import sys
+import timeit
+
+import lxml.html
+
+from recommender import html_head
+from recommender import reading_time_estimator
+
+REPEATS = 3
+
+
+def GeneratedPage():
+  paragraph = '<p>%s<a href="/link">a link</a> %s</p>\n' % ('Some text. ' * 40,
+                                                           'More text. ' * 20)
+  return ('<html><head><title>Title</title>'
+          '<meta name="description" content="Description">'
+          '<link rel="canonical" href="/page"></head><body>' +
+          paragraph * 20000 + '</body></html>')
+
+
+def ParseTree(content):
+  tree = lxml.html.fromstring(content)
+  return (tree.findtext('.//head/title'), reading_time_estimator.Estimate(tree))
+
+
+def ParseIncrementally(content):
+  return (html_head.Parse(content).title,
+          reading_time_estimator.EstimateContent(content))
+
+
+def PeakMemoryKb(parse, content):
+  """Returns how much the peak memory of a child process grows in kB."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    parse(content)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    os.write(write_fd, str(after - before))
+    os._exit(0)  # pylint: disable=protected-access
+  os.close(write_fd)
+  result = int(os.read(read_fd, 100))
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  return result
+
+
+def Measure(name, content):
+  results = [ParseTree(content), ParseIncrementally(content)]
+  assert results[0] == results[1], results
+  print('%s: %d kB' % (name, len(content) // 1024))
+  for label, parse in (('tree', ParseTree), ('incremental', ParseIncrementally)):
+    seconds = min(
+        timeit.repeat(lambda: parse(content), number=1, repeat=REPEATS))
+    print('  %s: %.1f ms, peak memory +%d kB' %
+          (label, seconds * 1000, PeakMemoryKb(parse, content)))
+
+
+def main():
+  if len(sys.argv) > 1:
+    for path in sys.argv[1:]:
+      with open(path, 'rb') as f:
+        Measure(path, f.read())
+  else:
+    Measure('generated page', GeneratedPage())
+
+
+if __name__ == '__main__':
+  main()
@@ -23,6 +23,7 @@ from google.appengine.ext import ndb
 from recommender import config
 from recommender import items
 from recommender import models
+from recommender import recommendation_cache
 from recommender import time_periods
 
 TIME_TO_COMMIT_PAST_RECOMMENDATIONS = timedelta(
@@ -113,6 +114,7 @@ def _CommitPastRecommendations(user_id, time_period_numeric, save_time):
       new_item_ids).get_result()
   _UpdatePastRecommendationItemIdsCacheAsync(user_id, None,
                                              new_item_ids).get_result()
+  recommendation_cache.BumpGeneration(user_id)
 
 
 PAST_RECOMMENDATIONS_LIMIT = 6000
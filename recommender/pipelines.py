@@ -19,6 +19,8 @@ from datetime import datetime
 from datetime import timedelta
 import logging
 import pickle
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from mapreduce import base_handler
 from mapreduce import control as mr_control
 from mapreduce import mapper_pipeline
@@ -27,11 +29,20 @@ from pipeline import pipeline
 import webapp2
 
 from recommender import config
+from recommender import feeds
+from recommender import items
+from recommender import migrations
 from recommender import models
 from recommender import recommendations
+from recommender import replay_trainer
 
 DEFAULT_SHARDS = 10 if not config.IsDev() else 1
 
+SCHEDULE_FEEDS_STARTED_CACHE_KEY = 'msf:'
+# The feed scheduling migration is started again after this long in case its
+# pipeline failed.
+SCHEDULE_FEEDS_RESTART_INTERVAL = timedelta(hours=6)
+
 
 def StartDatetimeFromContext():
   return LoadFromContext('start_datetime')
@@ -61,6 +72,18 @@ class MapperPipeline(SelfCleaningPipeline):
         shards=DEFAULT_SHARDS)
 
 
+class MigrationPipeline(SelfCleaningPipeline):
+  """Runs the mapper of a migration and records that the migration finished."""
+
+  def run(self, name, entity_type, map_fn):
+    yield MapperPipeline(name, entity_type, map_fn)
+
+  def finalized(self):
+    if not self.was_aborted:
+      migrations.SetFinished(self.args[0])
+      self.cleanup()
+
+
 def CreateAdminHandler(callable_fn):
 
   def Call(req):
@@ -87,6 +110,12 @@ def AddMapperPipeline(name, entity_type, map_fn):
                                        FullName(map_fn)).start())
 
 
+def AddMigrationPipeline(name, entity_type, map_fn):
+  AddHandler(
+      name, lambda req: MigrationPipeline(name, FullName(entity_type),
+                                          FullName(map_fn)).start())
+
+
 def LoadFromContext(name):
   params = mr_control.handlers.context.get().mapreduce_spec.mapper.params
   return pickle.loads(params[name])
@@ -198,6 +227,69 @@ AddMapperPipeline('cron/update_active_connection_state', models.Connection,
                   UpdateActiveConnectionStateMap)
 
 
-AddHandler('cron/update_feeds', lambda req: recommendations.UpdateAllFeeds())
+def BackfillUserRatingSequenceNumbersMap(user):
+  models.BackfillRatingSequenceNumbers(user.key)
+
+
+def BackfillFeedItemSequenceNumbersMap(feed):
+  models.InvalidateUnifiedRatings(
+      item.url for item in feeds.BackfillSequenceNumbers(feed))
+
+
+AddMapperPipeline('backfill_user_rating_sequence_numbers', models.User,
+                  BackfillUserRatingSequenceNumbersMap)
+AddMapperPipeline('backfill_feed_item_sequence_numbers', feeds.Feed,
+                  BackfillFeedItemSequenceNumbersMap)
+AddMigrationPipeline(migrations.URL_TO_ITEM, items.Item, items.AddUrlToItem)
+AddMigrationPipeline(migrations.FEED_ITEM_KEYS, feeds.Feed,
+                     feeds.MigrateItemKeys)
+
+
+def ScheduleFeedMap(feed):
+  if feed.next_update is None:
+    feed.next_update = datetime.now()
+    feed.put()
+
+
+AddMigrationPipeline(migrations.SCHEDULE_FEEDS, feeds.Feed, ScheduleFeedMap)
+
+
+def UpdateDueFeeds():
+  # Feeds that were added before next_update existed are not due until the
+  # migration has scheduled them, so it is started until it has finished.
+  if (not migrations.IsFinished(migrations.SCHEDULE_FEEDS) and
+      memcache.add(SCHEDULE_FEEDS_STARTED_CACHE_KEY, True,
+                   SCHEDULE_FEEDS_RESTART_INTERVAL.total_seconds())):
+    MigrationPipeline(migrations.SCHEDULE_FEEDS, FullName(feeds.Feed),
+                      FullName(ScheduleFeedMap)).start()
+  recommendations.UpdateDueFeeds()
+
+
+AddHandler('cron/update_due_feeds', lambda req: UpdateDueFeeds())
+AddHandler('cron/retry_failed_page_fetches',
+           lambda req: models.RetryFailedPageFetches())
+
+
+def UpdateFeedActiveConnectionsMap(feed):
+  has_active_connections = models.Connection.query(
+      models.Connection.publisher_id == feed.GetUrl(),
+      models.Connection.version == models.LOGISTIC_REGRESSION_CONNECTION,
+      models.Connection.positive == True).get(keys_only=True) is not None
+
+  @ndb.transactional
+  def Update():
+    current = feed.key.get()
+    if current.has_active_connections != has_active_connections:
+      current.has_active_connections = has_active_connections
+      current.has_active_connections_updated = datetime.now()
+      current.put()
+
+  Update()
+
+
+AddMapperPipeline('cron/update_feed_active_connections', feeds.Feed,
+                  UpdateFeedActiveConnectionsMap)
+
+AddHandler('replay_connections', lambda req: replay_trainer.StartReplay())
 
 application = webapp2.WSGIApplication(routes, debug=True)
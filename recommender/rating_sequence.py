@@ -0,0 +1,113 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Numbers the ratings of every source in the order they are written.
+
+Every source (a user category or a feed) has a RatingSequence with the last
+number given to one of its ratings. A PageRating or FeedItem gets the next
+number when it is written, so the number of ratings a source made after one of
+its ratings is the last number minus the number of that rating.
+
+Numbers are never given back, so this counts every write after the rating:
+changing a rating again, including to neutral, and ratings that were deleted
+since are counted too. A count of the ratings that exist now, as the count
+query of models.Source did, counts a page that was rated again once and a
+deleted rating not at all.
+
+Ratings written before the numbers existed are numbered by the backfill with
+numbers up to 0 in date order, so they do not need a RatingSequence.
+"""
+
+from google.appengine.ext import ndb
+
+_DEFAULT_CATEGORY_SEQUENCE_ID = 'default'
+
+
+class RatingSequence(ndb.Model):
+  last = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def UserSequenceKey(user_key, category_key):
+  """The key of the sequence of a user category.
+
+  It is in the entity group of the user so that it can be updated in the same
+  transaction as a PageRating.
+
+  Args:
+    user_key: The key of the user.
+    category_key: The key of the category, None for the default category.
+
+  Returns:
+    The key.
+  """
+  if category_key is None:
+    return ndb.Key(RatingSequence, _DEFAULT_CATEGORY_SEQUENCE_ID,
+                   parent=user_key)
+  return ndb.Key(RatingSequence, category_key.id(), parent=user_key)
+
+
+def FeedSequenceKey(feed_url):
+  return ndb.Key(RatingSequence, feed_url)
+
+
+def AllocateInTransaction(key, count=1):
+  """Reserves count numbers and returns the first one.
+
+  Must be called in a transaction that includes the entity group of key.
+  """
+  sequence = key.get() or RatingSequence(key=key)
+  first = sequence.last + 1
+  sequence.last += count
+  sequence.put()
+  return first
+
+
+def Allocate(key, count=1):
+  return ndb.transaction(lambda: AllocateInTransaction(key, count))
+
+
+def GetLast(keys):
+  return GetLastAsync(keys).get_result()
+
+
+@ndb.tasklet
+def GetLastAsync(keys):
+  """Returns a dict with the last number of each of the sequences."""
+  keys = list(set(keys))
+  sequences = yield ndb.get_multi_async(keys)
+  raise ndb.Return({
+      key: sequence.last if sequence else 0
+      for key, sequence in zip(keys, sequences)
+  })
+
+
+def BackfillNumbers(entities, date):
+  """Numbers the entities that do not have a number yet.
+
+  The entities must be all the ratings of one source. The ones without a
+  sequence number are numbered in date order with numbers up to 0, which are
+  lower than the numbers of all the ratings that were numbered when they were
+  written.
+
+  Args:
+    entities: PageRatings or FeedItems with a sequence_number property.
+    date: Returns the date of an entity.
+
+  Returns:
+    The entities that were numbered.
+  """
+  missing = sorted((e for e in entities if e.sequence_number is None),
+                   key=date)
+  for index, entity in enumerate(missing):
+    entity.sequence_number = index + 1 - len(missing)
+  return missing
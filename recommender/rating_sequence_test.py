@@ -0,0 +1,89 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import unittest
+
+from recommender import items
+from recommender import models
+from recommender import rating_sequence
+
+from google.appengine.ext import testbed
+
+
+class RatingSequenceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    self.testbed.init_search_stub()
+    self.testbed.init_urlfetch_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.start = datetime(2020, 1, 2)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Rate(self, url, minutes):
+    models.AddRatingAtTime('1', url, 1, 'fake_source', None,
+                           self.start + timedelta(minutes=minutes))
+
+  def UnifiedRatings(self, urls):
+    return [
+        models.UserRatingToUnified(
+            models.PageRating.query(models.PageRating.url == url).get())
+        for url in urls
+    ]
+
+  def testAllocate(self):
+    key = rating_sequence.FeedSequenceKey('http://feed')
+    self.assertEqual(1, rating_sequence.Allocate(key))
+    self.assertEqual(2, rating_sequence.Allocate(key, 3))
+    self.assertEqual(5, rating_sequence.GetLast([key])[key])
+
+  def testSameAsCountQuery(self):
+    for minutes, url in enumerate(['http://a', 'http://b', 'http://c']):
+      self.Rate(url, minutes)
+    unified_ratings = self.UnifiedRatings(['http://a', 'http://b', 'http://c'])
+    self.assertEqual([2, 1, 0], models.GetNumRatingsAfter(unified_ratings))
+
+    for r in unified_ratings:
+      del r['sequence_number']
+    self.assertEqual([2, 1, 0], models.GetNumRatingsAfter(unified_ratings))
+
+  def testBackfill(self):
+    self.Rate('http://a', 0)
+    self.Rate('http://b', 1)
+    # Make it look like the ratings were added before they were numbered.
+    for page_rating in models.PageRating.query():
+      page_rating.sequence_number = None
+      page_rating.put()
+    rating_sequence.UserSequenceKey(models.UserKey('1'), None).delete()
+    self.Rate('http://c', 2)
+
+    models.BackfillRatingSequenceNumbers(models.UserKey('1'))
+    self.assertEqual(
+        [2, 1, 0],
+        models.GetNumRatingsAfter(
+            self.UnifiedRatings(['http://a', 'http://b', 'http://c'])))
+
+
+if __name__ == '__main__':
+  unittest.main()
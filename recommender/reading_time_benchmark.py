@@ -0,0 +1,117 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Times the reading time estimators on a corpus of saved html pages.
+
+Estimate walks a parsed tree once and is checked against the previous
+estimator, which collected all text nodes with an xpath query: both must give
+the same estimate for every page. EstimateContent parses incrementally and
+does not count text inside the children of head or after the end of html, so
+its differences are reported instead of failing. Without arguments it uses
+generated pages.
+
+Usage: python -m recommender.reading_time_benchmark [page.html ...]
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import math
+import sys
+import timeit
+
+import lxml.html
+
+from recommender import reading_time_estimator
+
+REPEATS = 5
+
+
+def EstimateWithXpath(tree):
+  """The estimator before the single walk, kept as the reference."""
+  texts = tree.xpath('//text()')
+  filtered_texts = [text for text in texts if _IsVisible(text)]
+  stripped_texts = [unicode(text).strip() for text in filtered_texts]
+  return int(
+      math.ceil(
+          sum(len(text) for text in stripped_texts) /
+          reading_time_estimator.CHARACTERS_PER_MINUTE))
+
+
+def _IsVisible(element):
+  if not isinstance(element.getparent().tag, basestring):
+    return False
+  if element.getparent().tag in [
+      'style', 'script', '[document]', 'head', 'title'
+  ]:
+    return False
+  if len(unicode(element).strip()) < 15:
+    return False
+  return True
+
+
+def GeneratedPages():
+  paragraph = ('<p>%s<a href="/link">a link</a> %s<!-- comment --> %s</p>'
+               '<script>var x = "a script that is long enough";</script>\n')
+  for num_paragraphs in (10, 1000, 20000):
+    yield 'generated %d paragraphs' % num_paragraphs, (
+        '<html><head><title>Title of the page</title>'
+        '<style>p { color: black; }</style></head><body>' + paragraph %
+        ('Some text. ' * 40, 'More text. ' * 20, 'A tail of a comment.') *
+        num_paragraphs + '</body></html>')
+
+
+def Measure(name, content):
+  tree = lxml.html.fromstring(content)
+  expected = EstimateWithXpath(tree)
+  actual = reading_time_estimator.Estimate(tree)
+  assert expected == actual, (name, expected, actual)
+  incremental = reading_time_estimator.EstimateContent(content)
+  if incremental != actual:
+    print('%s: single walk estimates %d minutes, incremental %d' %
+          (name, actual, incremental))
+  times = [
+      min(timeit.repeat(lambda: estimate(tree), number=1, repeat=REPEATS))
+      for estimate in (EstimateWithXpath, reading_time_estimator.Estimate)
+  ]
+  # The incremental estimator is timed with parsing, the others without it.
+  times.append(
+      min(
+          timeit.repeat(
+              lambda: reading_time_estimator.EstimateContent(content),
+              number=1,
+              repeat=REPEATS)))
+  print('%s: %d minutes, xpath %.2f ms, single walk %.2f ms, '
+        'parse and count incrementally %.2f ms' %
+        (name, actual, times[0] * 1000, times[1] * 1000, times[2] * 1000))
+  return times
+
+
+def main():
+  if len(sys.argv) > 1:
+    pages = []
+    for path in sys.argv[1:]:
+      with open(path, 'rb') as f:
+        pages.append((path, f.read()))
+  else:
+    pages = GeneratedPages()
+  totals = [0, 0, 0]
+  for name, content in pages:
+    for index, seconds in enumerate(Measure(name, content)):
+      totals[index] += seconds
+  print('total: xpath %.1f ms, single walk %.1f ms, incremental %.1f ms' %
+        (totals[0] * 1000, totals[1] * 1000, totals[2] * 1000))
+
+
+if __name__ == '__main__':
+  main()
@@ -16,56 +16,137 @@ from __future__ import division
 import math
 
 import urllib
-import lxml.html.soupparser
+import lxml.etree
+import lxml.html
+
+from recommender import html_head
 
 # The average number of characters per minute a person can read.
 # Source:
 # https://en.wikipedia.org/wiki/Words_per_minute#Reading_and_comprehension
 CHARACTERS_PER_MINUTE = 860
+# Shorter texts are not counted, they are usually menus and buttons.
+MIN_VISIBLE_TEXT_LENGTH = 15
+_INVISIBLE_TAGS = frozenset(['style', 'script', '[document]', 'head', 'title'])
+# EstimateContent feeds the page to the parser in chunks of this many bytes.
+CHUNK_SIZE = 16 * 1024
 
 
 def Estimate(tree):
   """Estimates how much time it takes to read a page.
 
+  Counts the visible text of the whole document of tree in one walk. A text
+  is visible when it is long enough and the element that holds it, as its
+  text or as its tail, is not one of _INVISIBLE_TAGS.
+
   Args:
     tree: A parsed page tree.
 
   Returns:
     Estimated time in minutes.
   """
-  texts = tree.xpath('//text()')
-  filtered_texts = [text for text in texts if _IsVisible(text)]
-  stripped_texts = [unicode(text).strip() for text in filtered_texts]
+  count = 0
+  # Only elements hold visible text, comments and processing instructions are
+  # skipped by the iterator.
+  for element in tree.getroottree().getroot().iter(lxml.etree.Element):
+    if element.tag not in _INVISIBLE_TAGS:
+      count += _TextLength(element.text) + _TextLength(element.tail)
+  # Round up the result because nothing is 0-minutes long.
+  return int(math.ceil(count / CHARACTERS_PER_MINUTE))
+
+
+def EstimateContent(content, encoding=None):
+  """Estimates how much time it takes to read a page without its tree.
+
+  The page is parsed incrementally and its visible text is counted in the
+  same pass. A text is visible when it is long enough, the element that holds
+  it, as its text or as its tail, is not one of _INVISIBLE_TAGS and it is not
+  inside one of them. Every element is removed as soon as its text and tail
+  have been counted, so only the path to the element being parsed is kept in
+  memory.
 
+  The estimate can be lower than the one of Estimate: text inside the children
+  of head, such as noscript, is not counted, and the incremental parser drops
+  everything after the end tag of html, which the tree parser moves into the
+  document.
+
+  Args:
+    content: The bytes of the page.
+    encoding: The charset of the page or None to detect it.
+
+  Returns:
+    Estimated time in minutes.
+  """
+  parser = lxml.etree.HTMLPullParser(events=('start', 'end'), encoding=encoding)
+  counter = _VisibleCharacterCounter()
+  for chunk in html_head.Chunks(content, CHUNK_SIZE):
+    parser.feed(chunk)
+    counter.Count(parser.read_events())
+  parser.close()
+  counter.Count(parser.read_events())
   # Round up the result because nothing is 0-minutes long.
-  return int(
-      math.ceil(_CountCharacters(stripped_texts) / CHARACTERS_PER_MINUTE))
+  return int(math.ceil(counter.count / CHARACTERS_PER_MINUTE))
+
+
+class _VisibleCharacterCounter(object):
+  """Counts the visible text of parsed elements and removes them.
+
+  The visibility of a tail depends on the element it trails. A tail is
+  complete when the next sibling starts or when the parent ends.
+  """
 
+  def __init__(self):
+    self.count = 0
+    # The number of open elements that are one of _INVISIBLE_TAGS.
+    self._invisible_depth = 0
 
-def _IsVisible(element):
-  if not isinstance(element.getparent().tag, basestring):
-    return False
-  if element.getparent().tag in [
-      'style', 'script', '[document]', 'head', 'title'
-  ]:
-    return False
-  if len(unicode(element).strip()) < 15:
-    return False
-  return True
+  def Count(self, events):
+    """Counts the text that events completed.
 
+    Args:
+      events: The start and end events of a HTMLPullParser.
+    """
+    for action, element in events:
+      if action == 'start':
+        parent = element.getparent()
+        if parent is not None:
+          previous = element.getprevious()
+          while previous is not None:
+            self._CountVisible(previous, previous.tail)
+            parent.remove(previous)
+            previous = element.getprevious()
+        if element.tag in _INVISIBLE_TAGS:
+          self._invisible_depth += 1
+      else:
+        self._CountVisible(element, element.text)
+        for child in element:
+          self._CountVisible(child, child.tail)
+        del element[:]
+        if element.tag in _INVISIBLE_TAGS:
+          self._invisible_depth -= 1
 
-def _CountCharacters(texts):
-  result = 0
-  for text in texts:
-    result += len(text)
-  return result
+  def _CountVisible(self, owner, text):
+    if not self._invisible_depth:
+      self.count += _VisibleLength(owner, text)
+
+
+def _VisibleLength(owner, text):
+  """The length of a text that owner holds as its text or tail."""
+  if not isinstance(owner.tag, basestring) or owner.tag in _INVISIBLE_TAGS:
+    return 0
+  return _TextLength(text)
+
+
+def _TextLength(text):
+  """The length of a text without surrounding spaces, 0 if it is too short."""
+  if not text:
+    return 0
+  length = len(text.strip())
+  if length < MIN_VISIBLE_TEXT_LENGTH:
+    return 0
+  return length
 
 
 # For running stand-alone.
 def EstimateUrl(url):
-  html = urllib.urlopen(url).read()
-  encoding = None
-  parser = lxml.etree.HTMLParser(encoding=encoding)
-  tree = lxml.html.fromstring(html, base_url=url, parser=parser)
-
-  return Estimate(tree)
+  return Estimate(lxml.html.fromstring(urllib.urlopen(url).read()))
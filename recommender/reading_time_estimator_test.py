@@ -0,0 +1,97 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import lxml.html
+
+from recommender import reading_time_estimator
+
+PAGES = [
+    '<html><head><title>A title that is long enough</title>'
+    '<script>var text = "a script that is long enough";</script></head>'
+    '<body><p>' + 'Some visible text. ' * 100 + '</p><!-- comment -->'
+    'The tail of a comment is not counted<div>short</div>'
+    'The tail of a div is counted<script>x</script>'
+    'The tail of a script is not counted</body></html>',
+    '<p>' + 'word ' * 2000 + '<b>bold text that is long enough</b>'
+    ' and a tail that is long enough</p>' * 20,
+    u'<html><head><meta charset="utf-8"></head><body>'
+    u'<p>\u00dcnic\u00f6de text that is long enough</p></body></html>'.encode(
+        'utf-8'),
+    '<table><tr><td>A cell that is long enough</td></tr></table>'
+    'Text after the table that is long enough',
+]
+
+
+class ReadingTimeEstimatorTest(unittest.TestCase):
+
+  def testEstimate(self):
+    self.assertEqual(
+        1, reading_time_estimator.EstimateContent('<p>A short text to read</p>'))
+    self.assertEqual(
+        3, reading_time_estimator.EstimateContent('<p>' + 'x' * 2000 + '</p>'))
+
+  def testEstimateTree(self):
+    self.assertEqual([3, 13, 1, 1], [
+        reading_time_estimator.Estimate(lxml.html.fromstring(page))
+        for page in PAGES
+    ])
+
+  def testTextAfterTheEndOfHtml(self):
+    self.addCleanup(setattr, reading_time_estimator, 'CHARACTERS_PER_MINUTE',
+                    reading_time_estimator.CHARACTERS_PER_MINUTE)
+    reading_time_estimator.CHARACTERS_PER_MINUTE = 1
+    page = ('<html><body><p>Visible text that is long</p></body></html>'
+            '<p>A paragraph after the end of html</p>')
+    self.assertEqual(
+        len('Visible text that is long') +
+        len('A paragraph after the end of html'),
+        reading_time_estimator.Estimate(lxml.html.fromstring(page)))
+    # The incremental parser drops everything after the end of html.
+    self.assertEqual(
+        len('Visible text that is long'),
+        reading_time_estimator.EstimateContent(page))
+
+  def testCountsVisibleText(self):
+    self.addCleanup(setattr, reading_time_estimator, 'CHARACTERS_PER_MINUTE',
+                    reading_time_estimator.CHARACTERS_PER_MINUTE)
+    reading_time_estimator.CHARACTERS_PER_MINUTE = 1
+    self.addCleanup(setattr, reading_time_estimator, 'CHUNK_SIZE',
+                    reading_time_estimator.CHUNK_SIZE)
+    page = ('<html><head><noscript><p>A paragraph inside the head</p>'
+            '</noscript></head><body><p>Visible text that is long</p>'
+            '<script>var text = "a script that is long enough";</script>'
+            'The tail of a script is not counted<div>short</div>'
+            'The tail of a div is counted</body></html>')
+    # Chunks split the end tag of the script unless they end before tags.
+    for chunk_size in (12, 13, 14, 15, 16, len(page)):
+      reading_time_estimator.CHUNK_SIZE = chunk_size
+      self.assertEqual(
+          len('Visible text that is long') +
+          len('The tail of a div is counted'),
+          reading_time_estimator.EstimateContent(page))
+
+  def testChunksDoNotChangeTheEstimate(self):
+    expected = [reading_time_estimator.EstimateContent(page) for page in PAGES]
+    self.assertEqual([3, 13, 1, 1], expected)
+    self.addCleanup(setattr, reading_time_estimator, 'CHUNK_SIZE',
+                    reading_time_estimator.CHUNK_SIZE)
+    reading_time_estimator.CHUNK_SIZE = 16
+    self.assertEqual(
+        expected,
+        [reading_time_estimator.EstimateContent(page) for page in PAGES])
+
+
+if __name__ == '__main__':
+  unittest.main()
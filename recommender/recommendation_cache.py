@@ -0,0 +1,138 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Caches ranked recommendations until the state of the user changes.
+
+Every user has a generation number in memcache. It is incremented whenever
+something that the recommendations of the user depend on changes:
+- The user rates a page.
+- The weight of a connection of the user changes. This also happens when a
+  connected user rates a page or a connected feed gets new items.
+- Past recommendations of the user are committed.
+
+Ranked recommendations are cached under the parameters of the request and the
+generation, so a change of the generation makes the old entries unreachable.
+"""
+
+from datetime import timedelta
+import hashlib
+import pickle
+import time
+
+from google.appengine.api import memcache
+
+from recommender import counters
+
+GENERATION_CACHE_PREFIX = 'rg:'
+RESULT_CACHE_PREFIX = 'rc:'
+
+# How many of the top recommendations are cached for each request.
+MAX_CACHED_RECOMMENDATIONS = 100
+# Recommendations get older even when nothing changes so we recalculate them
+# from time to time.
+RESULT_TTL = timedelta(minutes=30)
+
+HITS_COUNTER = 'recommendation_cache.hits'
+MISSES_COUNTER = 'recommendation_cache.misses'
+SAVED_MILLIS_COUNTER = 'recommendation_cache.saved_millis'
+counters.Register(HITS_COUNTER, MISSES_COUNTER, SAVED_MILLIS_COUNTER)
+
+
+def _NewGeneration():
+  # A generation that was lost from memcache must not be reused, otherwise we
+  # could return results that were cached before the generation was lost.
+  return int(time.time() * 1000000)
+
+
+def GetGeneration(user_id):
+  key = GENERATION_CACHE_PREFIX + str(user_id)
+  generation = memcache.get(key)
+  if generation is None:
+    memcache.add(key, _NewGeneration())
+    generation = memcache.get(key)
+  return generation
+
+
+def BumpGeneration(user_id):
+  BumpGenerations([user_id])
+
+
+def BumpGenerations(user_ids):
+  """Invalidates the cached recommendations of users."""
+  # Missing generations are not created here. GetGeneration creates them with
+  # a new value.
+  memcache.offset_multi({str(user_id): 1 for user_id in user_ids},
+                        key_prefix=GENERATION_CACHE_PREFIX)
+
+
+def _ResultCacheKey(user_id, request_key, generation):
+  return '%s%s:%s:%s' % (RESULT_CACHE_PREFIX, user_id,
+                         hashlib.md5(repr(request_key)).hexdigest(), generation)
+
+
+def Get(user_id, request_key, generation, limit):
+  """Returns the cached top recommendations.
+
+  Args:
+    user_id: The user the recommendations are for.
+    request_key: A tuple of the parameters of the request.
+    generation: The generation of the user from GetGeneration.
+    limit: How many recommendations are needed.
+
+  Returns:
+    A (recommendations, has_more) pair, where recommendations is a list of at
+    most limit models.Recommendation and has_more tells whether there can be
+    more recommendations after them. None when they are not cached.
+  """
+  start = time.time()
+  cached = memcache.get(_ResultCacheKey(user_id, request_key, generation))
+  if cached is not None:
+    serialized_recommendations, is_complete, millis_to_calculate = (
+        pickle.loads(cached))
+    if is_complete or len(serialized_recommendations) >= limit:
+      # The same as models.DeserializeRecommendation, models imports this
+      # module.
+      result = [pickle.loads(r) for r in serialized_recommendations[:limit]]
+      millis_to_read = (time.time() - start) * 1000
+      counters.IncrementMulti({
+          HITS_COUNTER: 1,
+          SAVED_MILLIS_COUNTER: max(millis_to_calculate - millis_to_read, 0)
+      })
+      has_more = not is_complete or len(serialized_recommendations) > limit
+      return result, has_more
+  counters.Increment(MISSES_COUNTER)
+  return None
+
+
+def Set(user_id, request_key, generation, recommendations, is_complete,
+        millis_to_calculate):
+  """Caches the top recommendations.
+
+  Args:
+    user_id: The user the recommendations are for.
+    request_key: A tuple of the parameters of the request.
+    generation: The generation that was read before the recommendations were
+      calculated.
+    recommendations: The models.Recommendation in ranking order, with
+      destination_url but not decorated.
+    is_complete: Whether these are all the recommendations there are.
+    millis_to_calculate: How long it took to calculate the recommendations.
+  """
+  value = pickle.dumps(
+      ([r.Serialize() for r in recommendations[:MAX_CACHED_RECOMMENDATIONS]],
+       is_complete and len(recommendations) <= MAX_CACHED_RECOMMENDATIONS,
+       millis_to_calculate))
+  memcache.set(
+      _ResultCacheKey(user_id, request_key, generation),
+      value,
+      time=RESULT_TTL.total_seconds())
@@ -23,48 +23,66 @@ import pickle
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
+from recommender import candidate_index
 from recommender import config
 from recommender import datastore_based_connection_trainer as connection_trainer
+from recommender import feed_fetcher
 from recommender import feeds
 from recommender import models
+from recommender import recommendation_cache
 from recommender import time_periods
 
 
-# Updates all feeds in batches of 10 at a time.
-def UpdateAllFeeds():
-  _UpdateNFeeds(None, 20, datetime.now())
+# Due feeds are only started for this long so that the task finishes before
+# its deadline of 10 minutes.
+FEED_UPDATE_TIME_BUDGET_SECONDS = 7 * 60
 
 
-def _UpdateNFeeds(min_id, batch_size, start_time):
-  max_last_updated = datetime.now()
-  query = feeds.Feed.query()
-  if min_id:
-    query = query.filter(feeds.Feed.key > ndb.Key(feeds.Feed, min_id))
-  batch = query.fetch(batch_size)
-  if not batch:
-    return
-  deferred.defer(
-      _UpdateNFeeds,
-      batch[-1].key.id(),
-      batch_size,
-      start_time,
-      _queue='feed-updates')
-  # Fire off all async requests in parallel so we only wait for the slowest
-  # feed in the batch instead of for all serially.
-  results = [(feed,
-              feed.UpdateAsync(canonicalize=CanonicalizeUrl))
-             for feed in batch
-             if feed.last_updated < max_last_updated]
-  for feed, new_items_future in results:
-    new_items = new_items_future.get_result()
-    if new_items:
-      deferred.defer(
-          _NewFeedItemsAdded,
-          feed, {item.url for item in new_items},
-          _queue='feed-updates')
+def UpdateDueFeeds(now=None):
+  """Updates the feeds whose next_update has passed.
+
+  When the time budget of the task runs out the rest of the feeds are updated
+  by another task. Updated feeds are not due anymore, so it runs the same
+  query.
+
+  Args:
+    now: The time that the feeds were due at.
+  """
+  now = now or datetime.now()
+  due_feeds = feeds.Feed.query(feeds.Feed.next_update <= now).order(
+      feeds.Feed.next_update).iter(batch_size=feed_fetcher.MAX_IN_FLIGHT)
+  if _UpdateFeeds(due_feeds, FEED_UPDATE_TIME_BUDGET_SECONDS):
+    deferred.defer(UpdateDueFeeds, now, _queue='feed-updates')
+
+
+def _UpdateFeeds(feeds_to_update, time_budget_seconds=None):
+  """Returns True if the time budget ran out before all feeds were updated."""
+  return feed_fetcher.UpdateFeeds(
+      feeds_to_update,
+      lambda feed: feed.UpdateAsync(canonicalize=CanonicalizeUrl),
+      _FeedUpdated,
+      on_failed=_FeedUpdateFailed,
+      time_budget_seconds=time_budget_seconds)
+
+
+def _FeedUpdated(feed, new_items):
+  if new_items:
+    models.InvalidateUnifiedRatings(item.url for item in new_items)
+    deferred.defer(
+        _NewFeedItemsAdded,
+        feed, {item.url for item in new_items},
+        _queue='feed-updates')
+
+
+def _FeedUpdateFailed(feed):
+  # Otherwise a feed that fails to parse stays due and is retried by every run.
+  feed.UpdateFailedAsync(datetime.now()).get_result()
 
 
 def _NewFeedItemsAdded(feed, new_item_urls):
+  # Like in RatingAddedImpl, the cached ratings may not have the new items.
+  models.InvalidateUnifiedRatings(new_item_urls)
+  models.UpdateUrlRatingStatsMulti(new_item_urls, feed_url=feed.GetUrl())
   _DecayConnectionWeightToFeed(feed, len(new_item_urls))
   models.PrefetchPageInfos(new_item_urls)
 
@@ -77,12 +95,15 @@ def UpdateFeed(feed):
 def UpdateFeedImpl(feed):
   new_items = feed.Update(CanonicalizeUrl)
   if new_items:
+    models.InvalidateUnifiedRatings(item.url for item in new_items)
     deferred.defer(
         _DecayConnectionWeightToFeed,
         feed,
         len(new_items),
         _queue='feed-updates')
     models.PrefetchPageInfos({item.url for item in new_items})
+    models.UpdateUrlRatingStatsMulti({item.url for item in new_items},
+                                     feed_url=feed.GetUrl())
 
 
 def _DecayConnectionWeightToFeed(feed, num_new_items):
@@ -99,24 +120,44 @@ def CanonicalizeUrl(url):
 
 
 def AddRating(user, url, rating, source, category_id):
+  """Saves a rating and schedules everything that depends on it.
+
+  Only the rating is written before returning, the feeds of the page are
+  registered and the connections are updated by tasks.
+
+  Returns:
+    The stats of the url from before the rating was added.
+  """
   user_id = models.UserKey(user).id()
   stats = models.AddRating(
       user_id, url, rating, source, category_id)
 
-  # If the page belongs to a feed then register this feed.
+  # The page is only fetched by the task if it is not known yet.
+  page_info = models.GetPageInfoAsync(url, do_not_fetch=True).get_result()
+  if page_info is None or page_info.feed_url or page_info.is_feed:
+    deferred.defer(_RegisterFeedsOfPage, url, _queue='feed-updates')
+  if page_info is not None:
+    if page_info.feed_url:
+      stats['own_feed'] = page_info.feed_url
+    if page_info.is_feed:
+      stats['own_feed'] = page_info.canonical_url
+
+  RatingAdded(
+      models.Source(models.SOURCE_TYPE_USER, user_id, category_id), url, rating)
+  return stats
+
+
+def _RegisterFeedsOfPage(url):
   page_info = models.GetPageInfo(url)
+  # If the page belongs to a feed then register this feed.
   if page_info.feed_url:
     UpdateFeed(feeds.AddFeed(page_info.feed_url, page_info.feed_title))
-    stats['own_feed'] = page_info.feed_url
+    # The stats may have been calculated before the page info was known.
+    models.UpdateUrlRatingStats(url, feed_url=page_info.feed_url)
 
   # If the page itself is a feed url then also register it.
   if page_info.is_feed:
     UpdateFeed(feeds.AddFeed(page_info.canonical_url, page_info.title))
-    stats['own_feed'] = page_info.canonical_url
-
-  RatingAdded(
-      models.Source(models.SOURCE_TYPE_USER, user_id, category_id), url, rating)
-  return stats
 
 
 DELAY_BEFORE_UPDATING_CONNECTIONS = (
@@ -136,6 +177,9 @@ def RatingAdded(source, url, rating):
 
 def RatingAddedImpl(source, url, rating):
   source = models.DeserializeSource(source)
+  # The ratings of the url may have been cached from a query that did not see
+  # the new rating yet.
+  models.InvalidateUnifiedRatings([url])
   if source.source_type == models.SOURCE_TYPE_USER:
     deferred.defer(UpdatePopularPage, url, _queue='default')
 
@@ -150,11 +194,27 @@ def RatingAddedImpl(source, url, rating):
       # We will let the deferred task scheduled from SetPageCategory to update
       # connections for the updated category.
       return
+    # The new rating changes the recommendations of all subscribers, also of
+    # the ones whose connection weight is not updated below.
+    recommendation_cache.BumpGenerations(
+        candidate_index.RatingAdded(page_rating))
 
   connection_trainer.CreateTrainer().RecommendationAdded(source, url, rating)
   models.UpdateCachedConnectionInfo(source.source_id)
 
 
+def DeleteRating(user, url):
+  page_rating = models.DeleteRating(user, url)
+  if page_rating is not None:
+    deferred.defer(
+        _RatingDeleted, page_rating, _queue='recommendation-updates')
+
+
+def _RatingDeleted(page_rating):
+  recommendation_cache.BumpGenerations(
+      candidate_index.RatingDeleted(page_rating))
+
+
 def UpdatePopularPage(url):
   start_datetime = datetime.now()
   values_by_key = dict()
@@ -192,8 +252,7 @@ def SetPageCategory(user, url, category_id, retries_left=10):
   if page_rating.category == category:
     return
 
-  page_rating.category = category
-  page_rating.put()
+  models.SetRatingCategory(page_rating, category)
 
   deferred.defer(
       RatingAddedImpl,
@@ -0,0 +1,480 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Rebuilds all connections by replaying the rating log.
+
+All PageRatings and FeedItems are read in date order and fed to the same
+connection_trainer.Trainer that trains connections online, but the connections
+are kept in memory in arrays instead of being read and written one by one. At
+the end the connections are written in bulk under a new version, which can be
+made live by changing models.LOGISTIC_REGRESSION_CONNECTION.
+
+The replay runs in a chain of tasks that each stop after a time budget. The
+store is saved to Cloud Storage between the tasks and the queries continue
+from cursors, so the replay can take longer than the task deadline and a
+failed task is retried from where the previous task stopped.
+
+The replay differs from the online training in two ways:
+- The feed that a page declares in its <head> is not treated as a rater of
+  the page, because that needs a PageInfo lookup for every rated url. Feeds
+  that have a FeedItem for the page are.
+- New feed items decay the connections to the feed one item at a time instead
+  of in batches per feed update.
+"""
+
+import array
+import collections
+import cPickle
+from datetime import datetime
+from datetime import timedelta
+import itertools
+import logging
+import time
+
+import cloudstorage as gcs
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from recommender import config
+from recommender import connection_trainer
+from recommender import datastore_based_connection_trainer
+from recommender import feeds
+from recommender import models
+from recommender import ratings
+
+# How many entities are read or written with one datastore call.
+BATCH_SIZE = 500
+# How often the progress of the replay is logged.
+LOG_EVERY_N_EVENTS = 100000
+# A task does not start more work after this long so that it can save the
+# store before its deadline of 10 minutes.
+TASK_TIME_BUDGET_SECONDS = 7 * 60
+
+POSITIVE = connection_trainer.POSITIVE
+
+
+class ReplayEvent(object):
+  """A rating or a feed item at the time it was added."""
+
+  def __init__(self, date, source, url, rating):
+    self.date = date
+    self.source = source
+    self.url = url
+    self.rating = rating
+
+
+class ArrayConnectionStore(connection_trainer.ConnectionStore):
+  """Keeps connections and the rating history in memory.
+
+  Sources and connections are numbered in the order they are first seen and
+  their state is kept in arrays indexed by these numbers. The store follows
+  the rules of datastore_based_connection_trainer.ConnectionStore, with the
+  time of the event being replayed as the current time.
+  """
+
+  def __init__(self, feed_urls=frozenset()):
+    # The urls that are feeds, every feed url is recommended by itself.
+    self.feed_urls = feed_urls
+    # The date of the event being replayed.
+    self.now = None
+    self.sources = []
+    self._source_indexes = {}
+    # By source index.
+    self._rating_counts = array.array('l')
+    self._last_rating_dates = []
+    # Keyed by url, lists of (source index, rating, number of earlier ratings
+    # of the source) in date order.
+    self._url_ratings = collections.defaultdict(list)
+    # By connection index.
+    self.connection_sources = []
+    self.weights = array.array('d')
+    self.num_shared_items = array.array('l')
+    self.top_sources = []
+    self.subscription_starts = []
+    self._connection_indexes = {}
+    # Keyed by (publisher index, positive), lists of connection indexes.
+    self._subscribers = collections.defaultdict(list)
+
+  def _SourceIndex(self, source):
+    index = self._source_indexes.get(source)
+    if index is None:
+      index = len(self.sources)
+      self._source_indexes[source] = index
+      self.sources.append(source)
+      self._rating_counts.append(0)
+      self._last_rating_dates.append(None)
+    return index
+
+  def AddRating(self, event):
+    """Records a replayed event so that later events see it."""
+    index = self._SourceIndex(event.source)
+    if event.rating != ratings.NEUTRAL:
+      self._url_ratings[event.url].append(
+          (index, event.rating, self._rating_counts[index]))
+    self._rating_counts[index] += 1
+    self._last_rating_dates[index] = event.date
+
+  def GetRecommendations(self, url, subscriber, subscriber_rating):
+    del subscriber_rating  # Source feeds of pages are not replayed.
+    result = []
+    if url in self.feed_urls:
+      feed = models.Source(models.SOURCE_TYPE_FEED, url, None)
+      result.append(
+          connection_trainer.Rating(
+              rating=ratings.POSITIVE,
+              user=feed,
+              weight=self.GetWeight(subscriber, feed, POSITIVE),
+              num_ratings_ago=0))
+    for index, rating, num_earlier_ratings in self._url_ratings.get(url, ()):
+      source = self.sources[index]
+      if source == subscriber:
+        break
+      if (source.source_type == models.SOURCE_TYPE_FEED and
+          source.source_id == url):
+        num_ratings_ago = 0
+      else:
+        # The number of ratings since this one, not including it.
+        num_ratings_ago = max(
+            self._rating_counts[index] - num_earlier_ratings - 1, 0)
+      result.append(
+          connection_trainer.Rating(
+              rating=rating,
+              user=source,
+              weight=self.GetWeight(subscriber, source, rating > 0),
+              num_ratings_ago=num_ratings_ago))
+    return result
+
+  def _ConnectionIndex(self, subscriber, publisher, positive):
+    return self._connection_indexes.get(
+        (self._SourceIndex(subscriber), self._SourceIndex(publisher), positive))
+
+  def GetWeight(self, subscriber, publisher, positive):
+    index = self._ConnectionIndex(subscriber, publisher, positive)
+    if index is None:
+      return 0
+    return self.weights[index]
+
+  def SetWeight(self,
+                subscriber,
+                publisher,
+                positive,
+                weight,
+                shared_item=None,
+                publisher_voted=False):
+    if subscriber.source_type == models.SOURCE_TYPE_FEED:
+      return
+    index = self._ConnectionIndex(subscriber, publisher, positive)
+    if index is None:
+      index = len(self.weights)
+      key = (self._SourceIndex(subscriber), self._SourceIndex(publisher),
+             positive)
+      self._connection_indexes[key] = index
+      self._subscribers[key[1], positive].append(index)
+      self.connection_sources.append(key)
+      self.weights.append(weight)
+      self.num_shared_items.append(0)
+      self.top_sources.append([])
+      self.subscription_starts.append(self.now - timedelta(days=1))
+    if not (publisher_voted and
+            publisher.source_type == models.SOURCE_TYPE_FEED and
+            self.subscription_starts[index] >
+            self.now - timedelta(days=1, hours=1)):
+      self.weights[index] = weight
+    if shared_item is not None:
+      self.num_shared_items[index] += 1
+      top_sources = self.top_sources[index]
+      top_sources.insert(0, shared_item)
+      del top_sources[datastore_based_connection_trainer.MAX_TOP_SOURCES:]
+
+  def GetSubscribers(self, publisher, positive=True):
+    return [
+        connection_trainer.Connection(
+            self.sources[self.connection_sources[index][0]],
+            self.weights[index])
+        for index in self._subscribers.get(
+            (self._SourceIndex(publisher), positive), ())
+    ]
+
+  def CanSubscribe(self, user):
+    return user.source_type == models.SOURCE_TYPE_USER
+
+  def Connections(self, version, now):
+    """Yields the connections as models.Connection entities."""
+    for index, (subscriber_index, publisher_index, positive) in enumerate(
+        self.connection_sources):
+      subscriber = self.sources[subscriber_index]
+      publisher = self.sources[publisher_index]
+      active_datetime = self._last_rating_dates[publisher_index]
+      yield models.Connection(
+          key=models.ConnectionKey(publisher.source_id, publisher.category_id,
+                                   subscriber.source_id,
+                                   subscriber.category_id, version, positive),
+          publisher_type=publisher.source_type,
+          publisher_id=publisher.source_id,
+          publisher_category=models.CategoryKey(publisher.category_id,
+                                                publisher.source_id),
+          subscriber_id=subscriber.source_id,
+          subscriber_category=models.CategoryKey(subscriber.category_id,
+                                                 subscriber.source_id),
+          version=version,
+          positive=positive,
+          weight=self.weights[index],
+          num_shared_items=self.num_shared_items[index],
+          top_sources=[
+              models.ConnectionSourcePage(url=url, weight=1)
+              for url in self.top_sources[index]
+          ],
+          subscription_start_datetime=self.subscription_starts[index],
+          active_datetime=active_datetime,
+          active_days=[
+              days for days in models.CONNECTION_ALL_ACTIVE_DAYS
+              if active_datetime and
+              now - active_datetime < timedelta(days=days)
+          ])
+
+
+def ReplayEvents(events, trainer, store):
+  """Trains connections on events in date order.
+
+  Args:
+    events: An iterable of ReplayEvent sorted by date.
+    trainer: A connection_trainer.Trainer that uses store.
+    store: The ArrayConnectionStore.
+
+  Returns:
+    The number of replayed events.
+  """
+  start = time.time()
+  num_events = 0
+  for event in events:
+    store.now = event.date
+    trainer.RecommendationAdded(event.source, event.url, event.rating)
+    store.AddRating(event)
+    num_events += 1
+    if num_events % LOG_EVERY_N_EVENTS == 0:
+      _LogThroughput('Replayed', num_events, start)
+  _LogThroughput('Replayed', num_events, start)
+  return num_events
+
+
+def _LogThroughput(action, count, start):
+  seconds = max(time.time() - start, 1e-6)
+  logging.info('%s %d in %.1fs (%.0f per hour)', action, count, seconds,
+               count * 3600 / seconds)
+
+
+def _UserRatingEvent(rating):
+  return ReplayEvent(
+      rating.date,
+      models.Source(models.SOURCE_TYPE_USER,
+                    rating.key.parent().id(),
+                    models.GetCategoryId(rating.category)), rating.url,
+      rating.rating)
+
+
+def _FeedItemEvent(item):
+  return ReplayEvent(item.published_date,
+                     models.Source(models.SOURCE_TYPE_FEED, item.feed_url,
+                                   None), item.url, ratings.POSITIVE)
+
+
+# The position of a stream whose query returned all its entities.
+_STREAM_DONE = 'done'
+
+
+class _EventStream(object):
+  """The events of a query in date order, that can continue from a cursor."""
+
+  def __init__(self, query, to_event, position):
+    self._to_event = to_event
+    if position == _STREAM_DONE:
+      self._iterator = iter(())
+    else:
+      self._iterator = query.iter(
+          start_cursor=ndb.Cursor(urlsafe=position) if position else None,
+          produce_cursors=True,
+          batch_size=BATCH_SIZE)
+    self.head = None
+    self._Advance()
+
+  def _Advance(self):
+    entity = next(self._iterator, None)
+    self.head = None if entity is None else self._to_event(entity)
+
+  def Pop(self):
+    event = self.head
+    self._Advance()
+    return event
+
+  def Position(self):
+    """Returns where to continue from, the head is not replayed yet."""
+    if self.head is None:
+      return _STREAM_DONE
+    return self._iterator.cursor_before().urlsafe()
+
+
+def _EventStreams(positions):
+  return [
+      _EventStream(
+          models.PageRating.query().order(models.PageRating.date),
+          _UserRatingEvent, positions[0]),
+      _EventStream(
+          feeds.FeedItem.query().order(feeds.FeedItem.published_date),
+          _FeedItemEvent, positions[1]),
+  ]
+
+
+def _MergeByDate(streams, end_time=None):
+  """Yields the events of streams in date order until end_time.
+
+  Events with the same date are yielded in the order of the streams. At least
+  one event is yielded.
+  """
+  while True:
+    streams_with_events = [
+        stream for stream in streams if stream.head is not None
+    ]
+    if not streams_with_events:
+      return
+    yield min(streams_with_events, key=lambda stream: stream.head.date).Pop()
+    if end_time is not None and time.time() >= end_time:
+      return
+
+
+class ReplayProgress(object):
+  """Where a replay continues in the next task."""
+
+  def __init__(self):
+    # The positions of the streams of _EventStreams, None to start at the
+    # beginning.
+    self.positions = [None, None]
+    self.num_events = 0
+    # The number of connections written, None while events are replayed.
+    self.num_written = None
+    self.now = None
+    # The file of the store in Cloud Storage, None if it is not saved.
+    self.store_filename = None
+    # The file of the previous save of the store, which is deleted once the
+    # next task runs.
+    self.previous_store_filename = None
+    self.num_saves = 0
+
+
+def ReplayVersionName():
+  return '%s-replay-%s' % (models.LOGISTIC_REGRESSION_CONNECTION,
+                           datetime.now().strftime('%Y%m%d%H%M%S'))
+
+
+def _SaveStore(version, progress, store):
+  """Saves the store to a new file so that a retried task loads its own."""
+  filename = '/' + '/'.join([
+      config.GetBucketName(), 'replay', version,
+      str(progress.num_saves)
+  ])
+  with gcs.open(
+      filename, 'w',
+      retry_params=gcs.RetryParams(backoff_factor=1.1)) as fp:
+    cPickle.dump(store, fp, cPickle.HIGHEST_PROTOCOL)
+  progress.previous_store_filename = progress.store_filename
+  progress.store_filename = filename
+  progress.num_saves += 1
+
+
+def _LoadStore(progress):
+  with gcs.open(progress.store_filename) as fp:
+    store = cPickle.load(fp)
+  _DeleteStore(progress.previous_store_filename)
+  return store
+
+
+def _DeleteStore(filename):
+  if filename is None:
+    return
+  try:
+    gcs.delete(filename)
+  except gcs.NotFoundError:
+    # A retried task deleted it already.
+    pass
+
+
+def Replay(version, progress=None, time_budget_seconds=None):
+  """Replays the ratings and writes the connections under version.
+
+  Args:
+    version: The version of the connections.
+    progress: The ReplayProgress returned by the previous call, None to start.
+    time_budget_seconds: No more events are replayed or connections written
+      after this many seconds. Some work is done even if it is 0.
+
+  Returns:
+    The ReplayProgress to continue from, or None when the replay is done.
+  """
+  start = time.time()
+  end_time = None
+  if time_budget_seconds is not None:
+    end_time = start + time_budget_seconds
+  # Whether the store has changes that are not saved.
+  store_changed = False
+  if progress is None:
+    progress = ReplayProgress()
+    feed_urls = frozenset(key.id() for key in feeds.Feed.query().iter(
+        keys_only=True, batch_size=BATCH_SIZE))
+    store = ArrayConnectionStore(feed_urls)
+  else:
+    store = _LoadStore(progress)
+
+  if progress.num_written is None:
+    trainer = connection_trainer.Trainer(
+        store, datastore_based_connection_trainer.LEARNING_RATE,
+        datastore_based_connection_trainer.IGNORE_LEARNING_RATE)
+    streams = _EventStreams(progress.positions)
+    progress.num_events += ReplayEvents(
+        _MergeByDate(streams, end_time), trainer, store)
+    progress.positions = [stream.Position() for stream in streams]
+    store_changed = True
+    if any(stream.head is not None for stream in streams):
+      _SaveStore(version, progress, store)
+      logging.info('Replayed %d events so far', progress.num_events)
+      return progress
+    progress.num_written = 0
+    progress.now = datetime.now()
+
+  connections = itertools.islice(
+      store.Connections(version, progress.now), progress.num_written, None)
+  while True:
+    batch = list(itertools.islice(connections, BATCH_SIZE))
+    if not batch:
+      break
+    ndb.put_multi(batch)
+    progress.num_written += len(batch)
+    if end_time is not None and time.time() >= end_time:
+      if store_changed:
+        _SaveStore(version, progress, store)
+      logging.info('Wrote %d connections so far', progress.num_written)
+      return progress
+  _LogThroughput('Wrote connections of version %s:' % version,
+                 progress.num_written, start)
+  _DeleteStore(progress.store_filename)
+  return None
+
+
+def _ReplayTask(version, progress):
+  progress = Replay(version, progress, TASK_TIME_BUDGET_SECONDS)
+  if progress is not None:
+    deferred.defer(
+        _ReplayTask, version, progress, _queue='connection-replay')
+
+
+def StartReplay():
+  deferred.defer(
+      _ReplayTask, ReplayVersionName(), None, _queue='connection-replay')
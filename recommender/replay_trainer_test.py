@@ -0,0 +1,122 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime
+from datetime import timedelta
+import os
+import unittest
+
+from recommender import datastore_based_connection_trainer
+from recommender import items
+from recommender import models
+from recommender import replay_trainer
+
+from google.appengine.ext import testbed
+
+
+class ReplayTrainerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    items.ClearInstanceCaches()
+    self.testbed.init_search_stub()
+    self.testbed.init_urlfetch_stub()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.dirname(__file__)))
+    self.start = datetime(2020, 1, 2)
+    self.minutes = 0
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Rate(self, user_id, url, rating):
+    """Adds a rating and trains the connections online like in production."""
+    self.minutes += 1
+    models.AddRatingAtTime(user_id, url, rating, 'fake_source', None,
+                           self.start + timedelta(minutes=self.minutes))
+    datastore_based_connection_trainer.CreateTrainer().RecommendationAdded(
+        models.Source(models.SOURCE_TYPE_USER, user_id, None), url, rating)
+
+  def Weights(self, version):
+    return {(c.subscriber_id, c.publisher_id, c.positive): c.weight
+            for c in models.Connection.query(
+                models.Connection.version == version)}
+
+  def RateAll(self):
+    self.Rate('1', 'http://a', 1)
+    self.Rate('2', 'http://a', 1)
+    self.Rate('1', 'http://b', 1)
+    self.Rate('3', 'http://b', -1)
+    self.Rate('3', 'http://a', 1)
+    self.Rate('2', 'http://b', 1)
+    self.Rate('4', 'http://c', 0)
+    self.Rate('1', 'http://c', -1)
+    self.Rate('2', 'http://c', -1)
+
+  def testSameWeightsAsOnlineTraining(self):
+    self.RateAll()
+
+    self.assertIsNone(replay_trainer.Replay('replayed'))
+
+    online = self.Weights(models.LOGISTIC_REGRESSION_CONNECTION)
+    replayed = self.Weights('replayed')
+    self.assertTrue(online)
+    self.assertEqual(sorted(online), sorted(replayed))
+    for key, weight in online.items():
+      self.assertAlmostEqual(weight, replayed[key])
+
+  def testResumesFromProgress(self):
+    self.RateAll()
+    self.addCleanup(setattr, replay_trainer, 'BATCH_SIZE',
+                    replay_trainer.BATCH_SIZE)
+    replay_trainer.BATCH_SIZE = 2
+
+    progress = replay_trainer.Replay('replayed', time_budget_seconds=0)
+    num_calls = 1
+    while progress is not None:
+      progress = replay_trainer.Replay(
+          'replayed', progress, time_budget_seconds=0)
+      num_calls += 1
+
+    # One event is replayed and one batch is written per call.
+    self.assertLess(9, num_calls)
+    online = self.Weights(models.LOGISTIC_REGRESSION_CONNECTION)
+    replayed = self.Weights('replayed')
+    self.assertEqual(sorted(online), sorted(replayed))
+    for key, weight in online.items():
+      self.assertAlmostEqual(weight, replayed[key])
+
+  def testNumRatingsAgo(self):
+    store = replay_trainer.ArrayConnectionStore()
+    publisher = models.Source(models.SOURCE_TYPE_USER, '1', None)
+    subscriber = models.Source(models.SOURCE_TYPE_USER, '2', None)
+    for minutes, url in enumerate(['http://a', 'http://b', 'http://c']):
+      store.AddRating(
+          replay_trainer.ReplayEvent(
+              self.start + timedelta(minutes=minutes), publisher, url, 1))
+    self.assertEqual(
+        [2], [r.num_ratings_ago
+              for r in store.GetRecommendations('http://a', subscriber, 1)])
+    self.assertEqual(
+        [0], [r.num_ratings_ago
+              for r in store.GetRecommendations('http://c', subscriber, 1)])
+
+
+if __name__ == '__main__':
+  unittest.main()
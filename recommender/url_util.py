@@ -13,16 +13,18 @@
 # limitations under the License.
 
 import cgi
+import codecs
+import io
 import logging
 
 import feedparser
 import lxml.etree
-import lxml.html
-import lxml.html.soupparser
+from recommender import html_head
 from recommender import reading_time_estimator
 import urlparse
 
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 
 
 class PageMetadata(object):
@@ -99,11 +101,21 @@ FEED_CONTENT_TYPES = set([
 
 
 def GetPageContent(url):
+  return GetPageContentAsync(url).get_result()
+
+
+@ndb.tasklet
+def GetPageContentAsync(url):
+  """Fetches a page without blocking the other tasklets.
+
+  Returns:
+    A tuple of the content, the content type, the charset and the final url.
+  """
   url = Normalize(url)
   final_url = url
   try:
-    result = urlfetch.fetch(
-        url, deadline=URL_FETCH_DEADLINE_SECONDS, allow_truncated=True)
+    rpc = urlfetch.create_rpc(deadline=URL_FETCH_DEADLINE_SECONDS)
+    result = yield urlfetch.make_fetch_call(rpc, url, allow_truncated=True)
     if result.status_code == 200:
       content_type, encoding = _GetContentTypeAndCharset(result.headers)
       content = result.content
@@ -116,25 +128,35 @@ def GetPageContent(url):
     raise InvalidURLError(e)
   except urlfetch.Error as e:
     raise Error(e)
-  return content, content_type, encoding, final_url
+  raise ndb.Return((content, content_type, encoding, final_url))
 
 
 def GetPageMetadata(url):
+  return GetPageMetadataAsync(url).get_result()
+
+
+@ndb.tasklet
+def GetPageMetadataAsync(url):
   url = Normalize(url)
-  (content, content_type, encoding, final_url) = GetPageContent(url)
+  (content, content_type, encoding,
+   final_url) = yield GetPageContentAsync(url)
+  raise ndb.Return(
+      _ParsePageMetadata(url, content, content_type, encoding, final_url))
+
+
+def _ParsePageMetadata(url, content, content_type, encoding, final_url):
   parsed_feed = None
-  # We set the default here because we cannot pass it explicitly into
-  # feedparser.parse(url).
-  urlfetch.set_default_fetch_deadline(URL_FETCH_DEADLINE_SECONDS)
   if content_type in FEED_CONTENT_TYPES:
+    # The fetched bytes are parsed so that the feed is not downloaded again.
+    # The content type tells feedparser the charset of the feed.
+    response_headers = {'content-type': content_type}
+    if encoding:
+      response_headers['content-type'] += '; charset=' + encoding
     try:
-      parsed_feed = feedparser.parse(url)
+      parsed_feed = feedparser.parse(
+          io.BytesIO(content), response_headers=response_headers)
     except StandardError as e:
-      logging.warning('Failed to parse as feed: ' + url + ' error: ' + str(e))
-      try:
-        parsed_feed = feedparser.parse(content)
-      except StandardError as e:
-        logging.warning('Failed to parse content of %s as a feed %s', url, e)
+      logging.warning('Failed to parse content of %s as a feed %s', url, e)
 
   if parsed_feed and parsed_feed.entries:
     result = PageMetadata()
@@ -150,16 +172,19 @@ def GetPageMetadata(url):
     result.estimated_reading_time = None
     return result
 
-  parser = None
-  if encoding and encoding != 'None':
+  if encoding == 'None':
+    encoding = None
+  if encoding:
     try:
-      parser = lxml.etree.HTMLParser(encoding=encoding)
-    except StandardError as e:
-      logging.warning('Could not create parser for: ' + url + ' error: ' +
-                      str(e))
+      codecs.lookup(encoding)
+    except LookupError as e:
+      logging.warning('Unknown encoding of: ' + url + ' error: ' + str(e))
+      encoding = None
 
+  # The head and the reading time are parsed separately and incrementally so
+  # that the tree of the page is never built.
   try:
-    tree = lxml.html.fromstring(content, base_url=url, parser=parser)
+    head = html_head.Parse(content, encoding)
   except lxml.etree.LxmlError as e:
     logging.warning('Could not parse content of url: %s, %s', url, str(e))
     raise Error(e)
@@ -168,80 +193,21 @@ def GetPageMetadata(url):
     raise Error(e)
 
   result = PageMetadata()
-  result.title = FindContent(tree, [{
-      'path': './/head/meta[@property="og:title"]',
-      'attribute': 'content'
-  }, {
-      'path': './/head/meta[@name="twitter:title"]',
-      'attribute': 'content'
-  }, {
-      'path': './/head/title'
-  }])
+  result.title = head.title
   result.final_url = final_url
-  result.canonical_url = Resolve(
-      url,
-      FindContent(tree, [{
-          'path': './/head/link[@rel="canonical"]',
-          'attribute': 'href'
-      }, {
-          'path': './/head/meta[@property="og:url"]',
-          'attribute': 'content'
-      }]))
-
+  result.canonical_url = Resolve(url, head.canonical_url)
   if not result.canonical_url:
     result.canonical_url = final_url
-
-  result.description = FindContent(tree, [{
-      'path': './/head/meta[@property="og:description"]',
-      'attribute': 'content'
-  }, {
-      'path': './/head/meta[@name="description"]',
-      'attribute': 'content'
-  }, {
-      'path': './/head/meta[@name="twitter:description"]',
-      'attribute': 'content'
-  }])
-  result.feed_url = None
-  result.feed_title = None
-  if not FindFeedUrl(url, tree, './/head/link[@type="application/rss+xml"]',
-                     result):
-    FindFeedUrl(url, tree, './/head/link[@type="application/atom+xml"]', result)
-
+  result.description = head.description
+  result.feed_url = Resolve(url, head.feed_url)
+  result.feed_title = head.feed_title
   result.is_feed = False
 
   try:
-    result.estimated_reading_time = reading_time_estimator.Estimate(tree)
-  except UnicodeDecodeError as e:
+    result.estimated_reading_time = reading_time_estimator.EstimateContent(
+        content, encoding)
+  except (UnicodeDecodeError, lxml.etree.LxmlError) as e:
     logging.warning('Could not estimate reading time for url %s: %s', url, e)
     result.estimated_reading_time = None
 
   return result
-
-
-def FindContent(tree, paths, filter_fn=None):
-  for p in paths:
-    match = tree.find(p['path'])
-    if match is not None:
-      if 'attribute' in p:
-        result = match.get(p['attribute'])
-      else:
-        result = match.text
-      if result:
-        if filter_fn and not filter_fn(result):
-          continue
-        return result
-  return None
-
-
-def FindFeedUrl(url, tree, path, result):
-  match = tree.find(path)
-  if match is None:
-    return False
-  title = match.get('title')
-  href = match.get('href')
-  if href is None:
-    return False
-  feed_url = Resolve(url, href)
-  result.feed_url = feed_url
-  result.feed_title = title
-  return True
@@ -0,0 +1,60 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decays many connection weights at once.
+
+This is connection_trainer.DecayedWeight for numpy arrays. A feed that adds
+items decays the connections of all its subscribers by the same number of
+steps, so they are decayed together.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+from recommender import connection_trainer
+
+_LOG_2 = np.log(2)
+
+
+def DecayedWeights(weights, num_items, learning_rate):
+  """Returns the weights after num_items decay steps.
+
+  Args:
+    weights: A sequence of initial weights.
+    num_items: The number of decay steps.
+    learning_rate: The learning rate of a step, less than 4.
+
+  Returns:
+    A numpy array with the decayed weights, in the same order.
+  """
+  weights = np.array(weights, dtype=np.float64)
+  if (num_items <= connection_trainer.EXACT_DECAY_STEPS or
+      learning_rate >= 4):
+    for _ in range(num_items):
+      weights -= learning_rate * (
+          1 / (1 + np.exp(-weights)) - connection_trainer.NEUTRAL_PREDICTION)
+    return weights
+  log_lambda, c = connection_trainer.DecayParameters(learning_rate)
+  threshold = connection_trainer.LOG_SPACE_THRESHOLD
+  z = c * np.abs(weights)
+  nonzero = z > 0
+  # Clipping keeps the unused branches of np.where finite.
+  log_sinh = np.where(z > threshold, z - _LOG_2,
+                      np.log(np.sinh(np.clip(z, 1e-300, threshold))))
+  log_decayed_sinh = log_sinh + num_items * log_lambda
+  decayed = np.where(
+      log_decayed_sinh > threshold, (log_decayed_sinh + _LOG_2) / c,
+      np.arcsinh(np.exp(np.minimum(log_decayed_sinh, threshold))) / c)
+  decayed = np.maximum(decayed, connection_trainer.MIN_DECAYED_WEIGHT)
+  return np.where(nonzero, np.sign(weights) * decayed, weights)
@@ -0,0 +1,42 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from recommender import connection_trainer
+from recommender import weight_decay
+
+WEIGHTS = [-3, 0, 1e-5, 0.001, 0.1, 0.5, 1, 2, 5, 10, 50, 1e4]
+
+
+class WeightDecayTest(unittest.TestCase):
+
+  def testSameAsScalarDecay(self):
+    for learning_rate in [0.001, 0.1, 1]:
+      for num_items in [0, 1, 5, 16, 17, 100, 5000, 10**9]:
+        decayed = weight_decay.DecayedWeights(WEIGHTS, num_items,
+                                              learning_rate)
+        for weight, decayed_weight in zip(WEIGHTS, decayed):
+          self.assertAlmostEqual(
+              connection_trainer.DecayedWeight(weight, num_items,
+                                               learning_rate),
+              decayed_weight,
+              delta=1e-9)
+
+  def testEmpty(self):
+    self.assertEqual([], weight_decay.DecayedWeights([], 100, 0.1).tolist())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -52,7 +52,8 @@ angular
 
           this.getRecommendations = function(
               timePeriod, categoryIdFilter, sourceTypeIdFilter, includePopular,
-              limit, decayRate = 1, excludeUrls = []) {
+              limit, decayRate = 1, excludeUrls = [],
+              continuationToken = null) {
             sourceTypeIdFilter =
                 convertSourceTypeIdToServerId(sourceTypeIdFilter);
             var request = {
@@ -61,6 +62,7 @@ angular
               limit: limit,
               decay_rate: decayRate,
               exclude_urls: excludeUrls,
+              continuation_token: continuationToken,
             };
             if (categoryIdFilter === categoryService.ANY_CATEGORY.id) {
               request.any_category = true;
@@ -74,10 +76,22 @@ angular
                       categoryIdFilter);
             }
 
+            // The continuation token lets the server continue from where the
+            // previous page stopped. excludeUrls is only used when the token
+            // has expired.
             return promiseFactory
                 .getPostPromise('rest/recommendations', request, null)
-                .then(categoryService
-                          .convertServerCategoriesToClientCategoriesPromise);
+                .then(function(response) {
+                  return categoryService
+                      .convertServerCategoriesToClientCategoriesPromise(
+                          response.recommendations)
+                      .then(function(recommendations) {
+                        return {
+                          recommendations: recommendations,
+                          continuationToken: response.continuation_token,
+                        };
+                      });
+                });
           };
 
           this.getPastRecommendations = function(timePeriod, offset, limit) {
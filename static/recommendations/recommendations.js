@@ -227,19 +227,27 @@ angular
           $scope.initialPageLoaded = $scope.savedStateRestored;
 
           var PAGE_SIZE = 20;
+          // Returned with each page of recommendations to get the next one.
+          var continuationToken = null;
           $scope.recommendations = new ItemLoader(
               PAGE_SIZE,
               function (offset, pageSize, callback) {
                 var excludeUrls = $scope.recommendations.items.map(
                     (item) => item.destination_url);
+                if (offset == 0) {
+                  continuationToken = null;
+                }
                 recommendationsService
                     .getRecommendations(
                         $scope.originalStateParams.timePeriod,
                         $scope.originalStateParams.categoryId,
                         $scope.originalStateParams.sourceTypeIdFilter,
                         $scope.originalStateParams.includePopular, pageSize,
-                        $scope.originalStateParams.decay / 100, excludeUrls)
-                    .then(function (data) {
+                        $scope.originalStateParams.decay / 100, excludeUrls,
+                        continuationToken)
+                    .then(function (response) {
+                      continuationToken = response.continuationToken;
+                      var data = response.recommendations;
                       $scope.initialPageLoaded = true;
                       console.log('initial page loaded');
                       data.forEach(function (recommendation) {